@@ -1,11 +1,34 @@
 import os
-from datetime import datetime
+from numbers import Integral, Real
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from functools import wraps
+from datetime import date, datetime
 from dateutil.parser import parse
 from flask import Flask, request, session, g, redirect, url_for, abort, \
-        render_template, flash, jsonify, make_response, json
-from models import User, Game, Team, Player, Score
-from models import db 
-from sqlalchemy import desc
+        render_template, flash, jsonify, make_response, json, Response, \
+        stream_with_context
+from models import User, Game, Team, Player, Score, UserStats, ArchivedPlayer
+from models import db, game_graph, touch
+from validation import check_game, describe_game, is_id, parse_time, \
+        tally_points
+from stats import FIELDS as STAT_FIELDS, add_stat, apply_stats, \
+        apply_stats_batch, difference, finished_teams, game_stats, \
+        result_stats, team_results
+from ratings import rate_game, unrate_game
+from ingest import ingest
+from purge import delete_games, purge
+from archive import load_archived
+from serializers import encode_games, encode_users, serialize_score, \
+        string_types
+from bulk import allocate_ids, insert_rows
+from cache import ResponseCache
+from config import from_environ
+from events import EventHub
+from metrics import Metrics, count_statements
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, String, \
+        and_, bindparam, desc, exists, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from flask.ext.cors import CORS
 
@@ -13,11 +36,85 @@ from flask.ext.cors import CORS
 app = Flask(__name__)
 CORS(app)
 
+# Database and pool settings come from the environment (see config.py)
+app.config.update(from_environ())
 app.config.update(dict(
-    SQLALCHEMY_DATABASE_URI='postgresql+psycopg2://danny@localhost/testdb',
-    DEBUG=True
+    # Listings with more rows than this are streamed, this many at a time
+    STREAM_PAGE_SIZE=500,
+    STREAM_CHUNK_SIZE=100,
+    # Number of finished game responses kept in memory, and an optional
+    # cache shared between workers (see cache.py)
+    GAME_CACHE_SIZE=5000,
+    GAME_CACHE_BACKEND=None,
+    # Most items accepted by one bulk request
+    BULK_LIMIT=10000,
+    # Games validated, written and committed together by POST /games/ingest
+    INGEST_CHUNK_SIZE=500,
+    # Games deleted per transaction by DELETE /games
+    PURGE_BATCH_SIZE=500,
+    # Age in days at which manage.py archive moves finished games to the
+    # archive tables (see archive.py)
+    ARCHIVE_AFTER_DAYS=365,
+    # Names checked per IN (...) when looking for existing users. SQLite
+    # allows at most 999 parameters in a statement.
+    BULK_LOOKUP_SIZE=500,
+    # Messages queued for one GET /games/<id>/events stream before it is
+    # dropped as too slow, seconds between keepalives on idle streams, and
+    # an optional broker to share events between workers (see events.py)
+    EVENT_QUEUE_SIZE=100,
+    EVENT_KEEPALIVE=15,
+    EVENT_BROKER=None,
+    # Record per endpoint latency, response size and SQL statements, for
+    # GET /metrics
+    METRICS_ENABLED=True
 ))
 
+game_cache = ResponseCache(app.config['GAME_CACHE_SIZE'],
+        lambda game: is_game_over(game), app.config['GAME_CACHE_BACKEND'])
+game_events = EventHub(app.config['EVENT_QUEUE_SIZE'],
+        app.config['EVENT_BROKER'])
+
+def metric_gauges():
+    """The game cache and event hub levels, for GET /metrics"""
+    return {
+        ('game_cache_size', 'Game responses in the cache.'):
+            game_cache.stats()['size'],
+        ('event_listeners', 'Open game event streams.'):
+            game_events.stats()['listeners']
+    }
+
+def metric_counters():
+    """The game cache and event hub counters, for GET /metrics"""
+    cache = game_cache.stats()
+    events = game_events.stats()
+    return {
+        ('game_cache_hits', 'Game responses served from the cache.'):
+            cache['hits'],
+        ('game_cache_misses', 'Game responses not found in the cache.'):
+            cache['misses'],
+        ('game_cache_evictions', 'Game responses dropped from the cache to '
+            'make room.'): cache['evictions'],
+        ('events_published', 'Game events published.'): events['published'],
+        ('event_listeners_dropped', 'Event streams dropped for falling '
+            'behind.'): events['dropped']
+    }
+
+metrics = Metrics(gauges=metric_gauges, counters=metric_counters)
+count_statements()
+
+@app.before_request
+def start_metrics():
+    if app.config['METRICS_ENABLED']:
+        metrics.start()
+
+@app.after_request
+def record_metrics(response):
+    if app.config['METRICS_ENABLED']:
+        endpoint = request.url_rule.endpoint if request.url_rule is not None \
+                else 'unmatched'
+        metrics.finish(endpoint, response)
+    return response
+
 
 db.init_app(app)
 
@@ -29,14 +126,25 @@ def init_db():
     db.create_all()
 
 def apply_paging(query, request, Model):
+    """Apply sorting and paging from the request to query.
+
+    Two modes are supported. The default is page/per_page, which skips over
+    the earlier pages with an OFFSET. Passing cursor (empty for the first
+    page) switches to keyset paging: results are read from the position
+    encoded in the cursor, which the database can seek to through an index.
+
+    Returns the paged query and a dict describing the paging that was
+    applied, to be handed to next_cursor once the results are fetched."""
     sort_keys = [k for k in Model.__dict__ if k[:1] != '_' and \
         type(Model.__dict__[k]) == InstrumentedAttribute]
 
-    # Set default values
+    # Set default values. Listings are in id order unless asked otherwise,
+    # rather than by whichever attribute the model happens to list first.
     page = 1
     per_page = 50
-    sort_by = sort_keys[0]
+    sort_by = 'id'
     order = 1
+    cursor = None
 
     if 'page' in request.values:
         try:
@@ -62,15 +170,323 @@ def apply_paging(query, request, Model):
         else:
             raise ValueError('order must be 1 or -1')
 
-    # Apply paging operators to the query
+    if 'cursor' in request.values:
+        if sort_by not in Model.__table__.c:
+            raise ValueError('cursor paging can only sort by a column')
+        cursor = decode_cursor(request.values['cursor'], Model, sort_by)
+
+    # Apply paging operators to the query. id breaks ties so that rows come
+    # back in the same order every time.
+    column = Model.__dict__[sort_by]
     if order == 1:
-        query = query.order_by(Model.__dict__[sort_by])
+        query = query.order_by(column, Model.id)
+    else:
+        query = query.order_by(desc(column), desc(Model.id))
+
+    if cursor is None:
+        query = query.slice((page-1) * per_page, page * per_page)
     else:
-        query = query.order_by(desc(Model.__dict__[sort_by]))
+        if len(cursor) > 0:
+            query = query.filter(seek_clause(column, Model.id, order, cursor))
+        query = query.limit(per_page)
+
+    return query, {
+        'cursor': cursor is not None,
+        'sort_by': sort_by,
+        'per_page': per_page
+    }
+
+def read_page(request, per_page=10):
+    """page and per_page from the request, for views ranked by an index
+    rather than sorted by apply_paging"""
+    try:
+        page = int(request.values.get('page', 1))
+        per_page = int(request.values.get('per_page', per_page))
+    except ValueError:
+        raise ValueError('page and per_page must be integers > 0')
+
+    if page < 1 or per_page < 1:
+        raise ValueError('page and per_page must be integers > 0')
+
+    return page, per_page
 
-    query = query.slice((page-1) * per_page, page * per_page)
+def seek_clause(column, id_column, order, cursor):
+    """Filter selecting the rows that sort after the cursor position.
 
-    return query
+    Where NULLs fall depends on the database (first in ascending order on
+    SQLite, last on PostgreSQL), so the clause follows the native ordering
+    rather than forcing one that an index can't serve."""
+    value, last_id = cursor
+
+    if order == 1:
+        after = lambda a, b: a > b
+    else:
+        after = lambda a, b: a < b
+
+    nulls_last = db.engine.dialect.name not in ['sqlite', 'mysql']
+    nulls_after = nulls_last if order == 1 else not nulls_last
+
+    if value is None:
+        clause = and_(column.is_(None), after(id_column, last_id))
+        if not nulls_after:
+            clause = or_(clause, column.isnot(None))
+        return clause
+
+    clause = or_(after(column, value),
+            and_(column == value, after(id_column, last_id)))
+    if nulls_after:
+        clause = or_(clause, column.is_(None))
+    return clause
+
+def encode_cursor(value, item_id):
+    """Pack a (sort value, id) seek position into an opaque string"""
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    raw = json.dumps([value, item_id], separators=(',', ':'))
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, Model, sort_by):
+    """Unpack a cursor made by encode_cursor. An empty cursor means start
+    from the beginning."""
+    if cursor == '':
+        return ()
+
+    try:
+        raw = urlsafe_b64decode(str(cursor + '=' * (-len(cursor) % 4)))
+        value, item_id = json.loads(raw.decode('utf-8'))
+        if not fits_column(item_id, Integer()):
+            raise ValueError(item_id)
+        if value is not None:
+            value = cursor_value(value, Model.__table__.c[sort_by].type)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError('cursor is not valid')
+
+    return (value, item_id)
+
+def fits_column(value, column_type):
+    """Whether a value decoded from JSON fits a column of column_type"""
+    if isinstance(column_type, Boolean):
+        return isinstance(value, bool)
+    if isinstance(value, bool):
+        return False
+    if isinstance(column_type, Integer):
+        return isinstance(value, Integral)
+    if isinstance(column_type, Float):
+        return isinstance(value, Real)
+    return isinstance(value, string_types)
+
+def cursor_value(value, column_type):
+    """A cursor's sort value as the column of column_type compares it.
+    Raises ValueError if it isn't of the column's type."""
+    if not fits_column(value, column_type):
+        raise ValueError(value)
+    if isinstance(column_type, DateTime):
+        return parse(value)
+    if isinstance(column_type, Date):
+        return parse(value).date()
+    if not isinstance(column_type, (Boolean, Integer, Float, String)):
+        raise ValueError(value)
+    return value
+
+def next_cursor(last, count, paging):
+    """Cursor for the page after one of count rows ending with last, or None
+    if that was the final page"""
+    if not paging['cursor'] or count < paging['per_page'] or count == 0:
+        return None
+
+    return encode_cursor(getattr(last, paging['sort_by']), last.id)
+
+def page_response(query, paging, Model, encode, options=(), cache=None):
+    """Respond with a page of Model rows as a JSON array.
+
+    Pages up to STREAM_PAGE_SIZE rows are built in memory. Bigger pages, or
+    any page when the request passes stream=1, are streamed instead: the ids
+    on the page are read first, then the rows are loaded, serialized and
+    written out STREAM_CHUNK_SIZE at a time. Memory use then stays flat
+    whatever per_page is, and the client gets the first rows while later
+    ones are still being read. Both produce the same bytes.
+
+    encode turns a list of rows into a list of their JSON texts, and options
+    are loader options it needs. If a ResponseCache is given, rows it holds
+    are served from it without being loaded at all."""
+    per_page = paging['per_page']
+    streaming = request.values.get('stream') == '1' or \
+            per_page > app.config['STREAM_PAGE_SIZE']
+
+    if cache is None and not streaming:
+        items = query.options(*options).all()
+        resp = make_response('[' + ', '.join(encode(items)) + ']')
+
+        last = items[-1] if len(items) > 0 else None
+        cursor = next_cursor(last, len(items), paging)
+    else:
+        columns = [Model.id, Model.version]
+        if paging['cursor']:
+            columns.append(Model.__dict__[paging['sort_by']])
+        keys = query.with_entities(*columns).all()
+
+        last = keys[-1] if len(keys) > 0 else None
+        cursor = next_cursor(last, len(keys), paging)
+
+        def render(chunk):
+            texts = {}
+            if cache is not None:
+                for key in chunk:
+                    text = cache.get(key.id, key.version, 'list')
+                    if text is not None:
+                        texts[key.id] = text
+
+            missing = [key.id for key in chunk if key.id not in texts]
+            if len(missing) > 0:
+                rows = db.session.query(Model).options(*options)\
+                        .filter(Model.id.in_(missing)).all()
+                for row, text in zip(rows, encode(rows)):
+                    texts[row.id] = text
+                    if cache is not None and cache.cacheable(row):
+                        cache.set(row.id, row.version, 'list', text)
+
+            # Rows deleted since the ids were read are left out
+            return [texts[key.id] for key in chunk if key.id in texts]
+
+        if not streaming:
+            resp = make_response('[' + ', '.join(render(keys)) + ']')
+        else:
+            chunk_size = app.config['STREAM_CHUNK_SIZE']
+
+            def generate():
+                yield '['
+                separator = ''
+                for start in range(0, len(keys), chunk_size):
+                    parts = render(keys[start:start + chunk_size])
+                    if len(parts) > 0:
+                        yield separator + ', '.join(parts)
+                        separator = ', '
+                yield ']'
+
+            resp = Response(stream_with_context(generate()))
+
+    if cursor is not None:
+        resp.headers['X-Next-Cursor'] = cursor
+
+    return resp
+
+def with_game(*options):
+    """Route decorator that loads the game named by the game_id url argument
+    once, and passes it to the view in place of the id. Responds with a 404
+    if there is no such game.
+
+    options are loader options for the relationships the view is going to
+    touch, so they come back with the game instead of one query at a time.
+
+    Archived games are read back from the archive for GET requests, and
+    passed on as they are to DELETE. Anything else gets a 400.
+
+    A PUT locks the game before reading it: it writes the teams' points as
+    worked out from what it read, so a goal posted in between would be
+    lost."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(game_id, *args, **kwargs):
+            if request.method == 'PUT':
+                lock_game(game_id)
+            game = db.session.query(Game).options(*options)\
+                    .filter(Game.id == game_id).first()
+
+            if game is None:
+                return make_response('game does not exist', '404', '')
+
+            if game.archived:
+                if request.method in ('GET', 'HEAD'):
+                    game = load_archived(db.session, [game])[0]
+                elif request.method != 'DELETE':
+                    return make_response('game is archived', '400', '')
+
+            # Keep the game for the rest of the request (see conditional)
+            g.loaded = game
+            return view(game, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def with_user(*options):
+    """Like with_game, for views taking a user_id url argument"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(user_id, *args, **kwargs):
+            user = db.session.query(User).options(*options)\
+                    .filter(User.id == user_id).first()
+
+            if user is None:
+                return make_response('user does not exist', '404', '')
+
+            g.loaded = user
+            return view(user, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def conditional(Model, key):
+    """Route decorator adding ETag and Last-Modified validators, taken from
+    the version of the Model row named by the key url argument.
+
+    A request with If-None-Match or If-Modified-Since is checked against the
+    row's version first, with a single lookup by primary key, and answered
+    with a 304 without running the view if nothing has changed. Otherwise the
+    validators are read from the row the view loaded."""
+    def validators(object_id, version, updated):
+        etag = '%s-%s-%s' % (Model.__tablename__, object_id, version)
+        if updated is not None:
+            updated = updated.replace(microsecond=0)
+        return etag, updated
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            object_id = kwargs[key]
+
+            if 'If-None-Match' in request.headers or \
+                    'If-Modified-Since' in request.headers:
+                row = db.session.query(Model.version, Model.updated)\
+                        .filter(Model.id == object_id).first()
+
+                if row is not None:
+                    etag, updated = validators(object_id, *row)
+                    if 'If-None-Match' in request.headers:
+                        fresh = request.if_none_match.contains_weak(etag)
+                    else:
+                        since = request.if_modified_since
+                        fresh = updated is not None and since is not None and \
+                                updated <= since.replace(tzinfo=None)
+
+                    if fresh:
+                        resp = Response(status=304)
+                        resp.set_etag(etag, weak=True)
+                        resp.last_modified = updated
+                        return resp
+
+            resp = make_response(view(**kwargs))
+
+            if resp.status_code == 200:
+                # Use the row the view loaded if there is one
+                obj = getattr(g, 'loaded', None)
+                if getattr(obj, 'id', None) != object_id:
+                    obj = db.session.query(Model).get(object_id)
+                if obj is not None:
+                    etag, updated = validators(object_id, obj.version,
+                            obj.updated)
+                    resp.set_etag(etag, weak=True)
+                    resp.last_modified = updated
+
+            return resp
+        return wrapper
+    return decorator
+
+def encode_game_rows(games):
+    """encode_games, reading archived games back from the archive"""
+    return encode_games(load_archived(db.session, games))
+
+def load_game_graph(game_id):
+    """Load a single game along with everything its serialization needs"""
+    return db.session.query(Game).options(*game_graph())\
+            .filter(Game.id == game_id).first()
     
 # Routes
 @app.route('/games', methods=['GET'])
@@ -86,6 +502,9 @@ def get_games():
     #    per_page -- Number of results per page.
     #    sort_by -- Field to sort by.
     #    order -- -1: ascending, 1: descending
+    #    cursor -- Keyset paging position from a previous X-Next-Cursor
+    #              header. Pass it empty to start from the first page.
+    #    stream -- 1 to stream the response (automatic for large pages).
     if 'user_id' in request.values:
         uid = request.values['user_id']
         try:
@@ -93,7 +512,14 @@ def get_games():
         except ValueError:
             return make_response('User_id must be an integer.', '400',\
                 '')
-        games = games.filter(Game.players.any(user_id=uid))
+        # An IN lets the database start from the user's rows in
+        # ix_players_user_id_game_id rather than testing every game, and
+        # the same for archived games
+        played = db.session.query(Player.game_id).filter(Player.user_id == uid)
+        archived = db.session.query(ArchivedPlayer.game_id)\
+                .filter(ArchivedPlayer.user_id == uid)
+        games = games.filter(or_(Game.id.in_(played.subquery()),
+                Game.id.in_(archived.subquery())))
 
     if 'started_after' in request.values:
         after = request.values['started_after']
@@ -116,11 +542,12 @@ def get_games():
         games = games.filter(Game.start < before)
 
     try:
-        games = apply_paging(games, request, Game)
+        games, paging = apply_paging(games, request, Game)
     except ValueError as e:
         return make_response(e.args[0], '400', '')
 
-    return json.dumps([game.serialize for game in games])
+    return page_response(games, paging, Game, encode_game_rows, game_graph(),
+            game_cache)
     #return jsonify( games=[game.serialize for game in games])
 
 @app.route('/users', methods=['GET'])
@@ -128,45 +555,201 @@ def get_users():
     users = db.session.query(User)
 
     try:
-        users = apply_paging(users, request, User)
+        users, paging = apply_paging(users, request, User)
     except ValueError as e:
         return make_response(e.args[0], '400', '')
 
-    return json.dumps([user.serialize for user in users])
+    return page_response(users, paging, User, encode_users)
     #return jsonify( users=[user.serialize for user in users])
 
-@app.route('/users', methods=['POST'])
-def create_user():
-    u_json = request.json 
-    u = User()
+def user_values(u_json):
+    """Column values for a new user from its JSON, or raise ValueError with
+    what is wrong with it"""
+    if not isinstance(u_json, dict) or u_json.get('name') is None:
+        raise ValueError('must include a name')
 
-    if 'name' in u_json:
-        u.name = u_json['name']
-    else:
-        return abort(400)
+    if not isinstance(u_json['name'], string_types):
+        raise ValueError('name must be a string')
 
-    if u.name == '':
-        return make_response('must include a name', '400', '')
+    if u_json['name'] == '':
+        raise ValueError('must include a name')
 
-    if db.session.query(User).filter(User.name == u.name).count() > 0:
-        return make_response('user already exists', '400', '')
-    
-    if 'first_name' in u_json:
-        u.first_name = u_json['first_name']
+    for field in ('first_name', 'last_name', 'email'):
+        if not isinstance(u_json.get(field, ''), (string_types, type(None))):
+            raise ValueError('%s must be a string' % (field,))
 
-    if 'last_name' in u_json:
-        u.last_name = u_json['last_name']
+    values = {
+        'name': u_json['name'],
+        'first_name': u_json.get('first_name'),
+        'last_name': u_json.get('last_name'),
+        'birthday': None,
+        'email': u_json.get('email')
+    }
 
     if u_json.get('birthday') is not None:
         try:
-            u.birthday = parse(u_json['birthday'])
-        except ValueError:
-            return make_response('birthday must be in format: YYYY-MM-DDThh:mm:ss', '400',\
-                '')
+            values['birthday'] = parse(u_json['birthday'])
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError('birthday must be in format: YYYY-MM-DDThh:mm:ss')
+
+    return values
+
+def read_items(request):
+    """The items of a bulk request: a JSON array, or one JSON document per
+    line (NDJSON). Returns (items, errors), errors giving a message for each
+    item that couldn't be read, by index. Raises ValueError if the body
+    isn't UTF-8."""
+    errors = {}
+
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        try:
+            lines = request.get_data().decode('utf-8').splitlines()
+        except UnicodeDecodeError:
+            raise ValueError('body must be UTF-8')
+        for line in lines:
+            if line.strip() == '':
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                errors[len(items)] = 'not valid JSON'
+                items.append(None)
+        return items, errors
+
+    return request.json, errors
+
+def bulk_response(results):
+    """Respond to a bulk request with its per item results: 201 if every
+    item was created, 400 if none were, 207 otherwise"""
+    created = len([r for r in results if r['status'] == 201])
+
+    resp = jsonify( results=results )
+    if created == len(results):
+        resp.status_code = 201
+    elif created == 0:
+        resp.status_code = 400
+    else:
+        resp.status_code = 207
+    return resp
+
+def existing_names(names):
+    """The subset of names already taken, looked up in batches of
+    BULK_LOOKUP_SIZE"""
+    names = list(names)
+    size = app.config['BULK_LOOKUP_SIZE']
+    taken = set()
+
+    for start in range(0, len(names), size):
+        rows = db.session.query(User.name)\
+                .filter(User.name.in_(names[start:start + size]))
+        taken.update(row.name for row in rows)
+
+    return taken
+
+def load_users_by_name(names):
+    """Users with the given names, by name, loaded in batches"""
+    names = list(names)
+    size = app.config['BULK_LOOKUP_SIZE']
+    users = {}
+
+    for start in range(0, len(names), size):
+        for user in db.session.query(User)\
+                .filter(User.name.in_(names[start:start + size])):
+            users[user.name] = user
+
+    return users
+
+def create_users(items, errors):
+    """Validate and insert a batch of users in one transaction.
+
+    Items are checked on their own, then against each other and the
+    database for duplicate names, and the valid ones are written with a
+    single executemany INSERT. Returns a result per item."""
+    rows = {}
+    for index, u_json in enumerate(items):
+        if index in errors:
+            continue
+        try:
+            rows[index] = user_values(u_json)
+        except ValueError as e:
+            errors[index] = e.args[0]
+
+    # A name can only be used once, by the first item asking for it
+    first = {}
+    for index in sorted(rows):
+        name = rows[index]['name']
+        if name in first:
+            errors[index] = 'user already exists'
+        else:
+            first[name] = index
+    for name in existing_names(first):
+        errors[first.pop(name)] = 'user already exists'
+
+    if len(first) > 0:
+        db.session.execute(User.__table__.insert(),
+                [rows[index] for index in sorted(first.values())])
+        # Serialized before the commit expires them
+        created = dict((name, user.serialize)
+                for name, user in load_users_by_name(first).items())
+        db.session.commit()
+    else:
+        created = {}
+
+    results = []
+    for index in range(len(items)):
+        if index in errors:
+            results.append({ 'index': index, 'status': 400,
+                'error': errors[index] })
+        else:
+            results.append({ 'index': index, 'status': 201,
+                'user': created[rows[index]['name']] })
+    return results
 
-    if 'email' in u_json:
-        u.email = u_json['email']
+@app.route('/users', methods=['POST'])
+def create_user():
+    """Create a user, or a batch of them from a JSON array or NDJSON"""
+    if request.mimetype == 'application/x-ndjson' or \
+            isinstance(request.json, list):
+        try:
+            items, errors = read_items(request)
+        except ValueError as e:
+            return make_response(e.args[0], '400', '')
+        if len(items) == 0:
+            return make_response('must include at least one user', '400', '')
+        if len(items) > app.config['BULK_LIMIT']:
+            return make_response('at most %s users can be created at once'
+                    % (app.config['BULK_LIMIT'],), '413', '')
+
+        try:
+            results = create_users(items, dict(errors))
+        except IntegrityError:
+            # A name was taken between the check and the insert
+            db.session.rollback()
+            try:
+                results = create_users(items, dict(errors))
+            except IntegrityError:
+                # and again, by a writer racing this batch
+                db.session.rollback()
+                return make_response('users with these names are being '
+                        'created by another request, try again', '409', '')
+
+        return bulk_response(results)
+
+    u_json = request.json 
+
+    if not isinstance(u_json, dict) or 'name' not in u_json:
+        return abort(400)
 
+    try:
+        values = user_values(u_json)
+    except ValueError as e:
+        return make_response(e.args[0], '400', '')
+
+    if db.session.query(exists().where(User.name == values['name'])).scalar():
+        return make_response('user already exists', '400', '')
+
+    u = User(**values)
     db.session.add(u)
     db.session.commit()
 
@@ -175,16 +758,16 @@ def create_user():
 
     return resp
 
+@app.route('/users/<int:user_id>', methods=['GET'])
+@conditional(User, 'user_id')
+@with_user()
+def get_user(user):
+    return jsonify(user.serialize)
+
 @app.route('/users/<int:user_id>', methods=['PUT'])
-def put_user(user_id):
+@with_user()
+def put_user(user):
     """Update an existng user object"""
-    # Check that user exists 
-    user = db.session.query(User).filter(User.id == user_id)
-
-    if user.count() == 0:
-        return make_response('user does not exist', '404', '')
-
-    user = user.first()
     user_json = request.json
 
     # Update non-key fields for user
@@ -197,6 +780,17 @@ def put_user(user_id):
         except ValueError:
             return make_response('birthday must be in form YYYY-MM-DDThh:mm:ss', '400', '')
     user.email = user_json.get('email', user.email)
+    touch(user)
+
+    # The user appears in the games they played, archived ones included,
+    # so those change too
+    played = db.session.query(Player.game_id).filter(Player.user_id == user.id)
+    archived = db.session.query(ArchivedPlayer.game_id)\
+            .filter(ArchivedPlayer.user_id == user.id)
+    db.session.query(Game).filter(or_(Game.id.in_(played.subquery()),
+                Game.id.in_(archived.subquery())))\
+            .update({ Game.version: Game.version + 1,
+                Game.updated: datetime.utcnow() }, synchronize_session=False)
 
     db.session.commit()
 
@@ -206,92 +800,142 @@ def put_user(user_id):
     return j_response
 
 @app.route('/users/<int:user_id>', methods=['DELETE'])
-def delete_user(user_id):
-    users = db.session.query(User)\
-            .filter(User.id == user_id)
-
-    if users.count() != 1:
-        return abort(404)
-
+@with_user()
+def delete_user(user):
     # Check if the user is in any games. If so, don't allow delete
-    player_count = db.session.query(Player)\
-                .filter(Player.user_id == user_id)\
-                .count()
+    in_games = db.session.query(or_(
+                exists().where(Player.user_id == user.id),
+                exists().where(ArchivedPlayer.user_id == user.id)))\
+                .scalar()
 
-    if player_count > 0:
+    if in_games:
         return make_response("can't delete user that is in games", '405', '')
 
-    user = users.first()
+    db.session.query(UserStats).filter(UserStats.user_id == user.id)\
+            .delete(synchronize_session=False)
     db.session.delete(user)
     db.session.commit()
 
     return make_response('', 204, '')
 
+@app.route('/users/<int:user_id>/stats', methods=['GET'])
+@with_user()
+def get_user_stats(user):
+    """A user's running totals, read from a single user_stats row"""
+    stats = db.session.query(UserStats).get(user.id)
+
+    # Users who haven't played yet have no row
+    if stats is None:
+        stats = UserStats(user_id=user.id, **dict.fromkeys(STAT_FIELDS, 0))
+
+    return jsonify(stats.serialize)
+
+@app.route('/leaderboard', methods=['GET'])
+def get_leaderboard():
+    """Users ranked by wins, then fewest losses.
+
+    The order is that of ix_user_stats_ranking, so a page is read straight
+    off the index however many games have been played. Accepts page and
+    per_page like the listings."""
+    try:
+        page, per_page = read_page(request)
+    except ValueError as e:
+        return make_response(e.args[0], '400', '')
+
+    rows = db.session.query(UserStats, User)\
+            .join(User, User.id == UserStats.user_id)\
+            .order_by(desc(UserStats.wins), UserStats.losses,
+                UserStats.user_id)\
+            .slice((page-1) * per_page, page * per_page)
+
+    leaderboard = []
+    for rank, (stats, user) in enumerate(rows, (page-1) * per_page + 1):
+        entry = stats.serialize
+        entry['rank'] = rank
+        entry['user'] = user.serialize
+        leaderboard.append(entry)
+
+    return jsonify( leaderboard=leaderboard )
+
+@app.route('/ratings', methods=['GET'])
+def get_ratings():
+    """Users by rating, best first, read in the order of ix_users_rating.
+    Accepts page and per_page like the listings."""
+    try:
+        page, per_page = read_page(request)
+    except ValueError as e:
+        return make_response(e.args[0], '400', '')
+
+    rows = db.session.query(User.id, User.name, User.rating)\
+            .order_by(desc(User.rating), User.id)\
+            .slice((page-1) * per_page, page * per_page)
+
+    ratings = []
+    for rank, row in enumerate(rows, (page-1) * per_page + 1):
+        ratings.append({
+            'rank': rank,
+            'user_id': row.id,
+            'name': row.name,
+            'rating': row.rating
+        })
+
+    return jsonify( ratings=ratings )
+
 @app.route('/games/<int:game_id>', methods=['GET'])
+@conditional(Game, 'game_id')
 def get_game(game_id):
-    # check count
-    count = db.session.query(Game).filter(Game.id == game_id).count()
+    # jsonify only pretty prints for requests not made with XMLHttpRequest
+    fmt = 'list' if request.is_xhr else 'pretty'
 
-    if count == 0:
+    # Finished games are served from the cache, which only needs the version
+    row = db.session.query(Game.id, Game.version, Game.updated)\
+            .filter(Game.id == game_id).first()
+    if row is None:
         return make_response('game does not exist', '404', '')
 
-    game = db.session.query(Game).filter(Game.id == game_id).first()
+    text = game_cache.get(row.id, row.version, fmt)
+    if text is not None:
+        g.loaded = row
+        return Response(text, mimetype='application/json')
 
-    return jsonify( game.serialize )
+    game = load_game_graph(game_id)
+    if game is None:
+        return make_response('game does not exist', '404', '')
+    if game.archived:
+        game = load_archived(db.session, [game])[0]
 
-@app.route('/games/<int:game_id>/players', methods=['GET'])
-def get_players(game_id):
-    # Sanity check
-    count = db.session.query(Game).filter(Game.id == game_id).count()
+    g.loaded = game
+    resp = jsonify( game.serialize )
+    if game_cache.cacheable(game):
+        game_cache.set(game.id, game.version, fmt, resp.get_data())
 
-    if count == 0:
-        return make_response('game does not exist', '404', '')
+    return resp
 
-    players = db.session.query(Player).filter(Game.id == game_id)\
-            .filter(Game.id == Player.game_id)\
-            .order_by(Player.team_id, Player.position)
+@app.route('/games/<int:game_id>/players', methods=['GET'])
+@conditional(Game, 'game_id')
+@with_game(joinedload(Game.players))
+def get_players(game):
+    players = sorted(game.players, key=lambda p: (p.team_id, p.position))
 
     return jsonify( players=[ player.serialize for player in players ])
 
 @app.route('/games/<int:game_id>/scores', methods=['GET'])
-def get_scores(game_id):
-    # Sanity check
-    count = db.session.query(Game).filter(Game.id == game_id).count()
-
-    if count == 0:
-        return make_response('game does not exist', '404', '')
-
-    scores = db.session.query(Score).filter(Game.id == game_id)\
-            .filter(Game.id == Score.game_id)\
-            .order_by(Score.id)
-
-    return jsonify( scores=[ score.serialize for score in scores ])
+@conditional(Game, 'game_id')
+@with_game(joinedload(Game.scores))
+def get_scores(game):
+    return jsonify( scores=[ score.serialize for score in game.scores ])
 
 @app.route('/games/<int:game_id>/score', methods=['POST'])
-def make_score(game_id):
+@with_game(joinedload(Game.teams))
+def make_score(game):
     """Takes a JSON object representing a new score and inserts it into the db"""
-    # Check that game exists 
-    game = db.session.query(Game).filter(Game.id == game_id)
-
-    if game.count() == 0:
-        return make_response('game does not exist', '404', '')
-
     # Check that game isn't over 
-    game = game.first()
     if game.end is not None:
         return make_response('game is already over', '400', '')
 
     # Check that neither team already has 10 points in game
-    for team in game.teams:
-        total_score = 0
-        for player in team.players:
-            for score in player.scores:
-                if score.own_goal:
-                    total_score -= 1
-                else:
-                    total_score += 1
-        if total_score >= 10:
-            return make_response('team already has 10 points', '400', '')
+    if max([team.points for team in game.teams] or [0]) >= 10:
+        return make_response('team already has 10 points', '400', '')
 
     # Make sure JSON was passed in
     if request.json is None:
@@ -322,40 +966,227 @@ def make_score(game_id):
 
     player = db.session.query(Player)\
             .filter(Player.id == player_id)\
-            .filter(Player.game_id == game_id)
+            .filter(Player.game_id == game.id)\
+            .first()
 
     # Check that player exists 
-    if player.count() != 1:
+    if player is None:
         return make_response('player not found', '404', '')
 
-    player = player.first()
+    # Own goals count for the other team
+    team_id = player.team_id
+    if own_goal:
+        others = [team.id for team in game.teams if team.id != player.team_id]
+        if len(others) > 0:
+            team_id = others[0]
+
+    if not award_points(game.id, team_id, 1):
+        db.session.rollback()
+        return make_response('team already has 10 points', '400', '')
 
     score = Score(player_id=player.id, team_id=player.team_id,\
                 game_id=player.game_id, time=time, own_goal=own_goal)
 
     db.session.add(score)
+    touch(game)
+
+    # Credit the goal, and the result too if this goal ended the game
+    changes = {}
+    add_stat(changes, player.user_id, 'own_goals' if own_goal else 'goals', 1)
+    teams = team_results(db.session, game.id)
+    finished = max([points for points, users in teams] or [0]) >= 10
+    if finished:
+        result_stats(teams, changes)
+    apply_stats(db.session, changes)
+    if finished:
+        rate_game(db.session, game.id)
+
+    # Points as loaded, plus this goal, and who scored it, read before the
+    # commit expires them
+    points = dict((team.id, team.points) for team in game.teams)
+    points[team_id] += 1
+    scorer = { 'player_id': player.id, 'team_id': player.team_id }
+    game_id = game.id
+
     db.session.commit()
 
+    publish_goals(game_id, [dict(score.serialize, **scorer)], points, finished)
+
     r_json = jsonify(score.serialize)
     r_json.status_code = 201 
 
     return r_json 
 
-@app.route('/games/<int:game_id>/teams', methods=['GET'])
-def get_teams(game_id):
-    # Sanity check
-    count = db.session.query(Game).filter(Game.id == game_id).count()
+def check_scores(game, scores_json):
+    """Check a batch of new scores against the game they are posted to.
+
+    Goals are counted in the order given, each own goal for the other team,
+    so a batch can't take a team past 10 points or score after the game is
+    won. Returns (rows, points, errors): the score rows to insert, each
+    team's points once they are in, and every problem found."""
+    players = dict((player.id, player) for player in game.players)
+    points = dict((team.id, team.points) for team in game.teams)
+    rows = []
+    errors = []
+
+    for index, score_json in enumerate(scores_json):
+        problems = []
+        if not isinstance(score_json, dict):
+            errors.append('score %s: must be a score object' % (index,))
+            continue
+
+        # Anything but a whole number is no player (true would be player 1)
+        player_id = score_json.get('player_id')
+        player = players.get(player_id) if is_id(player_id) else None
+        if player is None:
+            problems.append('player not found')
+
+        time = score_json.get('time')
+        if time is None:
+            time = datetime.now()
+        else:
+            time = parse_time(time, problems)
+
+        own_goal = bool(score_json.get('own_goal'))
+
+        if player is not None:
+            # Own goals count for the other team
+            team_id = player.team_id
+            if own_goal:
+                others = [t for t in points if t != player.team_id]
+                if len(others) > 0:
+                    team_id = others[0]
+
+            if max(points.values() or [0]) >= 10:
+                problems.append('team already has 10 points')
+            else:
+                points[team_id] += 1
+
+        if len(problems) > 0:
+            errors.extend('score %s: %s' % (index, problem)
+                    for problem in problems)
+        else:
+            rows.append({ 'player_id': player.id, 'team_id': player.team_id,
+                'game_id': game.id, 'time': time, 'own_goal': own_goal })
+
+    return rows, points, errors
+
+@app.route('/games/<int:game_id>/scores', methods=['POST'])
+@with_game(joinedload(Game.teams), joinedload(Game.players))
+def make_scores(game):
+    """Takes a JSON array of new scores, such as goals a table buffered
+    while it was offline, and inserts them together.
+
+    The whole batch is checked first and nothing is written unless every
+    score is valid. The scores go in with one INSERT, each team's points
+    with one conditional UPDATE."""
+    if game.end is not None:
+        return make_response('game is already over', '400', '')
+
+    scores_json = request.json
+    if not isinstance(scores_json, list) or len(scores_json) == 0:
+        return make_response('must pass in an array of scores', '400', '')
+    if len(scores_json) > app.config['BULK_LIMIT']:
+        return make_response('at most %s scores can be posted at once'
+                % (app.config['BULK_LIMIT'],), '413', '')
+
+    rows, points, errors = check_scores(game, scores_json)
+    if len(errors) > 0:
+        return make_response('\n'.join(errors), '400', '')
+
+    # Award the team reaching 10, if any, last: award_points refuses
+    # points once either team has 10
+    gained = sorted((points[team.id], team.id, points[team.id] - team.points)
+            for team in game.teams if points[team.id] != team.points)
+    for total, team_id, amount in gained:
+        if not award_points(game.id, team_id, amount):
+            db.session.rollback()
+            return make_response('team already has 10 points', '400', '')
 
-    if count == 0:
+    connection = db.session.connection()
+    for row, score_id in zip(rows, allocate_ids(connection, Score.__table__,
+            len(rows))):
+        row['id'] = score_id
+    insert_rows(connection, Score.__table__, rows)
+    touch(game)
+
+    # Credit the goals, and the result too if the batch ended the game
+    players = dict((player.id, player) for player in game.players)
+    changes = {}
+    for row in rows:
+        add_stat(changes, players[row['player_id']].user_id,
+                'own_goals' if row['own_goal'] else 'goals', 1)
+    finished = max(points.values() or [0]) >= 10
+    if finished:
+        result_stats(team_results(db.session, game.id), changes)
+    apply_stats(db.session, changes)
+    if finished:
+        rate_game(db.session, game.id)
+
+    # Serialized from the rows, which hold everything a score shows
+    scores = [serialize_score(Score(**row)) for row in rows]
+    game_id = game.id
+    db.session.commit()
+
+    publish_goals(game_id, [dict(score, player_id=row['player_id'],
+        team_id=row['team_id']) for score, row in zip(scores, rows)],
+        points, finished)
+
+    resp = jsonify( scores=scores )
+    resp.status_code = 201
+    return resp
+
+def publish_end(game_id, points):
+    """Tell a game's listeners it is over, with { team_id: points }"""
+    game_events.publish(game_id, 'end', { 'game_id': game_id,
+        'teams': [{ 'id': team_id, 'points': team_points }
+            for team_id, team_points in sorted(points.items())] })
+
+def publish_goals(game_id, scores, points, finished):
+    """Tell a game's listeners about committed goals, along with each
+    team's points, { team_id: points }, once they are in"""
+    teams = [{ 'id': team_id, 'points': team_points }
+            for team_id, team_points in sorted(points.items())]
+    for score in scores:
+        game_events.publish(game_id, 'goal', { 'game_id': game_id,
+            'score': score, 'teams': teams })
+    if finished:
+        publish_end(game_id, points)
+
+@app.route('/games/<int:game_id>/events', methods=['GET'])
+def game_event_stream(game_id):
+    """Stream a game's events as Server-Sent Events (see events.py)"""
+    if not db.session.query(exists().where(Game.id == game_id)).scalar():
         return make_response('game does not exist', '404', '')
 
-    teams = db.session.query(Team).filter(Game.id == game_id)\
-            .filter(Game.id == Team.game_id)\
-            .order_by(Team.id)
+    # Listen before returning, so nothing committed from here on is missed,
+    # and give the connection back: the stream never touches the database
+    listener = game_events.subscribe(game_id)
+    db.session.close()
 
+    def generate():
+        try:
+            # Reconnect after three seconds if the stream breaks
+            yield 'retry: 3000\n\n'
+            for text in listener.messages(app.config['EVENT_KEEPALIVE']):
+                yield text
+        finally:
+            game_events.unsubscribe(listener)
+
+    resp = Response(generate(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+@app.route('/games/<int:game_id>/teams', methods=['GET'])
+@conditional(Game, 'game_id')
+@with_game(joinedload(Game.teams).joinedload(Team.players)\
+        .joinedload('user'))
+def get_teams(game):
     results = []
 
-    for team in teams:
+    for team in game.teams:
         t = {}
         t['id'] = team.id
         t['players'] = []
@@ -371,274 +1202,276 @@ def get_teams(game_id):
 
     return jsonify( teams=results )
 
+def save_game(game, existing=None):
+    """Write a game resolved by validation.check_game, returning its id.
+
+    existing is the loaded Game being updated, if any. Its rows are compared
+    with the resolved game by id and only the ones that differ are written,
+    with Core statements: at most one executemany INSERT for the new rows
+    and one executemany UPDATE for the changed rows of each table, however
+    big the game is. The game's own row is written first, which on SQLite
+    takes the write lock before ids are reserved for the new rows (see
+    bulk.allocate_ids)."""
+    connection = db.session.connection()
+    games = Game.__table__
+    teams = Team.__table__
+    players = Player.__table__
+    scores = Score.__table__
+    now = datetime.utcnow()
+
+    if existing is None:
+        game_id = connection.execute(games.insert().values(
+            start=game['start'], end=game['end'], updated=now))\
+            .inserted_primary_key[0]
+        old_teams, old_players, old_scores = {}, {}, {}
+    else:
+        game_id = existing.id
+        connection.execute(games.update().where(games.c.id == game_id)\
+            .values(start=game['start'], end=game['end'],
+                version=games.c.version + 1, updated=now))
+        old_teams = dict((t.id, (t.name, t.points)) for t in existing.teams)
+        old_players = dict((p.id, (p.position, p.user_id))
+            for t in existing.teams for p in t.players)
+        old_scores = dict((s.id, (s.time, s.own_goal))
+            for t in existing.teams for p in t.players for s in p.scores)
+
+    # Reserve ids for the new rows
+    new_teams = [team for team in game['teams'] if team['id'] is None]
+    new_players = [player for team in game['teams']
+        for player in team['players'] if player['id'] is None]
+    new_scores = [score for team in game['teams'] for player in team['players']
+        for score in player['scores'] if score['id'] is None]
+    team_ids = iter(allocate_ids(connection, teams, len(new_teams)))
+    player_ids = iter(allocate_ids(connection, players, len(new_players)))
+    score_ids = iter(allocate_ids(connection, scores, len(new_scores)))
+
+    inserts = { teams: [], players: [], scores: [] }
+    updates = { teams: [], players: [], scores: [] }
+
+    for team, points in zip(game['teams'], tally_points(game)):
+        team_id = team['id']
+        if team_id is None:
+            team_id = next(team_ids)
+            inserts[teams].append({ 'id': team_id, 'game_id': game_id,
+                'name': team['name'], 'points': points })
+        elif old_teams[team_id] != (team['name'], points):
+            updates[teams].append({ 'target': team_id,
+                'new_name': team['name'], 'new_points': points })
+
+        for player in team['players']:
+            player_id = player['id']
+            if player_id is None:
+                player_id = next(player_ids)
+                inserts[players].append({ 'id': player_id,
+                    'game_id': game_id, 'team_id': team_id,
+                    'position': player['position'],
+                    'user_id': player['user_id'] })
+            elif old_players[player_id] != (player['position'],
+                    player['user_id']):
+                updates[players].append({ 'target': player_id,
+                    'new_position': player['position'],
+                    'new_user_id': player['user_id'] })
+
+            for score in player['scores']:
+                if score['id'] is None:
+                    inserts[scores].append({ 'id': next(score_ids),
+                        'game_id': game_id, 'team_id': team_id,
+                        'player_id': player_id, 'time': score['time'],
+                        'own_goal': score['own_goal'] })
+                elif old_scores[score['id']] != (score['time'],
+                        score['own_goal']):
+                    updates[scores].append({ 'target': score['id'],
+                        'new_time': score['time'],
+                        'new_own_goal': score['own_goal'] })
+
+    for table in (teams, players, scores):
+        insert_rows(connection, table, inserts[table])
+
+    changed = [(teams, ('name', 'points')), (players, ('position', 'user_id')),
+        (scores, ('time', 'own_goal'))]
+    for table, columns in changed:
+        rows = updates[table]
+        if len(rows) > 0:
+            connection.execute(table.update()\
+                .where(table.c.id == bindparam('target'))\
+                .values(dict((column, bindparam('new_' + column))
+                    for column in columns)), rows)
+
+    return game_id
+
 # Create a game
 @app.route('/games', methods=['POST'])
 def create_game():
-    # Game is sent in as JSON
-    game = request.json
-    
-    g = Game()
+    # Game is sent in as JSON. Check it before building anything.
+    game, errors = check_game(request.json)
 
-    if 'start' not in game:
-        g.start = datetime.now()
-    else:
-        try:
-            g.start = parse(game.get('start'))
-        except ValueError:
-            return make_response('times must be in YYYY-MM-DDThh:mm:ss',\
-                '400', '')
+    # If not valid, return every problem found
+    if len(errors) > 0:
+        return make_response('\n'.join(errors), '400', '')
 
-    if game.get('end') is not None:
-        try:
-            g.end = parse(game.get('end'))
-        except ValueError:
-            make_response('times must be in YYYY-MM-DDThh:mm:ss', '400', '')
-
-    # Iterate through passed in structures. Update/Add as needed.
-    if 'teams' in game:
-        for team in game['teams']:
-            # New team.
-            t = Team()
-            g.teams.append(t)
-            
-            # Set values 
-            t.name = team.get('name')
-
-            if 'players' in team:
-                for player in team['players']:
-                    # New player.
-                    p = Player()
-                    g.players.append(p)
-                    t.players.append(p)
-                    
-                    # Set values
-                    p.position = player.get('position')
-                    u = player.get('user')
-                    if u is None or u.get('id') is None:
-                        return make_response('user does not exist', '400', '')
-                    p.user_id = u.get('id')
-
-                    if 'scores' in player:
-                        for score in player['scores']:
-                            # New score. 
-                            s = Score()
-                            g.scores.append(s)
-                            t.scores.append(s)
-                            p.scores.append(s)
-                            
-                            # Set values 
-                            try:
-                                s.time = parse(score.get('time'))
-                            except ValueError:
-                                make_response('times must be in YYYY-MM-DDThh:mm:ss', '400', '')
-                            s.own_goal = score.get('own_goal', False)
-
-    # Verify that resulting game is valid
-    valid_results = validate_game(g)
-
-    # If not valid, return the error
-    if (valid_results[0] is False):
-        return make_response(valid_results[1], '400', '')
-
-    db.session.add(g)
+    game_id = save_game(game)
+    apply_stats_batch(db.session.connection(), game_stats(game))
+    if finished_teams(game) is not None:
+        rate_game(db.session, game_id)
     db.session.commit()
 
+    g = load_game_graph(game_id)
     resp = jsonify(g.serialize)
     resp.status_code = 201
 
     return resp
 
-@app.route('/games/<int:game_id>', methods=['PUT'])
-def update_game(game_id):
-    # Get existing game.
-    g = db.session.query(Game).filter(Game.id == game_id).first()   
-
-    # Get passed in game object 
-    game = request.json 
+@app.route('/games/ingest', methods=['POST'])
+def ingest_games():
+    """Create games from NDJSON, one game per line, for backfills.
+
+    The body is read as it arrives and written a chunk of
+    INGEST_CHUNK_SIZE games at a time (see ingest.py), each chunk in its
+    own transaction. Lines that fail don't stop the rest; they are listed
+    with their errors in the response."""
+    summary = ingest(db.session, request.stream,
+            app.config['INGEST_CHUNK_SIZE'])
+
+    resp = jsonify( created=summary['created'],
+            failed=len(summary['errors']),
+            errors=[{ 'line': number, 'errors': errors }
+                for number, errors in summary['errors']] )
+    if len(summary['errors']) == 0:
+        resp.status_code = 201
+    elif summary['created'] == 0:
+        resp.status_code = 400
+    else:
+        resp.status_code = 207
+    return resp
 
-    if g is None:
-        return make_response('game does not exist', '404', '')
+@app.route('/games/<int:game_id>', methods=['PUT'])
+@with_game(*game_graph())
+def update_game(g):
+    # Work out what the game will look like once the passed in game object
+    # is applied, and check that before changing anything.
+    try:
+        game, errors = check_game(request.json, g)
+    except LookupError as e:
+        return make_response(e.args[0], '404', '')
+
+    # If not valid, return every problem found
+    if len(errors) > 0:
+        return make_response('\n'.join(errors), '400', '')
+
+    # Swap what the game contributed to its users' stats for what it will
+    before = describe_game(g)
+    game_id = save_game(game, g)
+    apply_stats_batch(db.session.connection(),
+            difference(game_stats(game), game_stats(before)))
+
+    # Rerate the game if its result changed
+    result = finished_teams(game)
+    if result != finished_teams(before):
+        unrate_game(db.session, game_id)
+        if result is not None:
+            rate_game(db.session, game_id)
 
-    if game.get('start') is not None:
-        try:
-            g.start = parse(game.get('start'))
-        except ValueError:
-            make_response('times must be in YYYY-MM-DDThh:mm:ss', '400', '')
+    db.session.commit()
+    game_cache.invalidate(game_id)
 
-    if game.get('end') is not None:
-        try:
-            g.end = parse(game.get('end'))
-        except ValueError:
-            make_response('times must be in YYYY-MM-DDThh:mm:ss', '400', '')
-
-    # Iterate through passed in structures. Update/Add as needed.
-    if 'teams' in game:
-        for team in game['teams']:
-            t = None
-            if team.get('id') is None:
-                # New team.
-                t = Team()
-                g.teams.append(t)
-            else:
-                # Existing team.
-                t = db.session.query(Team).filter(Team.id == team.get('id'))\
-                    .filter(Team.game_id == g.id).first()
-                if t is None:
-                    return make_response('team does not exist', '404', '')
-            # Set values 
-            t.name = team.get('name')
-
-            if 'players' in team:
-                for player in team['players']:
-                    p = None
-                    if player.get('id') is None:
-                        # New player.
-                        p = Player()
-                        g.players.append(p)
-                        t.players.append(p)
-                    else:
-                        # Existing player.
-                        p = db.session.query(Player).filter(Player.id == player.get('id'))\
-                            .filter(Player.team_id == t.id)\
-                            .filter(Player.game_id == g.id).first()
-                        if p is None:
-                            return make_response('player does not exist', '404', '')
-                    # Set values
-                    p.position = player.get('position')
-                    u = player.get('user')
-                    if u is None or u.get('id') is None:
-                        return make_response('user does not exist', '400', '')
-                    p.user_id = u.get('id')
-
-                    if 'scores' in player:
-                        for score in player['scores']:
-                            s = None
-                            if score.get('id') is None:
-                                # New score. 
-                                s = Score()
-                                g.scores.append(s)
-                                t.scores.append(s)
-                                p.scores.append(s)
-                            else: 
-                                # Existing score.
-                                s = db.session.query(Score).filter(Score.id == score.get('id'))\
-                                    .filter(Score.player_id == p.id)\
-                                    .filter(Score.team_id == t.id)\
-                                    .filter(Score.game_id == g.id).first()
-                                if s is None:
-                                    return make_response('score does not exist', '404', '')
-                            # Set values 
-                            try:
-                                s.time = parse(score.get('time'))
-                            except ValueError:
-                                make_response('times must be in YYYY-MM-DDThh:mm:ss', '400', '')
-                            s.own_goal = score.get('own_goal', False)
-
-    # Verify that resulting game is valid
-    valid_results = validate_game(g)
-
-    # If not valid, return the error
-    if (valid_results[0] is False):
-        return make_response(valid_results[1], '400', '')
+    g = load_game_graph(game_id)
+    game_json = g.serialize
+    game_events.publish(game_id, 'update', game_json)
+    if result is not None and finished_teams(before) is None:
+        publish_end(game_id, dict((team.id, team.points) for team in g.teams))
 
-    db.session.commit()
-    resp = jsonify(g.serialize)
+    resp = jsonify(game_json)
     resp.status_code = 200
     return resp
 
 # Delete a game
 @app.route('/games/<int:game_id>', methods=['DELETE'])
-def delete_game(game_id):
-    games = db.session.query(Game)\
-            .filter(Game.id == game_id)
+@with_game()
+def delete_game(g):
+    game_id = g.id
+    # A statement per table, taking back the game's stats and ratings,
+    # rather than the ORM cascades deleting a row at a time
+    delete_games(db.session.connection(), [game_id])
+    db.session.commit()
+    game_cache.invalidate(game_id)
+    game_events.publish(game_id, 'delete', { 'id': game_id })
 
-    if games.count() != 1:
-        return make_response('game does not exist', '404', '')
+    return make_response('', 204, None)
 
-    g = games.first()
+@app.route('/games', methods=['DELETE'])
+def purge_games():
+    """Delete every game started in a range, given by started_after
+    (inclusive) and started_before (exclusive) as for GET /games. At least
+    one of them is required. Games are deleted PURGE_BATCH_SIZE at a time,
+    each batch in its own transaction (see purge.py)."""
+    limits = {}
+    for name in ('started_after', 'started_before'):
+        if name in request.values:
+            try:
+                limits[name] = parse(request.values[name])
+            except ValueError:
+                return make_response('Bad date format. Should be '
+                        'YYYY-MM-DDThh:mm:ss.', '400', '')
+    if len(limits) == 0:
+        return make_response('started_after or started_before is required',
+                '400', '')
 
-    db.session.delete(g)
-    db.session.commit()
+    def deleted(game_ids):
+        for game_id in game_ids:
+            game_cache.invalidate(game_id)
+            game_events.publish(game_id, 'delete', { 'id': game_id })
 
-    return make_response('', 204, None)
+    count = purge(db.session, batch_size=app.config['PURGE_BATCH_SIZE'],
+            progress=deleted, **limits)
+    return jsonify( deleted=count )
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request metrics in the Prometheus text format (see metrics.py)"""
+    return Response(metrics.render(),
+            mimetype='text/plain; version=0.0.4')
+
 @app.route("/static/<path:path>", methods=['GET'])
 def serve_static(path):
     return app.send_static_file(os.path.join('static', path))
 
+def lock_game(game_id):
+    """Lock a game's row until the end of the transaction, so that writers
+    to the same game take turns. SQLite only lets one writer in at a time
+    anyway, so there this does nothing."""
+    if db.session.connection().dialect.name != 'sqlite':
+        games = Game.__table__
+        db.session.execute(select([games.c.id])\
+                .where(games.c.id == game_id).with_for_update())
+
+def award_points(game_id, team_id, points):
+    """Add points to a team's running total in the current transaction.
+
+    This is a conditional UPDATE, so two goals posted at the same time can't
+    both slip past the 10 point limit. The game row is locked first: goals
+    for opposite teams update different rows, and under READ COMMITTED
+    neither would otherwise wait for the other, letting a game end 10-10.
+    Returns False, without changing anything, if the team would go over 10
+    or either team already has 10."""
+    lock_game(game_id)
+    teams = Team.__table__
+    finished = Team.__table__.alias()
+
+    result = db.session.execute(teams.update()\
+            .where(teams.c.id == team_id)\
+            .where(teams.c.game_id == game_id)\
+            .where(teams.c.points + points <= 10)\
+            .where(~exists().where(finished.c.game_id == game_id)\
+                .where(finished.c.points >= 10))\
+            .values(points=teams.c.points + points))
+
+    return result.rowcount == 1
+
 def can_team_score(team):
     """Check whether a team is allowed to score again"""
     # Check that team doesn't already have 10 points
-    teams = team.game.teams 
-
-    curr_score = len(filter(lambda x: x.own_goal is False, team.scores))
-
-    if len(teams) == 2:
-        other_team = None
-        if teams[0].id == team.id:
-            other_team = teams[1]
-        else:
-            other_team = teams[0]
-        curr_score += len(filter(lambda x: x.own_goal is True, other_team.scores))
-
-    if curr_score >= 10:
-        return False 
-
-    return True
-
-def validate_game(game):
-    if len(game.teams) > 2:
-        return (False, 'too many teams')
-
-    total_scores = [0, 0]
-
-    for team in game.teams:
-        if len(team.players) > 4:
-            return (False, 'too many players on team')
-
-        if len(filter(lambda x: x.name == team.name, game.teams)) > 1:
-            return (False, 'each team must have a different name')
-
-        # Use this to keep track of the total scores... Kind of stupid and ugly.
-        team_index = game.teams.index(team)
-
-        position_counts = { 1: 0, 2: 0, 3: 0, 4: 0 }
-        for player in team.players:
-            user_count = db.session.query(User).filter(User.id == player.user_id).count()
-            if user_count == 0:
-                return (False, 'user does not exist')
-            if player.position is None or player.position < 1 or player.position > 4:
-                return (False, 'player must be in position 1-4')
-            position_counts[player.position] = position_counts[player.position] + 1 
-
-            for score in player.scores:
-                if score.own_goal is False:
-                    total_scores[team_index] = total_scores[team_index] + 1 
-                else:
-                    total_scores[team_index-1] = total_scores[team_index-1] + 1 
-
-        for key, val in position_counts.iteritems():
-            if val > 1:
-                return (False, 'more than one player in the same position')
-
-    if None in [score.time for score in game.scores]:
-        return (False, 'every score must have a time')
-
-    if total_scores[0] > 10 or total_scores[1] > 10:
-        return (False, 'each team can have a max of 10 points')
-
-    # Verify that same user isn't on each team
-    if len(game.teams) == 2:
-        team1_users = set()
-        for player in game.teams[0].players:
-            team1_users.add(player.user_id)
-        for player in game.teams[1].players:
-            if player.user_id in team1_users:
-                return (False, 'each user can only be on a single team')
-
-    return (True, None)
-
+    return max([t.points for t in team.game.teams]) < 10
 
 def is_game_over(game):
     """Check whether a game is over."""
@@ -646,17 +1479,9 @@ def is_game_over(game):
     if game.end is not None:
         return True 
 
-    # Check whether either team has 10 scores
-    if len(game.teams) == 2:
-        team1_scores = len(filter(lambda x: x.own_goal is False, game.teams[0].scores)) +\
-            len(filter(lambda x: x.own_goal is True, game.teams[1].scores))
-        team2_scores = len(filter(lambda x: x.own_goal is False, game.teams[1].scores)) +\
-            len(filter(lambda x: x.own_goal is True, game.teams[0].scores))
-
-        if team1_scores == 10 or team2_scores == 10:
-            return True 
-
-    return False
+    # Check whether either team has 10 points
+    return max([team.points for team in game.teams] or [0]) >= 10
 
 if __name__ == '__main__':
-    app.run(host='127.0.0.1')
+    # Event streams hold their request open, so serve each on a thread
+    app.run(host='127.0.0.1', threaded=True)
@@ -1,25 +1,134 @@
 import os
 import api
+import config
 import unittest
 import tempfile
 import json
 from datetime import datetime 
+from sqlalchemy import event
+
+class QueryCounter(object):
+	"""Count the SQL statements executed inside a with block"""
+
+	def __init__(self):
+		self.count = 0
+
+	def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+		self.count += 1
+
+	def __enter__(self):
+		self.engine = api.db.engine
+		event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+		return self
+
+	def __exit__(self, *exc):
+		event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+# The most SQL statements a request to each endpoint may run, whatever the
+# size of the database. test_statement_budgets runs every endpoint with one
+# game and again with 100, so a view that goes back to loading rows one at a
+# time goes over.
+STATEMENT_BUDGETS = {
+	'get_games': 7,
+	'get_users': 1,
+	'create_user': 3,
+	'get_user': 1,
+	'put_user': 4,
+	'delete_user': 5,
+	'get_user_stats': 2,
+	'get_leaderboard': 1,
+	'get_ratings': 1,
+	'get_game': 5,
+	'get_players': 1,
+	'get_scores': 1,
+	'make_score': 8,
+	'make_scores': 15,
+	'get_teams': 1,
+	'create_game': 17,
+	'ingest_games': 15,
+	'update_game': 11,
+	'delete_game': 16,
+	'purge_games': 17,
+	'get_metrics': 0
+}
+# Endpoints that run no budgeted request: the event stream stays open
+# until the client goes, and static files don't touch the database
+UNBUDGETED = set(['game_event_stream', 'serve_static', 'static'])
 
 class ApiTestCase(unittest.TestCase):
 
 	def setUp(self):
 		"""Run before every test case"""
+		# Nothing in a test database needs to survive a crash
+		api.app.config.update(config.profile('testing'))
 		self.db_fd, api.app.config['DATABASE_PATH'] = tempfile.mkstemp()
 		api.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + api.app.config['DATABASE_PATH']
 		api.app.config['TESTING'] = True
+		api.game_cache.clear()
+		api.metrics.clear()
 		self.app = api.app.test_client()
 		api.init_db()
 
 	def tearDown(self):
 		"""Run after every test case"""
+		api.db.session.remove()
 		os.close(self.db_fd)
 		os.unlink(api.app.config['DATABASE_PATH'])
 
+	def within_budget(self, method, path, data=None,
+			content_type='application/json'):
+		"""Send a request, checking that it succeeds within its endpoint's
+		statement budget. Returns the response and the statements run."""
+		endpoint = api.app.url_map.bind('localhost').match(
+			path.split('?')[0], method)[0]
+		with QueryCounter() as counter:
+			resp = self.app.open(path, method=method, data=data,
+				content_type=content_type)
+			# Streamed bodies run their queries as they are read
+			body = resp.data
+		assert resp.status_code < 400, (method, path, resp.status_code, body)
+		assert counter.count <= STATEMENT_BUDGETS[endpoint], \
+			'%s %s ran %s statements, over the %s budget of %s' % (method,
+				path, counter.count, endpoint, STATEMENT_BUDGETS[endpoint])
+		return resp, counter.count
+
+	def create_users(self, count):
+		"""Create count users and return their ids"""
+		user_ids = []
+		for i in range(count):
+			user_json = json.dumps({
+				'name': 'user%s' % (i,)
+			})
+			resp = self.app.post('/users', content_type='application/json', data=user_json)
+			assert resp.status_code == 201 
+			user_ids.append(json.loads(resp.data)['id'])
+		return user_ids
+
+	def create_game(self, user_ids, start='2015-05-01 18:11:10'):
+		"""Create a red vs blue game with two players a side and return it"""
+		game_json = json.dumps({
+			'start': start,
+			'teams': [
+				{ 
+					'name': 'red',
+					'players': [
+				 	{ 'user': { 'id': user_ids[0] },
+				 	  'position': 1 },
+				 	{ 'user': { 'id': user_ids[1] },
+				 	  'position': 2 }]},
+				{ 
+					'name': 'blue',
+					'players': [
+				 	{ 'user': { 'id': user_ids[2] },
+				 	  'position': 1 },
+				 	{ 'user': { 'id': user_ids[3] },
+				 	  'position': 2 }]}
+				 ]
+		})
+		resp = self.app.post('/games', content_type='application/json', data=game_json)
+		assert resp.status_code == 201
+		return json.loads(resp.data)
+
 	def test_empty_db(self):
 		"""Check resource responses from an empty database"""
 		# Get games
@@ -337,7 +446,9 @@ class ApiTestCase(unittest.TestCase):
 		})
 		resp = self.app.post('/games', content_type='application/json', data=game_json)
 		assert resp.status_code == 400
-		assert resp.data == 'too many players on team'
+		# Every problem with the game is reported at once
+		assert resp.data.split('\n') == ['too many players on team',
+			'more than one player in the same position']
 
 		# Create a game with position less than 1
 		game_json = json.dumps({
@@ -801,6 +912,1230 @@ class ApiTestCase(unittest.TestCase):
 		resp = self.app.post('/games', content_type='application/json', data=game_json)
 		assert resp.status_code == 201
 
+	def test_games_query_count(self):
+		"""Listing games costs the same number of queries for any page size"""
+
+		# Add users 
+		user_ids = []
+		for i in range(8):
+			user_json = json.dumps({
+				'name': 'user%s' % (i,)
+			})
+			resp = self.app.post('/users', content_type='application/json', data=user_json)
+			assert resp.status_code == 201 
+			u = json.loads(resp.data)
+			user_ids.append(u['id'])
+
+		game_json = json.dumps({
+			'start': '2015-05-01 18:11:10',
+			'teams': [
+				{ 
+					'name': 'red',
+					'players': [
+				 	{ 'user': { 'id': user_ids[0] },
+				 	  'position': 1,
+				 	  'scores': [
+				 	   	{ 'time': '2015-05-01T18:11:12'}]},
+				 	{ 'user': { 'id': user_ids[1] },
+				 	  'position': 2 }]},
+				{ 
+					'name': 'blue',
+					'players': [
+				 	{ 'user': { 'id': user_ids[4] },
+				 	  'position': 1,
+				 	  'scores': [
+				 	  	{ 'time': '2015-05-01T18:11:16'}] },
+				 	{ 'user': { 'id': user_ids[5] },
+				 	  'position': 2 }]}
+				 ]
+		})
+
+		resp = self.app.post('/games', content_type='application/json', data=game_json)
+		assert resp.status_code == 201
+
+		with QueryCounter() as single:
+			resp = self.app.get('/games')
+		assert len(json.loads(resp.data)) == 1
+
+		for i in range(5):
+			resp = self.app.post('/games', content_type='application/json', data=game_json)
+			assert resp.status_code == 201
+
+		with QueryCounter() as many:
+			resp = self.app.get('/games')
+		games = json.loads(resp.data)
+		assert len(games) == 6
+		assert games[5]['teams'][0]['players'][0]['user']['name'] == 'user0'
+		assert len(games[5]['teams'][1]['players'][0]['scores']) == 1
+		assert many.count == single.count
+
+	def test_own_goal_points(self):
+		"""Own goals count towards the other team's 10 points"""
+		game = self.create_game(self.create_users(4))
+		blue_player = game['teams'][1]['players'][0]['id']
+		red_player = game['teams'][0]['players'][0]['id']
+
+		# Blue gifts red nine points
+		for i in range(9):
+			resp = self.app.post('/games/%s/score' % (game['id'],),
+				content_type='application/json',
+				data=json.dumps({ 'player_id': blue_player, 'own_goal': True }))
+			assert resp.status_code == 201
+
+		teams = api.db.session.query(api.Team.id, api.Team.points)\
+			.order_by(api.Team.id).all()
+		assert [team.points for team in teams] == [9, 0]
+
+		# Red's tenth point ends the game
+		resp = self.app.post('/games/%s/score' % (game['id'],),
+			content_type='application/json',
+			data=json.dumps({ 'player_id': red_player }))
+		assert resp.status_code == 201
+
+		resp = self.app.post('/games/%s/score' % (game['id'],),
+			content_type='application/json',
+			data=json.dumps({ 'player_id': blue_player }))
+		assert resp.status_code == 400
+		assert resp.data == 'team already has 10 points'
+
+		# The conditional update refuses an 11th point even if the read check
+		# is skipped
+		assert api.award_points(game['id'], teams[0].id, 1) is False
+		assert api.award_points(game['id'], teams[1].id, 1) is False
+		api.db.session.rollback()
+
+	def test_cursor_paging(self):
+		"""Walk users with keyset paging, including a nullable sort key"""
+		birthdays = ['1985-04-03', None, '1980-01-01', None, '1985-04-03']
+		for i, birthday in enumerate(birthdays):
+			resp = self.app.post('/users', content_type='application/json',
+				data=json.dumps({ 'name': 'user%s' % (i,), 'birthday': birthday }))
+			assert resp.status_code == 201
+
+		for params in ['sort_by=id', 'sort_by=name&order=-1',
+				'sort_by=birthday', 'sort_by=birthday&order=-1']:
+			expected = [u['name'] for u in json.loads(
+				self.app.get('/users?per_page=50&' + params).data)]
+
+			names = []
+			cursor = ''
+			while cursor is not None:
+				resp = self.app.get('/users?per_page=2&%s&cursor=%s' % (params, cursor))
+				assert resp.status_code == 200
+				page = json.loads(resp.data)
+				assert len(page) <= 2
+				names.extend([u['name'] for u in page])
+				cursor = resp.headers.get('X-Next-Cursor')
+
+			assert names == expected
+			assert len(names) == 5
+
+		# Offset paging still works alongside
+		resp = self.app.get('/users?sort_by=id&page=2&per_page=2')
+		assert [u['name'] for u in json.loads(resp.data)] == ['user2', 'user3']
+		assert 'X-Next-Cursor' not in resp.headers
+		# and sorts by id unless told otherwise
+		assert self.app.get('/users?page=2&per_page=2').data == resp.data
+
+		resp = self.app.get('/users?cursor=garbage')
+		assert resp.status_code == 400
+		assert resp.data == 'cursor is not valid'
+
+		# Well formed cursors whose values don't fit the sort column
+		from base64 import urlsafe_b64encode
+		for url, position in [('/games?', [[1], 1]), ('/users?', [[1], 1]),
+				('/users?', [1, '1']), ('/users?', [True, 1]),
+				('/users?sort_by=name&', [5, 1]), ('/users?sort_by=birthday&', [{}, 1]),
+				('/users?sort_by=rating&', ['high', 1])]:
+			cursor = urlsafe_b64encode(json.dumps(position)).rstrip('=')
+			resp = self.app.get('%scursor=%s' % (url, cursor))
+			assert resp.status_code == 400, (url, position)
+			assert resp.data == 'cursor is not valid'
+
+	def test_game_context_single_lookup(self):
+		"""Sub-resource handlers load their game with a single query"""
+		game = self.create_game(self.create_users(4))
+
+		for resource in ['players', 'scores', 'teams']:
+			with QueryCounter() as counter:
+				resp = self.app.get('/games/%s/%s' % (game['id'], resource))
+			assert resp.status_code == 200
+			assert counter.count == 1
+
+			with QueryCounter() as counter:
+				resp = self.app.get('/games/%s/%s' % (game['id'] + 1, resource))
+			assert resp.status_code == 404
+			assert counter.count == 1
+
+		resp = self.app.get('/games/%s/teams' % (game['id'],))
+		teams = json.loads(resp.data)['teams']
+		assert [p['name'] for p in teams[0]['players']] == ['user0', 'user1']
+
+		resp = self.app.put('/users/1000', content_type='application/json',
+			data=json.dumps({ 'name': 'nobody' }))
+		assert resp.status_code == 404
+		assert resp.data == 'user does not exist'
+
+	def test_game_validation_before_orm(self):
+		"""Bad games are rejected with one user lookup and no writes"""
+		user_ids = self.create_users(4)
+		game_json = json.dumps({
+			'start': 'not a time',
+			'teams': [
+				{ 
+					'name': 'red',
+					'players': [
+				 	{ 'user': { 'id': user_ids[0] },
+				 	  'position': 1,
+				 	  'scores': [ { 'own_goal': False } ] },
+				 	{ 'user': { 'id': 1000 },
+				 	  'position': 2 }]},
+				{ 
+					'name': 'red',
+					'players': [
+				 	{ 'user': { 'id': user_ids[2] },
+				 	  'position': 7 }]}
+				 ]
+		})
+
+		with QueryCounter() as counter:
+			resp = self.app.post('/games', content_type='application/json', data=game_json)
+		assert resp.status_code == 400
+		assert resp.data.split('\n') == [
+			'times must be in YYYY-MM-DDThh:mm:ss',
+			'each team must have a different name',
+			'user does not exist',
+			'player must be in position 1-4',
+			'every score must have a time']
+		assert counter.count == 1
+		assert len(json.loads(self.app.get('/games').data)) == 0
+
+		game = self.create_game(user_ids)
+		game['teams'][0]['players'][0]['id'] = 1000
+		resp = self.app.put('/games/%s' % (game['id'],),
+			content_type='application/json', data=json.dumps(game))
+		assert resp.status_code == 404
+		assert resp.data == 'player does not exist'
+
+		# Payloads in the wrong shape, and ids that aren't numbers
+		def team(player):
+			return { 'name': 'red', 'players': [player] }
+		player = { 'user': { 'id': user_ids[0] }, 'position': 1 }
+		for payload, error in [
+				(None, 'game must be an object'),
+				([1], 'game must be an object'),
+				({ 'teams': 'red' }, 'teams must be a list of objects'),
+				({ 'teams': [team(5)] }, 'players must be a list of objects'),
+				({ 'teams': [team(dict(player, user=5))] },
+					'user must be an object'),
+				({ 'teams': [team(dict(player, user={ 'id': True }))] },
+					'user does not exist'),
+				({ 'teams': [team(dict(player, user={ 'id': [1] }))] },
+					'user does not exist'),
+				({ 'teams': [team(dict(player, scores=[{
+					'time': '2015-05-01T18:00:00', 'own_goal': 'yes' }]))] },
+					'own_goal must be true or false'),
+				({ 'teams': [dict(team(player), id=True)] }, 'ids must be whole numbers'),
+				({ 'teams': [dict(team(player), name=['red'])] },
+					'each team must have a name')]:
+			for method, url in [(self.app.post, '/games'),
+					(self.app.put, '/games/%s' % (game['id'],))]:
+				resp = method(url, content_type='application/json',
+					data=json.dumps(payload))
+				assert resp.status_code == 400
+				assert error in resp.data.split('\n')
+
+		resp = self.app.post('/games/ingest', content_type='application/x-ndjson',
+			data='\n'.join(json.dumps(payload) for payload in [
+				{ 'teams': 'red' },
+				{ 'teams': [team(dict(player, user={ 'id': True }))] }]))
+		assert resp.status_code == 400
+		assert [line['errors'] for line in json.loads(resp.data)['errors']] == [
+			['teams must be a list of objects'], ['user does not exist']]
+
+	def test_streamed_listing(self):
+		"""Streamed listings match the buffered ones byte for byte"""
+		user_ids = self.create_users(4)
+		for i in range(5):
+			self.create_game(user_ids, start='2015-05-0%s 18:11:10' % (i + 1,))
+		api.app.config['STREAM_CHUNK_SIZE'] = 2
+		try:
+			for url in ['/games?per_page=4&cursor=', '/games?sort_by=start&order=-1',
+					'/users?per_page=3&cursor=', '/games?user_id=%s' % (user_ids[0],)]:
+				buffered = self.app.get(url)
+				streamed = self.app.get(url + '&stream=1')
+				assert streamed.status_code == 200
+				assert streamed.data == buffered.data
+				assert streamed.headers.get('X-Next-Cursor') == \
+					buffered.headers.get('X-Next-Cursor')
+
+			# Large pages stream without asking
+			api.app.config['STREAM_PAGE_SIZE'] = 3
+			resp = self.app.get('/games?per_page=10', buffered=False)
+			assert resp.is_streamed
+			assert len(json.loads(resp.get_data())) == 5
+		finally:
+			api.app.config['STREAM_PAGE_SIZE'] = 500
+			api.app.config['STREAM_CHUNK_SIZE'] = 100
+
+	def test_listing_encoding(self):
+		"""Listings encode exactly as json.dumps of the serialize dicts"""
+		resp = self.app.post('/users', content_type='application/json',
+			data=json.dumps({ 'name': u'J\xf6rg "the wall"', 'birthday': '1985-04-03',
+				'email': None }))
+		assert resp.status_code == 201
+		user_ids = self.create_users(4)
+		game = self.create_game(user_ids)
+		resp = self.app.post('/games/%s/score' % (game['id'],),
+			content_type='application/json',
+			data=json.dumps({ 'player_id': game['teams'][0]['players'][0]['id'],
+				'own_goal': True, 'time': '2015-05-01T18:11:12' }))
+		assert resp.status_code == 201
+
+		with api.app.app_context():
+			users = api.db.session.query(api.User).order_by(api.User.id).all()
+			expected_users = api.json.dumps([user.serialize for user in users])
+			games = api.db.session.query(api.Game).order_by(api.Game.id).all()
+			expected_games = api.json.dumps([g.serialize for g in games])
+
+		assert self.app.get('/users?sort_by=id').data == expected_users
+		assert self.app.get('/games?sort_by=id').data == expected_games
+
+	def test_conditional_get(self):
+		"""Unchanged games and users answer If-None-Match with a 304"""
+		user_ids = self.create_users(4)
+		game = self.create_game(user_ids)
+		url = '/games/%s' % (game['id'],)
+
+		resp = self.app.get(url)
+		etag = resp.headers['ETag']
+		assert resp.headers.get('Last-Modified') is not None
+
+		with QueryCounter() as counter:
+			resp = self.app.get(url, headers={ 'If-None-Match': etag })
+		assert resp.status_code == 304
+		assert counter.count == 1
+
+		resp = self.app.get(url + '/scores', headers={ 'If-None-Match': etag })
+		assert resp.status_code == 304
+
+		# A goal changes the game
+		resp = self.app.post(url + '/score', content_type='application/json',
+			data=json.dumps({ 'player_id': game['teams'][0]['players'][0]['id'] }))
+		assert resp.status_code == 201
+		resp = self.app.get(url, headers={ 'If-None-Match': etag })
+		assert resp.status_code == 200
+		etag = resp.headers['ETag']
+
+		# So does renaming one of its players
+		user_url = '/users/%s' % (user_ids[0],)
+		user_etag = self.app.get(user_url).headers['ETag']
+		resp = self.app.put(user_url, content_type='application/json',
+			data=json.dumps({ 'name': 'renamed' }))
+		assert resp.status_code == 204
+		assert self.app.get(user_url, headers={ 'If-None-Match': user_etag })\
+			.status_code == 200
+		resp = self.app.get(url, headers={ 'If-None-Match': etag })
+		assert resp.status_code == 200
+		assert json.loads(resp.data)['teams'][0]['players'][0]['user']['name'] == 'renamed'
+
+		# Other games are left alone
+		other = self.create_game(user_ids[1:] + user_ids[:1])
+		other_url = '/games/%s' % (other['id'],)
+		other_etag = self.app.get(other_url).headers['ETag']
+		self.app.post(url + '/score', content_type='application/json',
+			data=json.dumps({ 'player_id': game['teams'][0]['players'][0]['id'] }))
+		assert self.app.get(other_url, headers={ 'If-None-Match': other_etag })\
+			.status_code == 304
+
+	def test_finished_game_cache(self):
+		"""Finished games are served from the response cache"""
+		user_ids = self.create_users(4)
+		live = self.create_game(user_ids)
+		game = self.create_game(user_ids)
+		url = '/games/%s' % (game['id'],)
+		for i in range(10):
+			resp = self.app.post(url + '/score', content_type='application/json',
+				data=json.dumps({ 'player_id': game['teams'][0]['players'][0]['id'] }))
+			assert resp.status_code == 201
+
+		first = self.app.get('/games?sort_by=id')
+		detail = self.app.get(url)
+		with QueryCounter() as counter:
+			assert self.app.get('/games?sort_by=id').data == first.data
+			assert self.app.get(url).data == detail.data
+		stats = api.game_cache.stats()
+		assert stats['hits'] == 2
+		assert stats['size'] == 2
+		# The listing still loads the live game, the detail is one lookup
+		assert counter.count == 4 + 1 + 1
+
+		# Updating the game drops it from the cache
+		finished = json.loads(detail.data)
+		finished['end'] = '2015-05-01 18:20:00'
+		resp = self.app.put(url, content_type='application/json',
+			data=json.dumps(finished))
+		assert resp.status_code == 200
+		assert api.game_cache.stats()['size'] == 0
+		assert json.loads(self.app.get(url).data)['end'] == '05/01/2015 18:20:00'
+
+		# The cache is bounded
+		api.game_cache.capacity = 1
+		self.app.get('/games?sort_by=id')
+		assert api.game_cache.stats()['evictions'] == 1
+		api.game_cache.capacity = api.app.config['GAME_CACHE_SIZE']
+
+		resp = self.app.delete(url)
+		assert resp.status_code == 204
+		assert self.app.get(url).status_code == 404
+
+	def user_stats(self, user_ids):
+		"""Each user's stats from GET /users/<id>/stats"""
+		stats = []
+		for user_id in user_ids:
+			resp = self.app.get('/users/%s/stats' % (user_id,))
+			assert resp.status_code == 200
+			stats.append(json.loads(resp.data))
+		return stats
+
+	def test_user_stats_first_row_race(self):
+		"""A first stats row another request inserts first is added to"""
+		import stats
+		user_ids = self.create_users(1)
+		table = api.UserStats.__table__
+
+		def insert_first(conn, cursor, statement, parameters, context, executemany):
+			# The other request's row lands between the UPDATE and the INSERT
+			if statement.startswith('UPDATE user_stats') and cursor.rowcount == 0:
+				event.remove(api.db.engine, 'after_cursor_execute', insert_first)
+				row = dict.fromkeys(stats.FIELDS, 0)
+				row.update(user_id=user_ids[0], goals=2, games_played=1)
+				conn.execute(table.insert().values(row))
+
+		event.listen(api.db.engine, 'after_cursor_execute', insert_first)
+		try:
+			stats.apply_stats(api.db.session,
+				{ user_ids[0]: { 'goals': 1, 'games_played': 1 } })
+			api.db.session.commit()
+		finally:
+			if event.contains(api.db.engine, 'after_cursor_execute', insert_first):
+				event.remove(api.db.engine, 'after_cursor_execute', insert_first)
+
+		totals = self.user_stats(user_ids)[0]
+		assert totals['goals'] == 3 and totals['games_played'] == 2
+
+	def test_user_stats(self):
+		"""Stats and the leaderboard follow goals, results and changes"""
+		user_ids = self.create_users(5)
+		game = self.create_game(user_ids)
+		url = '/games/%s' % (game['id'],)
+		red_player = game['teams'][0]['players'][0]['id']
+		blue_player = game['teams'][1]['players'][0]['id']
+
+		resp = self.app.post(url + '/score', content_type='application/json',
+			data=json.dumps({ 'player_id': blue_player, 'own_goal': True }))
+		assert resp.status_code == 201
+		for i in range(8):
+			resp = self.app.post(url + '/score', content_type='application/json',
+				data=json.dumps({ 'player_id': red_player }))
+			assert resp.status_code == 201
+
+		# Goals count straight away, results once the game is over
+		red, red2, blue, blue2, idle = self.user_stats(user_ids)
+		assert red['goals'] == 8 and red['games_played'] == 0
+		assert blue['own_goals'] == 1 and blue['losses'] == 0
+
+		resp = self.app.post(url + '/score', content_type='application/json',
+			data=json.dumps({ 'player_id': red_player }))
+		assert resp.status_code == 201
+
+		red, red2, blue, blue2, idle = self.user_stats(user_ids)
+		assert red == { 'user_id': user_ids[0], 'games_played': 1, 'wins': 1,
+			'losses': 0, 'goals': 9, 'own_goals': 0, 'goals_for': 10,
+			'goals_against': 0, 'goal_differential': 10 }
+		assert red2['wins'] == 1 and red2['goals'] == 0
+		assert blue['losses'] == 1 and blue['goal_differential'] == -10
+		assert idle['games_played'] == 0 and idle['user_id'] == user_ids[4]
+		assert self.app.get('/users/1000/stats').status_code == 404
+
+		resp = self.app.get('/leaderboard?per_page=3')
+		assert resp.status_code == 200
+		leaderboard = json.loads(resp.data)['leaderboard']
+		assert [entry['user_id'] for entry in leaderboard] == \
+			[user_ids[0], user_ids[1], user_ids[2]]
+		assert [entry['rank'] for entry in leaderboard] == [1, 2, 3]
+		assert leaderboard[0]['user']['name'] == 'user0'
+		resp = self.app.get('/leaderboard?page=2&per_page=3')
+		assert [entry['rank'] for entry in json.loads(resp.data)['leaderboard']] \
+			== [4]
+		assert self.app.get('/leaderboard?per_page=0').status_code == 400
+
+		# Turning the own goal into a goal for blue reopens the game at 9-1
+		full = json.loads(self.app.get(url).data)
+		full['teams'][1]['players'][0]['scores'][0]['own_goal'] = False
+		resp = self.app.put(url, content_type='application/json',
+			data=json.dumps(full))
+		assert resp.status_code == 200
+
+		red, red2, blue, blue2, idle = self.user_stats(user_ids)
+		assert red['goals'] == 9 and red['games_played'] == 0 \
+			and red['wins'] == 0 and red['goals_for'] == 0
+		assert blue['goals'] == 1 and blue['own_goals'] == 0 \
+			and blue['losses'] == 0
+
+		# Ending it by hand counts the result again
+		full['end'] = '2015-05-01 18:20:00'
+		resp = self.app.put(url, content_type='application/json',
+			data=json.dumps(full))
+		assert resp.status_code == 200
+		incremental = self.user_stats(user_ids)
+		assert incremental[0]['goals_for'] == 9 and incremental[0]['wins'] == 1
+		assert incremental[2]['goals_against'] == 9
+
+		# A full rebuild agrees with the running totals
+		from stats import rebuild_stats
+		assert rebuild_stats(api.db.engine) == 4
+		assert self.user_stats(user_ids) == incremental
+
+		resp = self.app.delete(url)
+		assert resp.status_code == 204
+		for stats in self.user_stats(user_ids):
+			assert stats['games_played'] == stats['goals'] == stats['wins'] == 0
+
+	def test_ratings(self):
+		"""Ratings change when a game ends and can be replayed in bulk"""
+		import ratings
+		user_ids = self.create_users(5)
+		game = self.create_game(user_ids)
+		url = '/games/%s' % (game['id'],)
+		for i in range(10):
+			resp = self.app.post(url + '/score', content_type='application/json',
+				data=json.dumps({ 'player_id': game['teams'][0]['players'][0]['id'] }))
+			assert resp.status_code == 201
+
+		# Evenly matched, so the winners take half the K factor
+		users = [json.loads(self.app.get('/users/%s' % (i,)).data)
+			for i in user_ids]
+		assert [user['rating'] for user in users] == [1516, 1516, 1484, 1484, 1500]
+		# Ratings stay out of game payloads, which only change with the game
+		assert 'rating' not in json.loads(self.app.get(url).data)\
+			['teams'][0]['players'][0]['user']
+
+		# The losers win a game ended by hand
+		second = self.create_game(user_ids[2:4] + user_ids[0:2],
+			start='2015-05-02 18:11:10')
+		second_url = '/games/%s' % (second['id'],)
+		second['teams'][0]['players'][0]['scores'] = [
+			{ 'time': '2015-05-02 18:12:00', 'own_goal': False }]
+		second['end'] = '2015-05-02 18:20:00'
+		resp = self.app.put(second_url, content_type='application/json',
+			data=json.dumps(second))
+		assert resp.status_code == 200
+
+		resp = self.app.get('/ratings?per_page=2')
+		assert resp.status_code == 200
+		ranked = json.loads(resp.data)['ratings']
+		assert [entry['rank'] for entry in ranked] == [1, 2]
+		# The underdogs gain more than the favourites did
+		assert [entry['user_id'] for entry in ranked] == user_ids[2:4]
+		assert 1501 < ranked[0]['rating'] < 1502
+		incremental = dict((entry['user_id'], entry['rating'])
+			for entry in json.loads(self.app.get('/ratings').data)['ratings'])
+
+		# Replaying the history gives the same ratings
+		def close(ratings):
+			return all(abs(ratings.get(i, 1500) - incremental[i]) < 1e-9
+				for i in user_ids)
+		assert close(ratings.recompute_ratings(api.db.engine, write=False))
+		assert close(ratings.recompute_ratings(api.db.engine))
+		resp = self.app.get('/ratings')
+		assert close(dict((entry['user_id'], entry['rating'])
+			for entry in json.loads(resp.data)['ratings']))
+
+		# Deleting both games takes their changes back
+		assert self.app.delete(second_url).status_code == 204
+		assert self.app.delete(url).status_code == 204
+		for entry in json.loads(self.app.get('/ratings').data)['ratings']:
+			assert abs(entry['rating'] - 1500) < 1e-9
+
+	def test_bulk_create_users(self):
+		"""A batch of users is created in one go with a result per item"""
+		self.create_users(1)
+		batch = [
+			{ 'name': 'alice', 'first_name': 'Alice', 'birthday': '1985-04-03' },
+			{ 'name': 'user0' },
+			{ 'name': 'bob' },
+			{ 'name': 'alice' },
+			{ 'first_name': 'Nobody' },
+			{ 'name': 'carol', 'birthday': 'someday' }
+		]
+		with QueryCounter() as counter:
+			resp = self.app.post('/users', content_type='application/json',
+				data=json.dumps(batch))
+		assert resp.status_code == 207
+		# Duplicate check, insert, reading back the new users
+		assert counter.count == 3
+
+		results = json.loads(resp.data)['results']
+		assert [r['index'] for r in results] == list(range(6))
+		assert [r['status'] for r in results] == [201, 400, 201, 400, 400, 400]
+		assert results[0]['user']['first_name'] == 'Alice'
+		assert results[0]['user']['birthday'] == '04/03/1985'
+		assert results[2]['user']['name'] == 'bob'
+		assert [r.get('error') for r in results][1:] == [
+			'user already exists', None, 'user already exists',
+			'must include a name',
+			'birthday must be in format: YYYY-MM-DDThh:mm:ss']
+
+		resp = self.app.get('/users/%s' % (results[2]['user']['id'],))
+		assert json.loads(resp.data)['rating'] == 1500
+
+		# NDJSON, one user per line
+		lines = '{"name": "dave"}\n\n{"name": "erin"}\nnot json\n'
+		resp = self.app.post('/users', content_type='application/x-ndjson',
+			data=lines)
+		assert resp.status_code == 207
+		results = json.loads(resp.data)['results']
+		assert [r['status'] for r in results] == [201, 201, 400]
+		assert results[2]['error'] == 'not valid JSON'
+
+		# Names that aren't strings, and bodies that aren't UTF-8
+		resp = self.app.post('/users', content_type='application/json',
+			data=json.dumps([{ 'name': 5 }, { 'name': ['x'] },
+				{ 'name': 'gina', 'email': 7 }]))
+		assert resp.status_code == 400
+		assert [r['error'] for r in json.loads(resp.data)['results']] == [
+			'name must be a string', 'name must be a string',
+			'email must be a string']
+		resp = self.app.post('/users', content_type='application/json',
+			data=json.dumps({ 'name': 5 }))
+		assert resp.status_code == 400
+		resp = self.app.post('/users', content_type='application/x-ndjson',
+			data=b'{"name": "\xff"}\n')
+		assert resp.status_code == 400
+
+		resp = self.app.post('/users', content_type='application/json',
+			data=json.dumps([{ 'name': 'bob' }]))
+		assert resp.status_code == 400
+		resp = self.app.post('/users', content_type='application/json',
+			data=json.dumps([{ 'name': 'frank' }]))
+		assert resp.status_code == 201
+		assert len(json.loads(self.app.get('/users').data)) == 6
+
+		# Another writer takes a name before every insert of the batch
+		def take_name(conn, cursor, statement, parameters, context, executemany):
+			if statement.startswith('INSERT INTO users') and executemany:
+				cursor.execute("INSERT INTO users (name, rating, version) "
+					"VALUES ('gina', 1500, 1)")
+		event.listen(api.db.engine, 'before_cursor_execute', take_name)
+		try:
+			resp = self.app.post('/users', content_type='application/json',
+				data=json.dumps([{ 'name': 'gina' }, { 'name': 'hank' }]))
+		finally:
+			event.remove(api.db.engine, 'before_cursor_execute', take_name)
+		assert resp.status_code == 409
+		assert len(json.loads(self.app.get('/users').data)) == 6
+
+	def test_ingest_chunks_at_once(self):
+		"""Chunks written at the same time reserve different ids"""
+		import threading, time
+		from ingest import read_chunk, write_chunk
+		user_ids = self.create_users(4)
+		line = json.dumps({ 'start': '2015-05-01T18:00:00',
+			'teams': [{ 'name': name, 'players': [{ 'user': { 'id': user_id },
+				'position': 1 }] } for name, user_id in zip(('red', 'blue'), user_ids)] })
+		games, errors = read_chunk([(1, line), (2, line)])
+		assert len(games) == 2 and errors == {}
+
+		# The first chunk has reserved its ids but not committed when the
+		# second one starts
+		first = api.db.engine.connect()
+		transaction = first.begin()
+		first_ids = write_chunk(first, games)
+		second = {}
+		def write_second():
+			connection = api.db.engine.connect()
+			try:
+				with connection.begin():
+					second['ids'] = write_chunk(connection, games)
+			except Exception as e:
+				second['error'] = e
+			finally:
+				connection.close()
+		thread = threading.Thread(target=write_second)
+		thread.start()
+		time.sleep(0.2)
+		transaction.commit()
+		first.close()
+		thread.join()
+
+		assert 'error' not in second, second['error']
+		assert set(first_ids).isdisjoint(second['ids'])
+		assert len(json.loads(self.app.get('/games').data)) == 4
+
+	def test_ingest_games(self):
+		"""Games are loaded from NDJSON in chunks, with errors by line"""
+		import ratings, stats
+		user_ids = self.create_users(4)
+		exported = self.create_game(user_ids)
+
+		def game(scores, end=None):
+			players = [{ 'user': { 'id': user_id }, 'position': i % 2 + 1,
+				'scores': [] } for i, user_id in enumerate(user_ids)]
+			for i in range(scores):
+				players[0]['scores'].append({ 'time': '2015-05-01T18:%02d:00' % (i,) })
+			players[2]['scores'].append({ 'time': '2015-05-01 18:30:00',
+				'own_goal': True })
+			return json.dumps({ 'start': '2015-05-01T18:00:00', 'end': end,
+				'teams': [{ 'name': 'red', 'players': players[:2] },
+					{ 'name': 'blue', 'players': players[2:] }] })
+
+		bad_user = json.loads(game(0))
+		bad_user['teams'][0]['players'][0]['user']['id'] = 1000
+		lines = [game(9), game(2), 'not json', '', json.dumps(bad_user),
+			json.dumps(exported), game(3, end='2015-05-01T18:40:00')]
+		api.app.config['INGEST_CHUNK_SIZE'] = 2
+		try:
+			resp = self.app.post('/games/ingest',
+				content_type='application/x-ndjson', data='\n'.join(lines))
+		finally:
+			api.app.config['INGEST_CHUNK_SIZE'] = 500
+		assert resp.status_code == 207
+
+		summary = json.loads(resp.data)
+		assert summary['created'] == 4
+		assert summary['failed'] == 2
+		assert summary['errors'] == [
+			{ 'line': 3, 'errors': ['not valid JSON'] },
+			{ 'line': 5, 'errors': ['user does not exist'] }]
+
+		games = json.loads(self.app.get('/games?sort_by=id').data)
+		assert len(games) == 5
+		assert games[1]['teams'][0]['players'][0]['scores'][8]['time'] == \
+			'05/01/2015 18:08:00'
+		assert [len(g['teams'][1]['players'][0]['scores']) for g in games] \
+			== [0, 1, 1, 0, 1]
+		teams = api.db.session.query(api.Team.points)\
+			.order_by(api.Team.id).all()
+		assert [team.points for team in teams] == \
+			[0, 0, 10, 0, 3, 0, 0, 0, 4, 0]
+
+		# Stats and ratings are the same as replaying everything
+		incremental = self.user_stats(user_ids)
+		assert incremental[0]['goals'] == 14 and incremental[0]['wins'] == 2
+		ratings_now = [json.loads(self.app.get('/users/%s' % (i,)).data)
+			['rating'] for i in user_ids]
+		assert ratings_now[0] > 1500
+		stats.rebuild_stats(api.db.engine)
+		assert self.user_stats(user_ids) == incremental
+		replayed = ratings.recompute_ratings(api.db.engine, write=False)
+		assert all(abs(replayed[i] - r) < 1e-9
+			for i, r in zip(user_ids, ratings_now))
+
+	def test_score_batch(self):
+		"""Buffered goals are posted as one array, all or nothing"""
+		user_ids = self.create_users(4)
+		game = self.create_game(user_ids)
+		red = game['teams'][0]['players'][0]['id']
+		blue = game['teams'][1]['players'][0]['id']
+
+		def post(scores):
+			return self.app.post('/games/%s/scores' % (game['id'],),
+				content_type='application/json', data=json.dumps(scores))
+
+		def points():
+			return [team.points for team in api.db.session.query(api.Team.points)\
+				.order_by(api.Team.id)]
+
+		# Blue's own goal counts for red
+		batch = [{ 'player_id': red, 'time': '2015-05-01T18:%02d:00' % (i,) }
+			for i in range(8)]
+		batch += [{ 'player_id': blue, 'own_goal': True }, { 'player_id': blue }]
+		resp = post(batch)
+		assert resp.status_code == 201
+		scores = json.loads(resp.data)['scores']
+		assert len(scores) == 10
+		assert scores[0]['time'] == '05/01/2015 18:00:00'
+		assert [s['own_goal'] for s in scores[8:]] == [True, False]
+		assert len(set(s['id'] for s in scores)) == 10
+		assert points() == [9, 1]
+
+		# One bad score rejects the whole batch
+		resp = post([{ 'player_id': red }, { 'player_id': red }, { 'player_id': 1000 }])
+		assert resp.status_code == 400
+		assert resp.data == 'score 1: team already has 10 points\n' \
+			'score 2: player not found'
+		assert points() == [9, 1]
+		assert post({ 'player_id': red }).status_code == 400
+		resp = post([{ 'player_id': [red] }, { 'player_id': {} },
+			{ 'player_id': True }])
+		assert resp.status_code == 400
+		assert resp.data == 'score 0: player not found\n' \
+			'score 1: player not found\nscore 2: player not found'
+
+		# Blue's goal is awarded before red's winner
+		assert post([{ 'player_id': red }, { 'player_id': blue }]).status_code == 400
+		resp = post([{ 'player_id': blue }, { 'player_id': red }])
+		assert resp.status_code == 201
+		assert points() == [10, 2]
+		assert len(json.loads(self.app.get('/games/%s/scores' % (game['id'],)).data)['scores']) == 12
+
+		stats = self.user_stats(user_ids)
+		assert stats[0]['goals'] == 9 and stats[0]['wins'] == 1
+		assert stats[2]['own_goals'] == 1 and stats[2]['losses'] == 1
+		assert json.loads(self.app.get('/users/%s' % (user_ids[0],)).data)['rating'] > 1500
+
+		resp = post([{ 'player_id': blue }])
+		assert resp.status_code == 400
+		assert resp.data == 'score 0: team already has 10 points'
+
+	def test_game_put_statements(self):
+		"""A PUT writes only what changed, in a fixed number of statements"""
+		user_ids = self.create_users(4)
+		game = self.create_game(user_ids)
+		red, blue = game['teams']
+
+		def put(goals, name='red'):
+			scores = [{ 'time': '2015-05-01T18:%02d:00' % (i,) } for i in range(goals)]
+			game_json = json.dumps({ 'teams': [
+				{ 'id': red['id'], 'name': name, 'players': [
+					{ 'id': red['players'][0]['id'], 'user': { 'id': user_ids[0] },
+					  'position': 1, 'scores': scores }] }] })
+			with QueryCounter() as counter:
+				resp = self.app.put('/games/%s' % (game['id'],),
+					content_type='application/json', data=game_json)
+			assert resp.status_code == 200
+			return counter.count, json.loads(resp.data)
+
+		unchanged, result = put(0)
+		few, result = put(2, name='crimson')
+		many, result = put(7)
+		assert few == many
+		assert unchanged < few
+
+		# The tenth goal ends the game
+		result = put(1)[1]
+
+		assert result['teams'][0]['name'] == 'red'
+		players = result['teams'][0]['players']
+		assert len(players[0]['scores']) == 10
+		assert len(set(s['id'] for s in players[0]['scores'])) == 10
+		assert result['teams'][1] == blue
+		teams = api.db.session.query(api.Team.points).order_by(api.Team.id).all()
+		assert [team.points for team in teams] == [10, 0]
+		assert self.user_stats(user_ids)[0]['wins'] == 1
+
+	def test_game_events(self):
+		"""Listeners get each committed change to their game as an SSE message"""
+		user_ids = self.create_users(4)
+		game = self.create_game(user_ids)
+		other = self.create_game(user_ids)
+		red = game['teams'][0]['players'][0]['id']
+
+		assert self.app.get('/games/1000/events').status_code == 404
+		resp = self.app.get('/games/%s/events' % (game['id'],))
+		assert resp.status_code == 200
+		assert resp.mimetype == 'text/event-stream'
+		stream = iter(resp.response)
+		assert next(stream) == 'retry: 3000\n\n'
+		assert api.game_events.stats()['listeners'] == 1
+
+		def message():
+			lines = next(stream).strip().split('\n')
+			return lines[0][len('event: '):], json.loads(lines[1][len('data: '):])
+
+		# Other games' events aren't sent
+		self.app.post('/games/%s/score' % (other['id'],), content_type='application/json',
+			data=json.dumps({ 'player_id': other['teams'][0]['players'][0]['id'] }))
+
+		resp_score = self.app.post('/games/%s/score' % (game['id'],),
+			content_type='application/json', data=json.dumps({ 'player_id': red }))
+		event, data = message()
+		assert event == 'goal'
+		assert data['score'] == dict(json.loads(resp_score.data), player_id=red,
+			team_id=game['teams'][0]['id'])
+		assert [team['points'] for team in data['teams']] == [1, 0]
+
+		self.app.post('/games/%s/scores' % (game['id'],), content_type='application/json',
+			data=json.dumps([{ 'player_id': red }] * 9))
+		events = [message() for i in range(10)]
+		assert [event for event, data in events] == ['goal'] * 9 + ['end']
+		assert events[-1][1]['teams'] == [{ 'id': game['teams'][0]['id'], 'points': 10 },
+			{ 'id': game['teams'][1]['id'], 'points': 0 }]
+
+		resp_put = self.app.put('/games/%s' % (game['id'],), content_type='application/json',
+			data=json.dumps({ 'teams': [{ 'id': game['teams'][0]['id'], 'name': 'crimson' }] }))
+		assert message() == ('update', json.loads(resp_put.data))
+
+		self.app.delete('/games/%s' % (game['id'],))
+		assert message() == ('delete', { 'id': game['id'] })
+		assert list(stream) == []
+		resp.close()
+		assert api.game_events.stats()['listeners'] == 0
+
+	def test_event_hub(self):
+		"""Events go through the broker when there is one, and slow listeners
+		are dropped"""
+		import time
+		from events import EventHub
+
+		class Broker(object):
+			def __init__(self):
+				self.callbacks = []
+			def publish(self, message):
+				for callback in self.callbacks:
+					callback(message)
+			def listen(self, callback):
+				self.callbacks.append(callback)
+
+		broker = Broker()
+		workers = [EventHub(2, broker), EventHub(2, broker)]
+		listeners = [workers[0].subscribe(1), workers[1].subscribe(1),
+			workers[1].subscribe(2)]
+		# Each hub relays the broker from a thread of its own
+		while len(broker.callbacks) < 2:
+			time.sleep(0.01)
+		workers[0].publish(1, 'goal', { 'id': 1 })
+		assert [listener.queue.qsize() for listener in listeners] == [1, 1, 0]
+		assert listeners[1].queue.get() == 'event: goal\ndata: {"id": 1}\n\n'
+
+		# The first worker's listener never reads, and is dropped once full
+		workers[1].publish(1, 'goal', { 'id': 2 })
+		assert not listeners[0].dropped and not listeners[1].dropped
+		workers[1].publish(1, 'end', {})
+		assert listeners[0].dropped and not listeners[1].dropped
+		assert list(listeners[0].messages()) == []
+		assert workers[0].stats()['dropped'] == 1
+		assert workers[0].stats()['listeners'] == 0
+		assert workers[1].stats()['listeners'] == 2
+
+	def test_engine_profiles(self):
+		"""Profiles and FOOSBALL_* variables configure the engine"""
+		settings = config.from_environ({ 'FOOSBALL_PROFILE': 'single-box',
+			'FOOSBALL_POOL_SIZE': '3', 'FOOSBALL_SQLITE_SYNCHRONOUS': 'OFF',
+			'FOOSBALL_DEBUG': '1' })
+		assert settings['SQLALCHEMY_POOL_SIZE'] == 3
+		assert settings['DEBUG'] is True
+		assert settings['SQLITE_PRAGMAS']['journal_mode'] == 'WAL'
+		assert settings['SQLITE_PRAGMAS']['synchronous'] == 'OFF'
+		assert config.PROFILES['single-box']['SQLITE_PRAGMAS']['synchronous'] == 'NORMAL'
+		assert config.from_environ({}) == config.profile('development')
+		self.assertRaises(ValueError, config.from_environ, { 'FOOSBALL_PROFILE': 'fast' })
+
+		assert api.db.engine.execute('PRAGMA journal_mode').scalar() == 'memory'
+		assert api.db.engine.execute('PRAGMA synchronous').scalar() == 0
+
+		# A pooled, WAL mode engine for a new database
+		api.db.session.remove()
+		fd, path = tempfile.mkstemp()
+		api.app.config.update(settings)
+		api.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+		try:
+			api.init_db()
+			engine = api.db.engine
+			assert engine.pool.__class__.__name__ == 'QueuePool'
+			assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+			assert engine.execute('PRAGMA mmap_size').scalar() == 268435456
+			resp = self.app.post('/users', content_type='application/json',
+				data=json.dumps({ 'name': 'pooled' }))
+			assert resp.status_code == 201
+			assert engine.pool.checkedout() == 0
+		finally:
+			api.db.session.remove()
+			api.db.engine.dispose()
+			os.close(fd)
+			for suffix in ('', '-wal', '-shm'):
+				if os.path.exists(path + suffix):
+					os.unlink(path + suffix)
+
+	def test_metrics(self):
+		"""Requests are timed and their SQL counted, by endpoint"""
+		game = self.create_game(self.create_users(4))
+		with QueryCounter() as counter:
+			self.app.get('/games/%s' % (game['id'],))
+		self.app.get('/games/%s' % (game['id'],), headers={ 'Accept': 'application/json' })
+		self.app.get('/nowhere')
+
+		get_game = api.metrics.endpoint('get_game')
+		assert get_game.responses == { 200: 2 }
+		assert get_game.latency.count == 2
+		assert get_game.statements.count == 2
+		assert get_game.statements.sum == counter.count * 2
+		assert get_game.size.sum == 2 * len(self.app.get('/games/%s' % (game['id'],)).data)
+		assert api.metrics.endpoint('create_user').responses == { 201: 4 }
+
+		resp = self.app.get('/metrics')
+		assert resp.status_code == 200
+		assert resp.mimetype == 'text/plain'
+		lines = resp.data.split('\n')
+		assert 'foosball_requests_total{endpoint="unmatched",status="404"} 1' in lines
+		assert 'foosball_sql_statements_count{endpoint="get_game"} 3' in lines
+		assert 'foosball_request_duration_seconds_bucket{endpoint="get_game",le="+Inf"} 3' in lines
+		assert 'foosball_sql_statements_bucket{endpoint="create_user",le="0"} 0' in lines
+		assert '# TYPE foosball_response_size_bytes histogram' in lines
+		assert 'foosball_game_cache_size 0' in lines
+		assert '# TYPE foosball_game_cache_evictions_total counter' in lines
+		assert 'foosball_game_cache_evictions_total 0' in lines
+		assert '# TYPE foosball_game_cache_hits_total counter' in lines
+		assert '# TYPE foosball_game_cache_misses_total counter' in lines
+		assert any(line.startswith('foosball_sql_duration_seconds_total{endpoint="create_game"} ')
+			for line in lines)
+
+		api.app.config['METRICS_ENABLED'] = False
+		try:
+			self.app.get('/games/%s' % (game['id'],))
+		finally:
+			api.app.config['METRICS_ENABLED'] = True
+		assert api.metrics.endpoint('get_game').latency.count == 3
+
+	def test_statement_budgets(self):
+		"""Every endpoint stays within its statement budget as games pile up"""
+		endpoints = set(rule.endpoint for rule in api.app.url_map.iter_rules())
+		assert endpoints - UNBUDGETED == set(STATEMENT_BUDGETS)
+		user_ids = self.create_users(8)
+
+		def game_json(i, goals):
+			players = [{ 'user': { 'id': user_id }, 'position': p % 2 + 1,
+				'scores': [] } for p, user_id in enumerate(user_ids[i % 5:i % 5 + 4])]
+			for goal in range(goals):
+				players[goal % 2]['scores'].append({
+					'time': '2015-05-01T18:%02d:00' % (goal,) })
+			return json.dumps({ 'start': '2015-05-01T18:00:00',
+				'teams': [{ 'name': 'red', 'players': players[:2] },
+					{ 'name': 'blue', 'players': players[2:] }] })
+
+		def exercise(run):
+			"""Statements run by a request to each endpoint"""
+			counts = {}
+			def send(method, path, body=None):
+				resp, count = self.within_budget(method, path,
+					None if body is None else json.dumps(body))
+				endpoint = api.app.url_map.bind('localhost').match(
+					path.split('?')[0], method)[0]
+				counts[endpoint] = max(count, counts.get(endpoint, 0))
+				return resp
+
+			game = json.loads(send('POST', '/games', json.loads(game_json(run, 0))).data)
+			red, blue = [team['players'][0]['id'] for team in game['teams']]
+			spare = json.loads(send('POST', '/users', { 'name': 'spare%s' % (run,) }).data)
+			for path in ['/games?per_page=100', '/games?per_page=100&user_id=%s'
+					% (user_ids[0],), '/games/%s' % (game['id'],),
+					'/games/%s/players' % (game['id'],), '/games/%s/scores'
+					% (game['id'],), '/games/%s/teams' % (game['id'],),
+					'/users?per_page=100', '/users/%s' % (user_ids[0],),
+					'/users/%s/stats' % (user_ids[0],), '/leaderboard',
+					'/ratings', '/metrics']:
+				send('GET', path)
+
+			send('PUT', '/users/%s' % (user_ids[0],), { 'first_name': 'run%s' % (run,) })
+			send('POST', '/games/%s/score' % (game['id'],), { 'player_id': red })
+			send('POST', '/games/%s/scores' % (game['id'],),
+				[{ 'player_id': red }, { 'player_id': blue }])
+			# The batch that ends the game rates it too
+			send('POST', '/games/%s/scores' % (game['id'],),
+				[{ 'player_id': red }] * 8)
+			send('GET', '/games/%s' % (game['id'],))
+			send('PUT', '/games/%s' % (game['id'],), { 'teams': [
+				{ 'id': game['teams'][0]['id'], 'name': 'crimson' }] })
+			send('DELETE', '/users/%s' % (spare['id'],))
+			send('DELETE', '/games/%s' % (game['id'],))
+			old = json.loads(game_json(run, 10))
+			old['start'] = '2014-05-01T18:00:00'
+			send('POST', '/games', old)
+			send('DELETE', '/games?started_before=2015-01-01T00:00:00')
+			return counts
+
+		games = 0
+		for total in (1, 100):
+			lines = [game_json(i, 10 if i % 3 else 3) for i in range(games, total)]
+			self.within_budget('POST', '/games/ingest', '\n'.join(lines),
+				'application/x-ndjson')
+			games = total
+			exercise(total)
+
+		assert len(json.loads(self.app.get('/games?per_page=200').data)) == 100
+
+	def test_generated_data(self):
+		"""Generated games are the same for a seed, valid, and load as they would through the api"""
+		import datagen
+		from validation import validate_game
+		user_ids = list(range(1, 11))
+		games = list(datagen.generate_games(200, user_ids, seed=5))
+		assert games == list(datagen.generate_games(200, user_ids, seed=5))
+		assert games != list(datagen.generate_games(200, user_ids, seed=6))
+		assert all(validate_game(game, set(user_ids)) == [] for game in games)
+		assert set(len(team['players']) for game in games
+			for team in game['teams']) == set([1, 2, 3, 4])
+		assert [game['end'] is None for game in games].count(True) == 2
+
+		datagen.populate(api.db.engine, 10, 50, seed=5, chunk_size=20)
+		listed = json.loads(self.app.get('/games?per_page=100').data)
+		assert len(listed) == 50
+		scores = [score for game in listed for team in game['teams']
+			for player in team['players'] for score in player['scores']]
+		assert any(score['own_goal'] for score in scores)
+		assert json.loads(self.app.get('/users/1').data)['name'] == 'user0'
+
+		stats = self.user_stats(user_ids)
+		assert sum(s['goals'] + s['own_goals'] for s in stats) == len(scores)
+		assert sum(s['games_played'] for s in stats) == sum(len(team['players'])
+			for game in listed if game['end'] is not None for team in game['teams'])
+
+	def test_purge_games(self):
+		"""Games in a start range are deleted in batches, taking back their stats and ratings"""
+		import stats
+		user_ids = self.create_users(4)
+		games = []
+		for day in range(1, 8):
+			game = self.create_game(user_ids, start='2015-05-%02d 18:00:00' % (day,))
+			games.append(game)
+			# Red wins the first five
+			if day <= 5:
+				resp = self.app.post('/games/%s/scores' % (game['id'],),
+					content_type='application/json', data=json.dumps(
+						[{ 'player_id': game['teams'][0]['players'][0]['id'] }] * 10))
+				assert resp.status_code == 201
+		before = self.user_stats(user_ids)
+		assert before[0]['wins'] == 5 and before[0]['goals'] == 50
+
+		resp = self.app.delete('/games')
+		assert resp.status_code == 400
+		assert resp.data == 'started_after or started_before is required'
+		resp = self.app.delete('/games?started_before=soon')
+		assert resp.status_code == 400
+
+		api.app.config['PURGE_BATCH_SIZE'] = 2
+		try:
+			resp = self.app.delete('/games?started_after=2015-05-02T00:00:00'
+				'&started_before=2015-05-07T00:00:00')
+		finally:
+			api.app.config['PURGE_BATCH_SIZE'] = 500
+		assert resp.status_code == 200
+		assert json.loads(resp.data) == { 'deleted': 5 }
+
+		left = json.loads(self.app.get('/games?sort_by=id').data)
+		assert [g['id'] for g in left] == [games[0]['id'], games[6]['id']]
+		assert self.app.get('/games/%s' % (games[3]['id'],)).status_code == 404
+		for table in (api.Team, api.Player, api.Score):
+			assert api.db.session.query(table)\
+				.filter(table.game_id == games[3]['id']).count() == 0
+		assert api.db.session.query(api.Score).count() == 10
+
+		# What is left matches a recount, and the one win left is rated as if
+		# it were the only game
+		after = self.user_stats(user_ids)
+		assert after[0]['wins'] == 1 and after[0]['goals'] == 10
+		assert after[2]['games_played'] == 1
+		stats.rebuild_stats(api.db.engine)
+		assert self.user_stats(user_ids) == after
+		ratings = [json.loads(self.app.get('/users/%s' % (i,)).data)['rating']
+			for i in user_ids]
+		assert ratings[0] == 1516 and ratings[2] == 1484
+
+		assert json.loads(self.app.delete('/games?started_before=2015-01-01T00:00:00').data) \
+			== { 'deleted': 0 }
+
+	def test_archive_games(self):
+		"""Archived games read back the same, and still count for stats and ratings"""
+		import archive, ratings, stats
+		from datetime import datetime
+		from models import ArchivedGame, ArchivedPlayer
+		user_ids = self.create_users(5)
+		games = []
+		for day in range(1, 5):
+			game = self.create_game(user_ids, start='2015-05-%02d 18:00:00' % (day,))
+			games.append(game)
+			if day == 4:
+				# Still running, so it stays where it is
+				continue
+			# Red wins on days 1 and 3, blue on day 2, with an own goal by red
+			red, blue = [team['players'][0]['id'] for team in game['teams']]
+			goals = [{ 'player_id': red, 'own_goal': True }]
+			winner, loser = (blue, red) if day == 2 else (red, blue)
+			goals.extend([{ 'player_id': loser }] * (2 if day == 2 else day))
+			goals.extend({ 'player_id': winner,
+				'time': '2015-05-%02d 18:%02d:00' % (day, i + 1) }
+				for i in range(9 if day == 2 else 10))
+			resp = self.app.post('/games/%s/scores' % (game['id'],),
+				content_type='application/json', data=json.dumps(goals))
+			assert resp.status_code == 201
+
+		urls = ['/games/%s%s' % (game['id'], sub) for game in games
+			for sub in ('', '/players', '/scores', '/teams')] + \
+			['/games?sort_by=id', '/games?user_id=%s' % (user_ids[2],),
+				'/games?started_after=2015-05-02T00:00:00&stream=1']
+		def read():
+			responses = [self.app.get(url) for url in urls]
+			return [(resp.data, resp.headers.get('ETag')) for resp in responses]
+		before = read()
+		stats_before = self.user_stats(user_ids)
+		ratings_before = [json.loads(self.app.get('/users/%s' % (i,)).data)['rating']
+			for i in user_ids]
+		assert stats_before[0]['wins'] == 2 and stats_before[0]['own_goals'] == 3
+		assert stats_before[2]['wins'] == 1 and stats_before[2]['games_played'] == 3
+
+		archived = []
+		assert archive.archive_games(api.db.session, datetime(2015, 5, 10),
+			batch_size=2, progress=archived.append) == 3
+		assert archived == [[g['id'] for g in games[:2]], [games[2]['id']]]
+		assert archive.archive_games(api.db.session, datetime(2015, 5, 10)) == 0
+		for table in (api.Team, api.Player, api.Score):
+			assert set(row.game_id for row in api.db.session.query(table)) \
+				<= set([games[3]['id']])
+
+		# Served from the archive, not the cache
+		api.game_cache.clear()
+		assert read() == before
+		for url in ('/games/%s' % (games[0]['id'],), '/games?sort_by=id'):
+			resp, count = self.within_budget('GET', url)
+		assert self.user_stats(user_ids) == stats_before
+
+		# Renaming a player changes their archived games too, cached or not
+		url = '/games/%s' % (games[0]['id'],)
+		etag = self.app.get(url).headers['ETag']
+		assert self.app.get(url, headers={ 'If-None-Match': etag }).status_code == 304
+		resp = self.app.put('/users/%s' % (user_ids[1],),
+			content_type='application/json', data=json.dumps({ 'name': 'renamed' }))
+		assert resp.status_code == 204
+		resp = self.app.get(url, headers={ 'If-None-Match': etag })
+		assert resp.status_code == 200 and resp.headers['ETag'] != etag
+		assert resp.data != before[0][0]
+		names = [p['user']['name'] for p in json.loads(resp.data)['teams'][0]['players']]
+		assert names == ['user0', 'renamed']
+		listed = json.loads(self.app.get('/games?sort_by=id').data)
+		assert listed[0]['teams'][0]['players'][1]['user']['name'] == 'renamed'
+
+		game_url = '/games/%s' % (games[0]['id'],)
+		resp = self.app.put(game_url, content_type='application/json',
+			data=before[0][0])
+		assert resp.status_code == 400 and resp.data == 'game is archived'
+		resp = self.app.post(game_url + '/score', content_type='application/json',
+			data=json.dumps({ 'player_id': games[0]['teams'][0]['players'][0]['id'] }))
+		assert resp.status_code == 400
+		assert self.app.delete('/users/%s' % (user_ids[0],)).status_code == 405
+		assert self.app.delete('/users/%s' % (user_ids[4],)).status_code == 204
+
+		# Rebuilding from the tables, archived rows included, changes nothing
+		stats.rebuild_stats(api.db.engine)
+		assert self.user_stats(user_ids[:4]) == stats_before[:4]
+		ratings.recompute_ratings(api.db.engine)
+		assert all(abs(json.loads(self.app.get('/users/%s' % (i,)).data)['rating'] - r)
+			< 1e-9 for i, r in zip(user_ids[:4], ratings_before))
+
+		# Deleting archived games takes back what they counted for
+		resp, count = self.within_budget('DELETE', game_url)
+		assert self.app.get(game_url).status_code == 404
+		after = self.user_stats(user_ids[:4])
+		assert after[0]['games_played'] == 2 and after[0]['wins'] == 1
+		stats.rebuild_stats(api.db.engine)
+		assert self.user_stats(user_ids[:4]) == after
+		resp, count = self.within_budget('DELETE', '/games?started_before=2015-05-10T00:00:00')
+		assert json.loads(resp.data) == { 'deleted': 3 }
+		for table in (ArchivedGame, ArchivedPlayer):
+			assert api.db.session.query(table).count() == 0
+		assert all(abs(json.loads(self.app.get('/users/%s' % (i,)).data)['rating']
+			- 1500) < 1e-9 for i in user_ids[:4])
+
 
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file
@@ -0,0 +1,276 @@
+"""Moving old finished games out of the tables every request reads.
+
+Listings, stats queries and the indexes on teams, players and scores all
+grow with every game ever played, though games from last year are rarely
+looked at. archive_games moves finished games started before a cutoff out
+of those tables, a batch at a time:
+
+- each game's teams, players and scores become one zlib compressed JSON
+  blob in archived_games
+- a row per player in archived_players keeps what the game counted for
+  (goals, own goals, the two teams' points and the rating change), which
+  stats.game_totals, ratings.load_history and GET /games?user_id= read
+  alongside the players table
+- the games row stays, marked archived, so ids, start filters, paging,
+  ETags and cached responses carry on as before
+
+Archived games are read back by load_archived as ColdGame objects, which
+the serializers and views take in place of Game rows, with the users as
+they are now. They can be read and deleted, but not changed.
+"""
+import json
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import and_, exists, or_, select
+from bulk import insert_rows, lock_for_write
+from models import User, Game, Team, Player, Score, ArchivedGame, \
+    ArchivedPlayer
+from purge import delete_contents
+from serializers import serialize_game, serialize_team, serialize_player, \
+    serialize_score
+
+BATCH_SIZE = 500
+# Score times are kept as microseconds since this
+EPOCH = datetime(1970, 1, 1)
+
+
+class ColdScore(object):
+    def __init__(self, id, player, time, own_goal):
+        self.id = id
+        self.player_id = player.id
+        self.team_id = player.team_id
+        self.game_id = player.game_id
+        self.time = time
+        self.own_goal = own_goal
+
+    @property
+    def serialize(self):
+        return serialize_score(self)
+
+
+class ColdPlayer(object):
+    def __init__(self, id, team, user_id, position, rating_change):
+        self.id = id
+        self.team_id = team.id
+        self.game_id = team.game_id
+        self.user_id = user_id
+        self.position = position
+        self.rating_change = rating_change
+        self.user = None
+        self.scores = []
+
+    @property
+    def serialize(self):
+        return serialize_player(self)
+
+
+class ColdTeam(object):
+    def __init__(self, id, game_id, name, points):
+        self.id = id
+        self.game_id = game_id
+        self.name = name
+        self.points = points
+        self.players = []
+
+    @property
+    def serialize(self):
+        return serialize_team(self)
+
+
+class ColdGame(object):
+    """An archived game as read back from its blob, with the attributes of
+    a Game row that the serializers and views use"""
+    archived = True
+
+    def __init__(self, game, teams):
+        self.id = game.id
+        self.start = game.start
+        self.end = game.end
+        self.version = game.version
+        self.updated = game.updated
+        self.teams = teams
+        self.players = sorted((player for team in teams
+            for player in team.players), key=lambda player: player.id)
+        self.scores = sorted((score for player in self.players
+            for score in player.scores), key=lambda score: score.id)
+
+    @property
+    def serialize(self):
+        return serialize_game(self)
+
+    @property
+    def serialize_players(self):
+        return [player.serialize for player in self.players]
+
+    @property
+    def serialize_teams(self):
+        return [team.serialize for team in self.teams]
+
+    @property
+    def serialize_scores(self):
+        return [score.serialize for score in self.scores]
+
+
+def encode_time(value):
+    if value is None:
+        return None
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def decode_time(value):
+    if value is None:
+        return None
+    return EPOCH + timedelta(microseconds=value)
+
+
+def pack(teams):
+    """The blob for a game's teams, given as lists of
+    [id, name, points, [[player id, user id, position, rating change,
+    [[score id, time, own goal]]]]]"""
+    return zlib.compress(json.dumps(teams, separators=(',', ':'))\
+        .encode('ascii'))
+
+
+def unpack(game, payload):
+    """ColdGame for a games row and its blob. The players' users are left
+    for load_archived to fill in."""
+    teams = []
+    for team_id, name, points, players in json.loads(
+            zlib.decompress(payload).decode('ascii')):
+        team = ColdTeam(team_id, game.id, name, points)
+        for player_id, user_id, position, rating_change, scores in players:
+            player = ColdPlayer(player_id, team, user_id, position,
+                rating_change)
+            player.scores = [ColdScore(score_id, player, decode_time(time),
+                own_goal) for score_id, time, own_goal in scores]
+            team.players.append(player)
+        teams.append(team)
+    return ColdGame(game, teams)
+
+
+def load_archived(session, games):
+    """games, a list of Game rows, with the archived ones swapped for
+    ColdGames: one query for their blobs and one for their users"""
+    ids = [game.id for game in games if game.archived]
+    if len(ids) == 0:
+        return games
+
+    archived = ArchivedGame.__table__
+    payloads = dict(session.execute(select([archived.c.game_id,
+            archived.c.payload])\
+        .where(archived.c.game_id.in_(ids))).fetchall())
+    # A game deleted since it was read has no blob left
+    cold = dict((game.id, unpack(game, payloads[game.id]))
+        for game in games if game.id in payloads)
+
+    user_ids = set(player.user_id for game in cold.values()
+        for player in game.players if player.user_id is not None)
+    if len(user_ids) > 0:
+        users = dict((user.id, user) for user in session.query(User)\
+            .filter(User.id.in_(user_ids)))
+        for game in cold.values():
+            for player in game.players:
+                player.user = users.get(player.user_id)
+
+    return [cold.get(game.id, game) if game.archived else game
+        for game in games]
+
+
+def archive_batch(connection, game_ids):
+    """Move games to the archive tables. The caller should hold the write
+    lock, and make sure the games are finished and not yet archived."""
+    teams = Team.__table__
+    players = Player.__table__
+    scores = Score.__table__
+
+    team_rows = connection.execute(select([teams.c.id, teams.c.game_id,
+            teams.c.name, teams.c.points])\
+        .where(teams.c.game_id.in_(game_ids))\
+        .order_by(teams.c.id)).fetchall()
+    player_rows = connection.execute(select([players.c.id,
+            players.c.team_id, players.c.user_id, players.c.position,
+            players.c.rating_change])\
+        .where(players.c.game_id.in_(game_ids))\
+        .order_by(players.c.id)).fetchall()
+    score_rows = connection.execute(select([scores.c.id, scores.c.player_id,
+            scores.c.time, scores.c.own_goal])\
+        .where(scores.c.game_id.in_(game_ids))\
+        .order_by(scores.c.id)).fetchall()
+
+    by_game = dict((game_id, []) for game_id in game_ids)
+    team_index = {}
+    for team_id, game_id, name, points in team_rows:
+        team_index[team_id] = [team_id, name, points, []]
+        by_game[game_id].append(team_index[team_id])
+
+    player_index = {}
+    for player_id, team_id, user_id, position, rating_change in player_rows:
+        player_index[player_id] = [player_id, user_id, position,
+            rating_change, []]
+        team_index[team_id][3].append(player_index[player_id])
+
+    for score_id, player_id, time, own_goal in score_rows:
+        player_index[player_id][4].append([score_id, encode_time(time),
+            own_goal])
+
+    archived_games, archived_players = [], []
+    for game_id in game_ids:
+        game_teams = by_game[game_id]
+        archived_games.append({ 'game_id': game_id,
+            'payload': pack(game_teams) })
+
+        for team in game_teams:
+            others = [other[2] for other in game_teams if other is not team]
+            for player_id, user_id, position, rating_change, goals \
+                    in team[3]:
+                own_goals = len([goal for goal in goals if goal[2]])
+                archived_players.append({ 'player_id': player_id,
+                    'game_id': game_id, 'team_id': team[0],
+                    'user_id': user_id, 'goals': len(goals) - own_goals,
+                    'own_goals': own_goals, 'points': team[2],
+                    'against': others[0] if len(others) == 1 else None,
+                    'rating_change': rating_change })
+
+    insert_rows(connection, ArchivedGame.__table__, archived_games)
+    insert_rows(connection, ArchivedPlayer.__table__, archived_players)
+    delete_contents(connection, game_ids)
+    games = Game.__table__
+    connection.execute(games.update()\
+        .where(games.c.id.in_(game_ids))\
+        .values(archived=True))
+
+
+def archive_games(session, before, batch_size=BATCH_SIZE, progress=None):
+    """Archive every finished game started before before, batch_size games
+    per transaction. progress, if given, is called with the ids of each
+    batch once it is committed. Returns the number of games archived."""
+    games = Game.__table__
+    teams = Team.__table__
+    finished = or_(games.c.end != None, exists().where(and_(
+        teams.c.game_id == games.c.id, teams.c.points >= 10)))
+    query = select([games.c.id])\
+        .where(games.c.archived == False)\
+        .where(games.c.start < before)\
+        .where(finished)\
+        .order_by(games.c.start, games.c.id)\
+        .limit(batch_size)\
+        .with_for_update()
+
+    archived = 0
+    while True:
+        connection = session.connection()
+        # Nobody can score in or change a game between it being picked
+        # and moved: the query locks the rows it picks, and SQLite, which
+        # ignores FOR UPDATE, gets its write lock taken first
+        lock_for_write(connection, games)
+        game_ids = [row[0] for row in connection.execute(query)]
+        if len(game_ids) == 0:
+            session.commit()
+            return archived
+
+        archive_batch(connection, game_ids)
+        session.commit()
+        archived += len(game_ids)
+        if progress is not None:
+            progress(game_ids)
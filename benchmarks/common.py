@@ -0,0 +1,62 @@
+"""Shared setup for the benchmark scripts in this directory.
+
+Benchmarks run against a throwaway SQLite database by default, the same way
+api_tests.py does. Pass a database URI to use something else."""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api
+from models import db
+from sqlalchemy import event
+
+
+def setup_app(uri=None):
+    """Point the api app at uri (or a fresh temp SQLite file) and create the
+    tables. Returns a cleanup function."""
+    path = None
+    if uri is None:
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        uri = 'sqlite:///' + path
+
+    api.app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    api.app.config['TESTING'] = True
+    api.init_db()
+
+    def cleanup():
+        db.session.remove()
+        if path is not None:
+            os.unlink(path)
+
+    return cleanup
+
+
+class QueryCounter(object):
+    """Context manager counting the SQL statements sent to the db engine.
+    The statements and their parameters are kept in statements."""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        self.count += 1
+        self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        self.engine = db.engine
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def percentile(values, fraction):
+    """The value fraction of the way through values, by rank"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
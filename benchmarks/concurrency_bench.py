@@ -0,0 +1,166 @@
+"""Compare serving the api with app.run against serve.py's gevent server.
+
+Usage: python benchmarks/concurrency_bench.py [idle] [requests] [clients]
+
+Starts each server on a throwaway SQLite database holding one game, opens
+idle (default 1000) GET /games/<id>/events streams and leaves them open,
+then sends requests (default 2000) GET /games/<id> from clients (default
+50) connections at a time. Reports how long the streams took to open, the
+server's memory and threads while holding them, and the throughput and
+latency of the requests made alongside them."""
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent
+from gevent import socket
+from gevent.pool import Pool
+
+import common
+import api
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+
+# (name, command line given the database URI and port)
+SERVERS = [
+    ('app.run, threaded', lambda uri, port: [sys.executable, '-c',
+        'import sys, api; '
+        'api.app.config["SQLALCHEMY_DATABASE_URI"] = sys.argv[1]; '
+        'api.app.config["DEBUG"] = False; api.init_db(); '
+        'api.app.run(port=int(sys.argv[2]), threaded=True)', uri, str(port)]),
+    ('serve.py, gevent', lambda uri, port: [sys.executable,
+        os.path.join(ROOT, 'serve.py'), '--database', uri,
+        '--port', str(port)]),
+]
+
+
+def seed(uri):
+    """One game between four users, returning its id"""
+    common.setup_app(uri)
+    client = api.app.test_client()
+    user_ids = []
+    for i in range(4):
+        resp = client.post('/users', content_type='application/json',
+            data=json.dumps({ 'name': 'user%s' % (i,) }))
+        user_ids.append(json.loads(resp.data)['id'])
+    resp = client.post('/games', content_type='application/json',
+        data=json.dumps({ 'start': '2015-05-01T18:00:00', 'teams': [
+            { 'name': 'red', 'players': [{ 'user': { 'id': user_ids[0] },
+                'position': 1 }, { 'user': { 'id': user_ids[1] },
+                'position': 2 }] },
+            { 'name': 'blue', 'players': [{ 'user': { 'id': user_ids[2] },
+                'position': 1 }, { 'user': { 'id': user_ids[3] },
+                'position': 2 }] }] }))
+    api.db.session.remove()
+    return json.loads(resp.data)['id']
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def connect(port, path):
+    """Send a GET and return the socket, once the response headers are in"""
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(('GET %s HTTP/1.0\r\nHost: localhost\r\n\r\n'
+        % (path,)).encode('ascii'))
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    assert data.startswith(b'HTTP/1.') and b' 200 ' in data.split(b'\r\n')[0]
+    return sock
+
+
+def get(port, path):
+    """Seconds taken by a whole GET"""
+    started = time.time()
+    sock = connect(port, path)
+    while sock.recv(65536):
+        pass
+    sock.close()
+    return time.time() - started
+
+
+def server_usage(pid):
+    """(resident MB, threads) of a process, from /proc"""
+    fields = {}
+    with open('/proc/%s/status' % (pid,)) as status:
+        for line in status:
+            key, _, value = line.partition(':')
+            fields[key] = value.split()
+    return int(fields['VmRSS'][0]) / 1024.0, int(fields['Threads'][0])
+
+
+def run(name, command, uri, game_id, idle, requests, clients):
+    port = free_port()
+    server = subprocess.Popen(command(uri, port), cwd=ROOT,
+        stderr=open(os.devnull, 'w'))
+    try:
+        for attempt in range(100):
+            try:
+                get(port, '/games/%s' % (game_id,))
+                break
+            except (socket.error, AssertionError):
+                gevent.sleep(0.1)
+
+        started = time.time()
+        streams = Pool(200).map(lambda i: connect(port,
+            '/games/%s/events' % (game_id,)), range(idle))
+        opened = time.time() - started
+        memory, threads = server_usage(server.pid)
+
+        started = time.time()
+        latencies = Pool(clients).map(lambda i: get(port,
+            '/games/%s' % (game_id,)), range(requests))
+        elapsed = time.time() - started
+
+        print('%-18s %5d streams open in %5.2fs, %6.1f MB, %5d threads; '
+            '%5.0f req/s, p50 %5.1fms, p99 %6.1fms' % (name, len(streams),
+            opened, memory, threads, requests / elapsed,
+            common.percentile(latencies, 0.5) * 1000,
+            common.percentile(latencies, 0.99) * 1000))
+
+        for sock in streams:
+            sock.close()
+    finally:
+        server.kill()
+        server.wait()
+
+
+def main():
+    idle = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    clients = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    # Every stream is a file descriptor at both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    uri = 'sqlite:///' + path
+    try:
+        game_id = seed(uri)
+        for name, command in SERVERS:
+            run(name, command, uri, game_id, idle, requests, clients)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Time the same workload under each engine profile in config.py.
+
+Usage: python benchmarks/engine_bench.py [n_games] [database_uri]
+
+Creates n_games (default 300) games through POST /games, posts a goal to
+each, and reads each back three times, reporting operations per second for
+every profile. Without a database URI the SQLite profiles run, each on a
+throwaway database file; with one, the development and production
+profiles run against it."""
+import json
+import os
+import sys
+import tempfile
+import time
+
+import common
+import api
+import config
+from models import db
+
+SQLITE_PROFILES = ['development', 'testing', 'single-box']
+SERVER_PROFILES = ['development', 'production']
+
+
+def workload(n_games):
+    """Seconds spent creating, scoring and reading n_games games"""
+    client = api.app.test_client()
+    user_ids = []
+    for i in range(4):
+        resp = client.post('/users', content_type='application/json',
+            data=json.dumps({ 'name': 'bench%s-%s' % (time.time(), i) }))
+        user_ids.append(json.loads(resp.data)['id'])
+    game_json = json.dumps({ 'start': '2015-05-01T18:00:00', 'teams': [
+        { 'name': 'red', 'players': [{ 'user': { 'id': user_ids[0] },
+            'position': 1 }, { 'user': { 'id': user_ids[1] },
+            'position': 2 }] },
+        { 'name': 'blue', 'players': [{ 'user': { 'id': user_ids[2] },
+            'position': 1 }, { 'user': { 'id': user_ids[3] },
+            'position': 2 }] }] })
+
+    timings = []
+    started = time.time()
+    games = []
+    for i in range(n_games):
+        resp = client.post('/games', content_type='application/json',
+            data=game_json)
+        assert resp.status_code == 201
+        games.append(json.loads(resp.data))
+    timings.append(time.time() - started)
+
+    started = time.time()
+    for game in games:
+        resp = client.post('/games/%s/score' % (game['id'],),
+            content_type='application/json', data=json.dumps({
+                'player_id': game['teams'][0]['players'][0]['id'] }))
+        assert resp.status_code == 201
+    timings.append(time.time() - started)
+
+    started = time.time()
+    for i in range(3):
+        for game in games:
+            assert client.get('/games/%s' % (game['id'],)).status_code == 200
+    timings.append(time.time() - started)
+
+    return timings
+
+
+def run(name, uri, n_games):
+    api.app.config.update(config.profile(name))
+    cleanup = common.setup_app(uri)
+    try:
+        create, score, read = workload(n_games)
+    finally:
+        db.engine.dispose()
+        cleanup()
+
+    print('%-12s %7.0f creates/s %7.0f goals/s %7.0f reads/s' % (name,
+        n_games / create, n_games / score, n_games * 3 / read))
+
+
+def main():
+    n_games = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+    if len(sys.argv) > 2:
+        for name in SERVER_PROFILES:
+            run(name, sys.argv[2], n_games)
+        return
+
+    for name in SQLITE_PROFILES:
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            run(name, 'sqlite:///' + path, n_games)
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
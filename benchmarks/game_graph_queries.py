@@ -0,0 +1,71 @@
+"""Count the SQL statements issued by GET /games as the page size grows.
+
+Usage: python benchmarks/game_graph_queries.py [database_uri]
+
+Seeds a database with fully populated games (2 teams, 4 players each, a
+finished score sheet) and prints the number of statements needed to serve
+GET /games for several per_page values, next to the number a lazily loaded
+Game.serialize walk would need for the same page."""
+import sys
+from datetime import datetime, timedelta
+
+from common import api, db, setup_app, QueryCounter
+from models import User, Game, Team, Player, Score
+
+PAGE_SIZES = [1, 10, 50, 200]
+
+
+def seed(n_games):
+    users = [User(name='user%s' % (i,)) for i in range(8)]
+    db.session.add_all(users)
+
+    start = datetime(2015, 1, 1)
+    for i in range(n_games):
+        g = Game(start=start + timedelta(minutes=i))
+        for t_index, name in enumerate(['red', 'blue']):
+            t = Team(name=name)
+            g.teams.append(t)
+            for position in range(1, 5):
+                p = Player(position=position,
+                        user=users[t_index * 4 + position - 1])
+                g.players.append(p)
+                t.players.append(p)
+                # Red scores ten, blue scores a few
+                goals = 3 if t_index == 0 else 1
+                if t_index == 0 and position == 4:
+                    goals = 1
+                for k in range(goals):
+                    s = Score(time=g.start, own_goal=False)
+                    g.scores.append(s)
+                    t.scores.append(s)
+                    p.scores.append(s)
+        db.session.add(g)
+    db.session.commit()
+
+
+def main():
+    cleanup = setup_app(sys.argv[1] if len(sys.argv) > 1 else None)
+    try:
+        seed(max(PAGE_SIZES))
+        client = api.app.test_client()
+
+        print('%10s %18s %18s' % ('per_page', 'GET /games', 'lazy serialize'))
+        for per_page in PAGE_SIZES:
+            db.session.expunge_all()
+            with QueryCounter() as eager:
+                resp = client.get('/games?per_page=%s' % (per_page,))
+            assert resp.status_code == 200
+
+            db.session.expunge_all()
+            with QueryCounter() as lazy:
+                games = db.session.query(Game).order_by(Game.id)\
+                        .limit(per_page).all()
+                [game.serialize for game in games]
+
+            print('%10s %18s %18s' % (per_page, eager.count, lazy.count))
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
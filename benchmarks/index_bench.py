@@ -0,0 +1,91 @@
+"""Show the query plans and timings of filtered GET /games requests with and
+without the model indexes.
+
+Usage: python benchmarks/index_bench.py [n_games] [database_uri]
+
+Seeds n_games (default 5000) games from datagen.py, drops every secondary
+index, and runs the filtered listings: by user, by start range, and sorted
+by start with keyset paging. It then runs the migration that recreates the indexes and
+repeats them. For each request it prints the average time and the plan of
+the query selecting the page, so the move from table scans to index
+searches can be seen."""
+import sys
+import time
+from datetime import timedelta
+
+from common import api, db, setup_app, QueryCounter
+from datagen import populate
+from migrate import migrate
+from models import Game
+from sqlalchemy import func, select
+
+RUNS = 3
+
+
+def drop_indexes():
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(db.engine)
+
+
+def explain(statement, parameters):
+    engine = db.engine
+    if engine.dialect.name == 'sqlite':
+        rows = engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[len(row) - 1] for row in rows]
+    rows = engine.execute('EXPLAIN ' + statement, parameters)
+    return [row[0] for row in rows]
+
+
+def run(client, urls):
+    for url in urls:
+        timings = []
+        for i in range(RUNS):
+            api.game_cache.clear()
+            db.session.expunge_all()
+            with QueryCounter() as counter:
+                started = time.time()
+                resp = client.get(url)
+                timings.append(time.time() - started)
+            assert resp.status_code == 200
+
+        print('  %s' % (url,))
+        print('    %.1f ms average over %s runs, %s statements' % (
+            sum(timings) / len(timings) * 1000, RUNS, counter.count))
+        for line in explain(*counter.statements[0]):
+            print('      %s' % (line,))
+
+
+def main():
+    n_games = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    cleanup = setup_app(sys.argv[2] if len(sys.argv) > 2 else None)
+    try:
+        drop_indexes()
+        populate(db.engine, 60, n_games)
+        client = api.app.test_client()
+
+        first, last = db.engine.execute(select([func.min(Game.start),
+            func.max(Game.start)])).first()
+        middle = first + (last - first) / 2
+        urls = [
+            '/games?user_id=7&per_page=50',
+            '/games?started_after=%s&started_before=%s&sort_by=start' % (
+                middle.isoformat(), (middle + timedelta(days=1)).isoformat()),
+            '/games?sort_by=start&order=-1&per_page=50&cursor='
+        ]
+
+        print('Without indexes (%s games)' % (n_games,))
+        run(client, urls)
+
+        migrate(db.engine)
+        if db.engine.dialect.name == 'sqlite':
+            db.engine.execute('ANALYZE')
+
+        print('With indexes')
+        run(client, urls)
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Time loading games through ingest against one POST /games per game.
+
+Usage: python benchmarks/ingest_bench.py [n_games] [database_uri]
+
+Generates n_games (default 20000) finished two-a-side games between 200
+users as NDJSON, posts the first 500 of them one at a time, then loads all
+of them with ingest.ingest, and reports games per second for each."""
+import json
+import random
+import sys
+import time
+
+import common
+import api
+from ingest import ingest
+from models import db, User
+
+
+def game_lines(n_games, user_ids, seed=1):
+    rng = random.Random(seed)
+    for game in range(n_games):
+        players = [{ 'user': { 'id': user_id }, 'position': i % 2 + 1,
+            'scores': [] } for i, user_id in enumerate(rng.sample(user_ids, 4))]
+        winner = rng.randint(0, 1)
+        goals = [10, rng.randint(0, 9)]
+        if winner == 1:
+            goals.reverse()
+        for team, count in enumerate(goals):
+            for goal in range(count):
+                players[team * 2 + rng.randint(0, 1)]['scores'].append({
+                    'time': '2015-05-01T18:%02d:%02d' % (goal, team * 30),
+                    'own_goal': False })
+        yield json.dumps({
+            'start': '2015-05-01T18:00:00',
+            'teams': [{ 'name': 'red', 'players': players[:2] },
+                { 'name': 'blue', 'players': players[2:] }]
+        })
+
+
+def main():
+    n_games = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cleanup = common.setup_app(sys.argv[2] if len(sys.argv) > 2 else None)
+    try:
+        db.engine.execute(User.__table__.insert(),
+            [{ 'name': 'user%s' % (i,) } for i in range(200)])
+        user_ids = [row[0] for row in db.engine.execute('SELECT id FROM users')]
+        lines = list(game_lines(n_games, user_ids))
+
+        client = api.app.test_client()
+        posted = min(500, n_games)
+        started = time.time()
+        for line in lines[:posted]:
+            resp = client.post('/games', content_type='application/json',
+                data=line)
+            assert resp.status_code == 201
+        elapsed = time.time() - started
+        print('POST /games  %6d games  %7.0f games/s' % (posted,
+            posted / elapsed))
+
+        started = time.time()
+        summary = ingest(db.session, lines)
+        elapsed = time.time() - started
+        assert summary['created'] == n_games and not summary['errors']
+        print('ingest       %6d games  %7.0f games/s' % (n_games,
+            n_games / elapsed))
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
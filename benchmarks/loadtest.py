@@ -0,0 +1,383 @@
+"""Load test every route of the api and report latency and throughput.
+
+Usage: python benchmarks/loadtest.py [--users N] [--games N] [--requests N]
+           [--concurrency N] [--routes NAME,...] [--url URL | --database URI]
+           [--save FILE] [--compare FILE] [--tolerance FRACTION]
+
+Seeds users and a history of games through the api itself, then sends
+--requests requests to each route in ROUTES in turn from --concurrency
+threads, and prints each route's throughput and p50/p95/p99 latency.
+Requests go to the app in process, on a throwaway SQLite database unless
+--database is given, or over HTTP to a running server with --url.
+
+--save writes the results to a JSON file. --compare reads such a file and
+marks every route whose p95 latency grew by more than --tolerance (default
+0.2, i.e. 20%) since, exiting with status 1 if any did, so that a baseline
+saved from one release can be checked against the next on the same
+machine.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+try:
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+    from Queue import Queue, Empty
+except ImportError:
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse
+    from queue import Queue, Empty
+
+import common
+
+# Start times marking the games set aside for routes that use a game up
+SCORE_POOL = '2016-01-01T00:00:00'
+BATCH_POOL = '2016-02-01T00:00:00'
+DELETE_POOL = '2016-03-01T00:00:00'
+POOL_END = '2016-04-01T00:00:00'
+
+
+class LocalClient(object):
+    """Requests to the app in this process"""
+
+    def __init__(self):
+        import api
+        self.client = api.app.test_client()
+
+    def request(self, method, path, body=None, content_type=None):
+        """(status, body, headers with lowercase names) of a request"""
+        resp = self.client.open(path, method=method, data=body,
+            content_type=content_type)
+        return resp.status_code, resp.data, dict((name.lower(), value)
+            for name, value in resp.headers.items())
+
+
+class HttpClient(object):
+    """Requests over one keep-alive HTTP connection"""
+
+    def __init__(self, url):
+        url = urlparse(url)
+        self.connection = HTTPConnection(url.hostname, url.port or 80)
+
+    def request(self, method, path, body=None, content_type=None):
+        headers = {} if content_type is None else \
+            { 'Content-Type': content_type }
+        self.connection.request(method, path, body, headers)
+        resp = self.connection.getresponse()
+        return resp.status, resp.read(), dict((name.lower(), value)
+            for name, value in resp.getheaders())
+
+
+def game_json(rng, user_ids, start, goals=0):
+    """A two-a-side game between random users, with goals scored by random
+    players up to a random final score if goals is 10"""
+    players = [{ 'user': { 'id': user_id }, 'position': i % 2 + 1,
+        'scores': [] } for i, user_id in enumerate(rng.sample(user_ids, 4))]
+    points = [goals, rng.randint(0, 9) if goals == 10 else 0]
+    rng.shuffle(points)
+    for team, count in enumerate(points):
+        for goal in range(count):
+            players[team * 2 + rng.randint(0, 1)]['scores'].append({
+                'time': start[:11] + '18:%02d:%02d' % (goal, team * 30) })
+    return { 'start': start, 'teams': [
+        { 'name': 'red', 'players': players[:2] },
+        { 'name': 'blue', 'players': players[2:] }] }
+
+
+def list_games(client, query):
+    """Every game a /games listing returns, following its cursors"""
+    games = []
+    cursor = ''
+    while cursor is not None:
+        status, data, headers = client.request('GET',
+            '/games?per_page=500&cursor=%s&%s' % (cursor, query))
+        games.extend(json.loads(data))
+        cursor = headers.get('x-next-cursor')
+    return games
+
+
+def ingest(client, games):
+    """Create games through POST /games/ingest"""
+    for start in range(0, len(games), 5000):
+        status, data, headers = client.request('POST', '/games/ingest',
+            '\n'.join(json.dumps(game) for game in games[start:start + 5000]),
+            'application/x-ndjson')
+        assert status == 201, data
+
+
+def seed(client, n_users, n_games, n_requests, rng):
+    """Users, a history of finished and running games, and the games and
+    users set aside for the routes that use them up"""
+    run = '%x' % (int(time.time() * 1000),)
+    names = ['load-%s-%s' % (run, i) for i in range(n_users + n_requests)]
+    status, data, headers = client.request('POST', '/users',
+        json.dumps([{ 'name': name } for name in names]), 'application/json')
+    assert status == 201, data
+    user_ids = [result['user']['id'] for result in json.loads(data)['results']]
+    players, spare_users = user_ids[:n_users], user_ids[n_users:]
+
+    history = []
+    for i in range(n_games):
+        start = '2015-%02d-%02dT18:00:00' % (i % 12 + 1, i % 28 + 1)
+        history.append(game_json(rng, players, start,
+            10 if rng.random() < 0.8 else rng.randint(0, 9)))
+    # Five goals at most, one team at a time, for POST /games/<id>/score
+    history.extend(game_json(rng, players, SCORE_POOL)
+        for i in range(n_requests // 5 + 1))
+    history.extend(game_json(rng, players, BATCH_POOL)
+        for i in range(n_requests))
+    history.extend(game_json(rng, players, DELETE_POOL)
+        for i in range(n_requests))
+    ingest(client, history)
+
+    return {
+        'run': run,
+        'users': players,
+        'spare_users': spare_users,
+        'games': list_games(client, 'started_before=' + SCORE_POOL),
+        'score_pool': list_games(client, 'started_after=%s&started_before=%s'
+            % (SCORE_POOL, BATCH_POOL)),
+        'batch_pool': list_games(client, 'started_after=%s&started_before=%s'
+            % (BATCH_POOL, DELETE_POOL)),
+        'delete_pool': list_games(client, 'started_after=%s&started_before=%s'
+            % (DELETE_POOL, POOL_END))
+    }
+
+
+def player_ids(game):
+    return [[player['id'] for player in team['players']]
+        for team in game['teams']]
+
+
+def score_requests(data, rng, n):
+    """Goals spread over the score pool, taking turns between teams so no
+    game gets near 10"""
+    pool = data['score_pool']
+    requests = []
+    for i in range(n):
+        game = pool[i % len(pool)]
+        team = player_ids(game)[(i // len(pool)) % 2]
+        requests.append(('POST', '/games/%s/score' % (game['id'],),
+            json.dumps({ 'player_id': rng.choice(team) })))
+    return requests
+
+
+def batch_requests(data, rng, n):
+    requests = []
+    for game in data['batch_pool'][:n]:
+        red, blue = player_ids(game)
+        requests.append(('POST', '/games/%s/scores' % (game['id'],),
+            json.dumps([{ 'player_id': rng.choice(red) },
+                { 'player_id': rng.choice(blue) },
+                { 'player_id': rng.choice(blue), 'own_goal': True },
+                { 'player_id': rng.choice(red) }])))
+    return requests
+
+
+def rename_requests(data, rng, n):
+    requests = []
+    for i in range(n):
+        game = rng.choice(data['games'])
+        team = game['teams'][0]
+        requests.append(('PUT', '/games/%s' % (game['id'],),
+            json.dumps({ 'teams': [{ 'id': team['id'],
+                'name': 'red %s' % (i,) }] })))
+    return requests
+
+
+def ingest_requests(data, rng, n):
+    return [('POST', '/games/ingest', '\n'.join(json.dumps(game_json(rng,
+        data['users'], '2015-06-01T18:00:00', 10)) for game in range(10)))
+        for i in range(n)]
+
+
+def reads(path):
+    """Requests for path, filled in with a random game or user"""
+    def build(data, rng, n):
+        return [('GET', path % { 'game': rng.choice(data['games'])['id'],
+            'user': rng.choice(data['users']) }, None) for i in range(n)]
+    return build
+
+
+# (name, function building n requests as (method, path, body))
+ROUTES = [
+    ('list_games', reads('/games?per_page=50')),
+    ('list_games_cursor', reads('/games?per_page=50&cursor=')),
+    ('list_games_by_user', reads('/games?user_id=%(user)s')),
+    ('get_game', reads('/games/%(game)s')),
+    ('get_players', reads('/games/%(game)s/players')),
+    ('get_scores', reads('/games/%(game)s/scores')),
+    ('get_teams', reads('/games/%(game)s/teams')),
+    ('list_users', reads('/users?per_page=50')),
+    ('get_user', reads('/users/%(user)s')),
+    ('get_user_stats', reads('/users/%(user)s/stats')),
+    ('leaderboard', reads('/leaderboard')),
+    ('ratings', reads('/ratings')),
+    ('metrics', reads('/metrics')),
+    ('create_user', lambda data, rng, n: [('POST', '/users',
+        json.dumps({ 'name': 'new-%s-%s' % (data['run'], i) }))
+        for i in range(n)]),
+    ('put_user', lambda data, rng, n: [('PUT', '/users/%s'
+        % (rng.choice(data['users']),), json.dumps({ 'first_name':
+        'first %s' % (i,) })) for i in range(n)]),
+    ('create_game', lambda data, rng, n: [('POST', '/games',
+        json.dumps(game_json(rng, data['users'], '2015-06-01T18:00:00')))
+        for i in range(n)]),
+    ('ingest_games', ingest_requests),
+    ('make_score', score_requests),
+    ('make_scores', batch_requests),
+    ('update_game', rename_requests),
+    ('delete_game', lambda data, rng, n: [('DELETE', '/games/%s'
+        % (game['id'],), None) for game in data['delete_pool'][:n]]),
+    ('delete_user', lambda data, rng, n: [('DELETE', '/users/%s'
+        % (user_id,), None) for user_id in data['spare_users'][:n]])
+]
+
+
+def drive(make_client, requests, concurrency):
+    """Send requests from concurrency threads. Returns (seconds taken,
+    latency of each request, number of requests that failed)."""
+    queue = Queue()
+    for request in requests:
+        queue.put(request)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        client = make_client()
+        while True:
+            try:
+                method, path, body = queue.get_nowait()
+            except Empty:
+                return
+            content_type = None if body is None else \
+                ('application/x-ndjson' if path.endswith('/ingest')
+                    else 'application/json')
+            started = time.time()
+            try:
+                status, data, headers = client.request(method, path, body,
+                    content_type)
+            except Exception:
+                status = 500
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors.append((method, path, status))
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started, latencies, errors
+
+
+def compare(results, baseline, tolerance):
+    """Print how each route's p95 moved since baseline. Returns the names
+    of the routes that got slower by more than tolerance."""
+    slower = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = result['p95'] / before['p95'] - 1 if before['p95'] else 0
+        flag = ''
+        if change > tolerance:
+            slower.append(name)
+            flag = '  REGRESSION'
+        print('%-20s p95 %8.1fms -> %8.1fms  %+6.0f%%%s' % (name,
+            before['p95'] * 1000, result['p95'] * 1000, change * 100, flag))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=200,
+        help='requests per route (default 200)')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--routes', help='comma separated routes to run '
+        '(default all): ' + ', '.join(name for name, build in ROUTES))
+    parser.add_argument('--url', help='server to test, e.g. '
+        'http://127.0.0.1:5000')
+    parser.add_argument('--database', help='database URI to test in '
+        'process (default a throwaway SQLite file)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with results saved '
+        'earlier')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    routes = ROUTES
+    if args.routes is not None:
+        wanted = args.routes.split(',')
+        routes = [(name, build) for name, build in ROUTES if name in wanted]
+
+    cleanup = None
+    if args.url is not None:
+        make_client = lambda: HttpClient(args.url)
+    else:
+        cleanup = common.setup_app(args.database)
+        # Errors become 500 responses as they would from a server, rather
+        # than propagating with their request context, and session, kept
+        import api
+        api.app.config['TESTING'] = False
+        api.app.config['PROPAGATE_EXCEPTIONS'] = False
+        api.app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
+        make_client = LocalClient
+
+    rng = random.Random(args.seed)
+    results = {}
+    try:
+        started = time.time()
+        data = seed(make_client(), args.users, args.games, args.requests, rng)
+        print('seeded %s users and %s games in %.1fs' % (args.users,
+            args.games, time.time() - started))
+        print('%-20s %6s %6s %8s %9s %9s %9s' % ('route', 'n', 'errors',
+            'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+
+        for name, build in routes:
+            requests = build(data, rng, args.requests)
+            elapsed, latencies, errors = drive(make_client, requests,
+                args.concurrency)
+            results[name] = {
+                'requests': len(latencies),
+                'errors': len(errors),
+                'throughput': len(latencies) / elapsed,
+                'p50': common.percentile(latencies, 0.5),
+                'p95': common.percentile(latencies, 0.95),
+                'p99': common.percentile(latencies, 0.99)
+            }
+            r = results[name]
+            print('%-20s %6d %6d %8.1f %9.1f %9.1f %9.1f' % (name,
+                r['requests'], r['errors'], r['throughput'], r['p50'] * 1000,
+                r['p95'] * 1000, r['p99'] * 1000))
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({ 'settings': { 'users': args.users,
+                'games': args.games, 'requests': args.requests,
+                'concurrency': args.concurrency }, 'routes': results }, f,
+                indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline['routes'], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
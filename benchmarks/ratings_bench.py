@@ -0,0 +1,87 @@
+"""Time recomputing every rating from the game history.
+
+Usage: python benchmarks/ratings_bench.py [n_games] [n_users] [db_games]
+
+Replays a random in-memory history of n_games (default 1000000) two-a-side
+games between n_users (default 2000) users with ratings.replay, then
+times ratings.recompute_ratings end to end, reading and writing the
+database, on db_games (default 50000) of those games."""
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import common
+import ratings
+from models import db, User, Game, Team, Player
+
+
+def build_history(n_games, n_users, seed=1):
+    """A history in the form ratings.load_history gives, users numbered
+    from 0"""
+    rng = random.Random(seed)
+    user_index, games, sides, points = [], [], [], []
+
+    for game in range(n_games):
+        players = rng.sample(range(n_users), 4)
+        for slot, user in enumerate(players):
+            user_index.append(user)
+            games.append(game)
+            sides.append(slot // 2)
+        loser = rng.randint(0, 9)
+        points.append((10, loser) if rng.random() < 0.5 else (loser, 10))
+
+    return user_index, games, sides, points
+
+
+def seed_database(history, n_users):
+    """Insert the history as finished games, with Core executemany"""
+    user_index, games, sides, points = history
+    start = datetime(2015, 1, 1)
+
+    db.engine.execute(User.__table__.insert(),
+        [{ 'id': i + 1, 'name': 'user%s' % (i,) } for i in range(n_users)])
+    db.engine.execute(Game.__table__.insert(),
+        [{ 'id': game + 1, 'start': start + timedelta(minutes=game) }
+            for game in range(len(points))])
+    db.engine.execute(Team.__table__.insert(),
+        [{ 'id': game * 2 + side + 1, 'game_id': game + 1,
+            'name': ('red', 'blue')[side], 'points': points[game][side] }
+            for game in range(len(points)) for side in (0, 1)])
+    db.engine.execute(Player.__table__.insert(),
+        [{ 'id': row + 1, 'user_id': user_index[row] + 1,
+            'game_id': games[row] + 1,
+            'team_id': games[row] * 2 + sides[row] + 1,
+            'position': row % 2 + 1 }
+            for row in range(len(games))])
+
+
+def main():
+    n_games = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    n_users = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    db_games = int(sys.argv[3]) if len(sys.argv) > 3 else 50000
+
+    history = build_history(n_games, n_users)
+    started = time.time()
+    ratings.replay(*(history + (n_users,)))
+    print('replay of %s games between %s users: %.2fs' % (n_games, n_users,
+        time.time() - started))
+
+    cleanup = common.setup_app()
+    try:
+        seed_database(build_history(db_games, n_users), n_users)
+
+        started = time.time()
+        ratings.recompute_ratings(db.engine, write=False)
+        read = time.time() - started
+
+        started = time.time()
+        ratings.recompute_ratings(db.engine)
+        print('recompute_ratings on %s stored games: %.2fs, %.2fs with '
+            'writing' % (db_games, read, time.time() - started))
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Compare the field list serializers with the old per-object serialize
+properties.
+
+Usage: python benchmarks/serialize_bench.py [n_games]
+
+Builds n_games (default 10000) finished games in memory, 8 players each,
+then times serializing and encoding them both ways. The two outputs are
+checked to be byte-identical before any timing is reported."""
+import gc
+import sys
+import time
+from datetime import datetime, date, timedelta
+
+import common
+from flask import json
+from models import User, Game, Team, Player, Score
+from serializers import dumps, encode_games, serialize_games
+
+
+def legacy_user(user):
+    return {
+        'id': user.id,
+        'name': user.name,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'birthday': user.birthday.strftime('%m/%d/%Y') if user.birthday is not None\
+                else None,
+        'email': user.email
+    }
+
+
+def legacy_game(game):
+    """Game.serialize as it was before the serializers module"""
+    teams = []
+    for team in game.teams:
+        t = {
+            'id': team.id,
+            'name': team.name,
+            'players': []
+        }
+        for player in team.players:
+            p = {
+                'id': player.id,
+                'position': player.position,
+                'user': legacy_user(player.user),
+                'scores': []
+            }
+            t['players'].append(p)
+            for score in player.scores:
+                p['scores'].append({
+                    'id': score.id,
+                    'time': score.time.strftime('%m/%d/%Y %H:%M:%S') if score.time is not None\
+                        else None,
+                    'own_goal': score.own_goal
+                })
+
+        teams.append(t)
+
+    return {
+        'id': game.id,
+        'start': game.start.strftime('%m/%d/%Y %H:%M:%S') if game.start is not None\
+                else None,
+        'end': game.end.strftime('%m/%d/%Y %H:%M:%S') if game.end is not None\
+                else None,
+        'teams': teams
+    }
+
+
+def build_games(n_games):
+    users = [User(id=i, name='user%s' % (i,), first_name='First', last_name='Last',
+            birthday=date(1985, 4, 3), email='user%s@example.com' % (i,))
+            for i in range(1, 41)]
+
+    games = []
+    ids = { 'team': 0, 'player': 0, 'score': 0 }
+    start = datetime(2015, 1, 1)
+    for i in range(n_games):
+        g = Game(id=i + 1, start=start + timedelta(minutes=i * 7),
+                end=start + timedelta(minutes=i * 7 + 5))
+        for t_index, name in enumerate(['red', 'blue']):
+            ids['team'] += 1
+            t = Team(id=ids['team'], name=name)
+            g.teams.append(t)
+            for position in range(1, 5):
+                ids['player'] += 1
+                user = users[(i + t_index * 4 + position) % len(users)]
+                p = Player(id=ids['player'], position=position, user=user,
+                        user_id=user.id)
+                t.players.append(p)
+                goals = [3, 3, 2, 2][position - 1] if t_index == 0 else 1
+                for k in range(goals):
+                    ids['score'] += 1
+                    p.scores.append(Score(id=ids['score'], own_goal=False,
+                            time=g.start + timedelta(seconds=k * 30)))
+        games.append(g)
+    return games
+
+
+def timed(f):
+    started = time.time()
+    result = f()
+    return result, time.time() - started
+
+
+def main():
+    n_games = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    games = build_games(n_games)
+
+    # Garbage collection passes over this many objects swamp the timings
+    gc.disable()
+    with common.api.app.app_context():
+        old, old_time = timed(lambda: json.dumps([legacy_game(g) for g in games]))
+        dicts, dicts_time = timed(lambda: dumps(serialize_games(games)))
+        new, new_time = timed(lambda: '[' + ', '.join(encode_games(games)) + ']')
+    gc.enable()
+
+    assert old == dicts, 'serialize_games output differs from the legacy properties'
+    assert old == new, 'encode_games output differs from the legacy properties'
+
+    print('%s games, %s bytes of JSON' % (n_games, len(new)))
+    print('%-34s %8.3fs' % ('serialize properties + json.dumps', old_time))
+    print('%-34s %8.3fs %6.2fx' % ('serialize_games + dumps', dicts_time,
+        old_time / dicts_time))
+    print('%-34s %8.3fs %6.2fx' % ('encode_games', new_time,
+        old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
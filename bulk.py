@@ -0,0 +1,106 @@
+"""Helpers for writing many rows at once with SQLAlchemy Core.
+
+The ORM inserts rows one statement at a time so that it can read back each
+generated primary key. Bulk writers instead reserve their keys up front with
+allocate_ids, fill in the foreign keys themselves, and send each table's
+rows as one executemany, or as a COPY on PostgreSQL with copy_rows.
+"""
+from sqlalchemy import false, func, select, text
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+def allocate_ids(connection, table, count):
+    """Reserve count primary keys for table, returned in ascending order.
+
+    PostgreSQL hands them out from the table's sequence, so they never clash
+    with anybody else's inserts. Other databases continue from the largest
+    id in the table, which is only safe while nobody else is inserting into
+    it, as SQLite ensures once the transaction has written; callers should
+    be ready to retry on an IntegrityError."""
+    if count == 0:
+        return []
+
+    if connection.dialect.name == 'postgresql':
+        rows = connection.execute(text("SELECT nextval('%s_id_seq') "
+            "FROM generate_series(1, :count)" % (table.name,)), count=count)
+        return sorted(row[0] for row in rows)
+
+    last = connection.execute(select([func.max(table.c.id)])).scalar() or 0
+    return list(range(last + 1, last + 1 + count))
+
+
+def lock_for_write(connection, table):
+    """On SQLite, take the database's write lock for the rest of the
+    transaction, by way of an UPDATE of table that changes nothing.
+
+    A transaction that reads the largest ids before it has written can
+    otherwise read the same ones as another writer, and clash with it when
+    it inserts."""
+    if connection.dialect.name == 'sqlite':
+        connection.execute(table.update().where(false()).values(
+            id=table.c.id))
+
+
+def lock_rows(connection, table, ids):
+    """Lock table's rows with the given ids for the rest of the transaction,
+    with SELECT ... FOR UPDATE. SQLite has no row locks, so there this takes
+    the database's write lock instead (see lock_for_write)."""
+    if connection.dialect.name == 'sqlite':
+        lock_for_write(connection, table)
+    else:
+        connection.execute(select([table.c.id])\
+            .where(table.c.id.in_(ids))\
+            .with_for_update())
+
+
+def insert_rows(connection, table, rows):
+    """Insert rows, a list of dicts with the same keys, as one executemany"""
+    if len(rows) > 0:
+        connection.execute(table.insert(), rows)
+
+
+def copy_value(value):
+    """value as a field of COPY's CSV format: unquoted empty for NULL,
+    anything else quoted"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif isinstance(value, float):
+        value = repr(value)
+    elif hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    elif not isinstance(value, (str, type(u''))):
+        value = str(value)
+    return '"%s"' % (value.replace('"', '""'),)
+
+
+def copy_rows(connection, table, rows):
+    """Insert rows like insert_rows, streaming them through COPY FROM STDIN
+    on PostgreSQL, which skips parsing and planning an INSERT per row"""
+    if len(rows) == 0:
+        return
+    if connection.dialect.name != 'postgresql':
+        insert_rows(connection, table, rows)
+        return
+
+    columns = sorted(rows[0])
+    buf = StringIO()
+    for row in rows:
+        line = ','.join(copy_value(row[column]) for column in columns) + '\n'
+        # Python 2 strings are bytes, and COPY reads UTF-8
+        buf.write(line if isinstance(line, str) else line.encode('utf-8'))
+    buf.seek(0)
+
+    preparer = connection.dialect.identifier_preparer
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (
+            preparer.format_table(table), ', '.join(
+                preparer.quote(column) for column in columns)), buf)
+    finally:
+        cursor.close()
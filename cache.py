@@ -0,0 +1,109 @@
+"""In-process cache for the JSON of finished games.
+
+A finished game practically never changes, so once its JSON has been
+written it can be served from memory instead of reloading and
+reserializing the game graph. Entries are keyed by game id and format, and
+carry the version of the game they were made from (see models.touch). A
+lookup for any other version is a miss, so a stale entry is never served,
+even by a worker that never saw the write that changed the game.
+
+The cache holds a bounded number of entries, evicting the least recently
+used. An optional shared backend, anything with get, set and delete like
+werkzeug.contrib.cache's MemcachedCache or RedisCache, sits behind it so
+several workers can share what they have serialized.
+"""
+import threading
+from collections import OrderedDict
+
+# Formats the api caches a game's JSON in
+FORMATS = ('list', 'pretty')
+
+
+class ResponseCache(object):
+    """LRU cache of serialized rows, keyed by (id, format) and checked
+    against the row's version.
+
+    cacheable decides whether a loaded row may be cached at all. hits,
+    misses and evictions count lookups served, lookups not served and
+    entries dropped to make room."""
+
+    def __init__(self, capacity, cacheable, backend=None, prefix='game'):
+        self.capacity = capacity
+        self.cacheable = cacheable
+        self.backend = backend
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _backend_key(self, object_id, fmt):
+        return '%s:%s:%s' % (self.prefix, object_id, fmt)
+
+    def get(self, object_id, version, fmt):
+        """Cached text for the given version of a row, or None"""
+        key = (object_id, fmt)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] == version:
+                # Reinsert to mark as most recently used
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+
+        if self.backend is not None:
+            entry = self.backend.get(self._backend_key(object_id, fmt))
+            if entry is not None and entry[0] == version:
+                self._store(key, entry)
+                with self._lock:
+                    self.hits += 1
+                return entry[1]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, object_id, version, fmt, text):
+        """Cache text as the given version of a row"""
+        entry = (version, text)
+        self._store((object_id, fmt), entry)
+
+        if self.backend is not None:
+            self.backend.set(self._backend_key(object_id, fmt), entry)
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, object_id):
+        """Drop every cached format of a row"""
+        with self._lock:
+            for fmt in FORMATS:
+                self._entries.pop((object_id, fmt), None)
+
+        if self.backend is not None:
+            for fmt in FORMATS:
+                self.backend.delete(self._backend_key(object_id, fmt))
+
+    def clear(self):
+        """Drop everything held in process and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Counters and current size"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'capacity': self.capacity
+            }
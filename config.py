@@ -0,0 +1,157 @@
+"""Settings for the app and its database engine, picked by environment.
+
+FOOSBALL_PROFILE names one of PROFILES (development by default), which is
+laid over DEFAULTS. Single settings can then be overridden:
+
+    FOOSBALL_DATABASE_URI      SQLALCHEMY_DATABASE_URI
+    FOOSBALL_DEBUG             DEBUG (1/0)
+    FOOSBALL_POOL_SIZE         connections kept open
+    FOOSBALL_MAX_OVERFLOW      extra connections opened when they are all busy
+    FOOSBALL_POOL_TIMEOUT      seconds to wait for a free connection
+    FOOSBALL_POOL_RECYCLE      seconds after which a connection is reopened
+    FOOSBALL_POOL_PRE_PING     test connections as they are checked out (1/0)
+    FOOSBALL_SQLITE_<PRAGMA>   a SQLite pragma, e.g. FOOSBALL_SQLITE_JOURNAL_MODE
+
+The pool settings are Flask-SQLAlchemy's and apply to SQLite as well as
+PostgreSQL: a SQLite file database normally opens a connection for every
+request, and with a pool size it keeps them open instead. SQLite pragmas
+are run on every new connection.
+"""
+import os
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import QueuePool
+
+DEFAULTS = {
+    'SQLALCHEMY_DATABASE_URI': 'postgresql+psycopg2://danny@localhost/testdb',
+    'DEBUG': True,
+    'SQLALCHEMY_POOL_SIZE': None,
+    'SQLALCHEMY_MAX_OVERFLOW': None,
+    'SQLALCHEMY_POOL_TIMEOUT': None,
+    'SQLALCHEMY_POOL_RECYCLE': None,
+    'DATABASE_POOL_PRE_PING': False,
+    'SQLITE_PRAGMAS': {}
+}
+
+PROFILES = {
+    # As the app has always run
+    'development': {},
+    # PostgreSQL behind several workers: a bounded pool per worker, and
+    # connections the database or a proxy dropped are replaced unseen
+    'production': {
+        'DEBUG': False,
+        'SQLALCHEMY_POOL_SIZE': 10,
+        'SQLALCHEMY_MAX_OVERFLOW': 20,
+        'SQLALCHEMY_POOL_TIMEOUT': 10,
+        'SQLALCHEMY_POOL_RECYCLE': 1800,
+        'DATABASE_POOL_PRE_PING': True
+    },
+    # SQLite on one machine: readers don't wait for the writer (WAL), a
+    # commit syncs the log rather than the database, and connections stay
+    # open with their page cache and memory map warm
+    'single-box': {
+        'DEBUG': False,
+        'SQLALCHEMY_POOL_SIZE': 5,
+        'SQLITE_PRAGMAS': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 268435456,
+            'cache_size': -65536,
+            'busy_timeout': 5000,
+            'temp_store': 'MEMORY'
+        }
+    },
+    # Throwaway SQLite databases, for tests and benchmarks: nothing needs to
+    # survive a crash, so nothing is synced
+    'testing': {
+        'SQLITE_PRAGMAS': {
+            'journal_mode': 'MEMORY',
+            'synchronous': 'OFF'
+        }
+    }
+}
+
+PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size',
+    'busy_timeout', 'temp_store')
+
+ENVIRONMENT = [
+    ('FOOSBALL_DATABASE_URI', 'SQLALCHEMY_DATABASE_URI', str),
+    ('FOOSBALL_DEBUG', 'DEBUG', lambda value: value == '1'),
+    ('FOOSBALL_POOL_SIZE', 'SQLALCHEMY_POOL_SIZE', int),
+    ('FOOSBALL_MAX_OVERFLOW', 'SQLALCHEMY_MAX_OVERFLOW', int),
+    ('FOOSBALL_POOL_TIMEOUT', 'SQLALCHEMY_POOL_TIMEOUT', int),
+    ('FOOSBALL_POOL_RECYCLE', 'SQLALCHEMY_POOL_RECYCLE', int),
+    ('FOOSBALL_POOL_PRE_PING', 'DATABASE_POOL_PRE_PING',
+        lambda value: value == '1')
+]
+
+
+def profile(name):
+    """The settings of a named profile, over DEFAULTS"""
+    if name not in PROFILES:
+        raise ValueError('profile must be one of %s' % (sorted(PROFILES),))
+
+    settings = dict(DEFAULTS)
+    settings.update(PROFILES[name])
+    settings['SQLITE_PRAGMAS'] = dict(settings['SQLITE_PRAGMAS'])
+    return settings
+
+
+def from_environ(environ=None):
+    """The settings chosen by FOOSBALL_* environment variables"""
+    environ = os.environ if environ is None else environ
+    settings = profile(environ.get('FOOSBALL_PROFILE', 'development'))
+
+    for variable, key, convert in ENVIRONMENT:
+        if variable in environ:
+            settings[key] = convert(environ[variable])
+
+    for pragma in PRAGMAS:
+        variable = 'FOOSBALL_SQLITE_' + pragma.upper()
+        if variable in environ:
+            settings['SQLITE_PRAGMAS'][pragma] = environ[variable]
+
+    return settings
+
+
+def engine_options(config, info, options):
+    """Adjust the create_engine options Flask-SQLAlchemy built for the app.
+
+    A SQLite file database with a pool size gets a real pool, shared between
+    threads, in place of opening a connection per checkout."""
+    if info.drivername.startswith('sqlite') and \
+            config.get('SQLALCHEMY_POOL_SIZE') and \
+            info.database not in (None, '', ':memory:'):
+        options['poolclass'] = QueuePool
+        options.setdefault('connect_args', {})['check_same_thread'] = False
+
+
+def prepare_engine(engine, config):
+    """Install the pre-ping and SQLite pragmas config asks for on a new
+    engine. Engines that were already prepared are left alone."""
+    if getattr(engine, 'foosball_prepared', False):
+        return
+    engine.foosball_prepared = True
+
+    pragmas = config.get('SQLITE_PRAGMAS') or {}
+    if engine.dialect.name == 'sqlite' and len(pragmas) > 0:
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in PRAGMAS:
+                if pragma in pragmas:
+                    cursor.execute('PRAGMA %s = %s' % (pragma,
+                        pragmas[pragma]))
+            cursor.close()
+
+    if config.get('DATABASE_POOL_PRE_PING'):
+        @event.listens_for(engine, 'checkout')
+        def ping(dbapi_connection, connection_record, connection_proxy):
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            except engine.dialect.dbapi.Error:
+                # The pool throws this connection away and tries another
+                raise DisconnectionError()
+            finally:
+                cursor.close()
@@ -0,0 +1,189 @@
+"""Synthetic users and games, for benchmarks and profiling at scale.
+
+Everything is drawn from a random.Random seeded with seed, so the same
+arguments always give the same users and games. Games are two teams of one
+to four players each, played in order from a start time. Goals go to one
+side or the other until a team reaches 10 points, with the occasional own
+goal counting for the other team, so every game passes validate_game. A
+few of the latest games are left running.
+
+populate writes them straight into the tables a chunk at a time: ids are
+reserved up front (bulk.allocate_ids) and each table's rows go in with one
+executemany, or a COPY on PostgreSQL. User stats and ratings are worked out
+afterwards from the whole history, with stats.rebuild_stats and
+ratings.recompute_ratings, rather than game by game.
+"""
+import random
+from datetime import datetime, timedelta
+
+from bulk import allocate_ids, copy_rows
+from models import User, Game, Team, Player, Score
+from ratings import recompute_ratings
+from stats import rebuild_stats
+from validation import tally_points
+
+CHUNK_SIZE = 1000
+START = datetime(2015, 1, 1, 9, 0)
+FIRST_NAMES = ['Alex', 'Sam', 'Jo', 'Chris', 'Pat', 'Robin', 'Kim', 'Lee',
+    'Max', 'Dana', 'Jamie', 'Terry', 'Morgan', 'Casey', 'Drew', 'Jesse']
+LAST_NAMES = ['Smith', 'Jones', 'Brown', 'Garcia', 'Miller', 'Davis',
+    'Lopez', 'Wilson', 'Clark', 'Young', 'Hall', 'King', 'Wright', 'Scott']
+# Chance that a goal is an own goal
+OWN_GOAL_RATE = 0.04
+# Share of the games, the latest ones, still being played
+RUNNING_RATE = 0.01
+
+
+def generate_users(n_users, seed=1, prefix='user'):
+    """n_users users as rows for the users table, without ids. Names are
+    prefix followed by a number, so pick a prefix no existing user has."""
+    rng = random.Random(seed)
+    users = []
+    for i in range(n_users):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        users.append({
+            'name': '%s%s' % (prefix, i),
+            'first_name': first,
+            'last_name': last,
+            'birthday': (datetime(1960, 1, 1) +
+                timedelta(days=rng.randint(0, 365 * 40))).date(),
+            'email': '%s.%s%s@example.com' % (first.lower(), last.lower(), i)
+        })
+    return users
+
+
+def generate_game(rng, user_ids, start, running=False):
+    """One game in the shape of validation.resolve_game"""
+    sizes = [rng.randint(1, 4), rng.randint(1, 4)]
+    # Some users play far more than others
+    chosen = []
+    while len(chosen) < sum(sizes):
+        user_id = user_ids[int(len(user_ids) * rng.random() ** 2)]
+        if user_id not in chosen:
+            chosen.append(user_id)
+
+    teams = []
+    for side, size in enumerate(sizes):
+        positions = sorted(rng.sample([1, 2, 3, 4], size))
+        teams.append({ 'id': None, 'name': ('red', 'blue')[side],
+            'players': [{ 'id': None, 'user_id': user_id,
+                'position': position, 'scores': [] }
+                for user_id, position in zip(chosen[:size], positions)] })
+        chosen = chosen[size:]
+
+    # The stronger side wins more of the goals
+    strength = rng.uniform(0.3, 0.7)
+    # Short of a team reaching 10
+    goals = rng.randint(0, 9) if running else None
+    points = [0, 0]
+    time = start
+    while max(points) < 10 and goals != 0:
+        time += timedelta(seconds=rng.randint(10, 90))
+        side = 0 if rng.random() < strength else 1
+        own_goal = rng.random() < OWN_GOAL_RATE
+        # An own goal is scored by the side that doesn't get the point
+        scorer = rng.choice(teams[1 - side if own_goal else side]['players'])
+        scorer['scores'].append({ 'id': None, 'time': time,
+            'own_goal': own_goal })
+        points[side] += 1
+        if goals is not None:
+            goals -= 1
+
+    return { 'id': None, 'start': start, 'teams': teams,
+        'end': None if running else time + timedelta(seconds=30) }
+
+
+def generate_games(n_games, user_ids, seed=1, start=START):
+    """Yield n_games games between user_ids, in the shape of
+    validation.resolve_game, starting in order from start"""
+    if len(user_ids) < 8:
+        raise ValueError('games need at least 8 users to pick from')
+    rng = random.Random(seed)
+    running_from = n_games - int(n_games * RUNNING_RATE)
+    for i in range(n_games):
+        start += timedelta(minutes=rng.randint(5, 60))
+        yield generate_game(rng, user_ids, start, i >= running_from)
+
+
+def write_games(connection, games):
+    """Insert games from generate_games with a COPY or executemany per
+    table. Stats and ratings are left alone. Returns the games' ids."""
+    game_ids = allocate_ids(connection, Game.__table__, len(games))
+    team_ids = iter(allocate_ids(connection, Team.__table__,
+        sum(len(game['teams']) for game in games)))
+    player_ids = iter(allocate_ids(connection, Player.__table__,
+        sum(len(team['players']) for game in games for team in game['teams'])))
+    score_ids = iter(allocate_ids(connection, Score.__table__,
+        sum(len(player['scores']) for game in games
+            for team in game['teams'] for player in team['players'])))
+
+    game_rows, team_rows, player_rows, score_rows = [], [], [], []
+    for game, game_id in zip(games, game_ids):
+        game_rows.append({ 'id': game_id, 'start': game['start'],
+            'end': game['end'], 'version': 1,
+            'updated': game['end'] or game['start'] })
+
+        for team, points in zip(game['teams'], tally_points(game)):
+            team_id = next(team_ids)
+            team_rows.append({ 'id': team_id, 'game_id': game_id,
+                'name': team['name'], 'points': points })
+
+            for player in team['players']:
+                player_id = next(player_ids)
+                player_rows.append({ 'id': player_id,
+                    'user_id': player['user_id'], 'game_id': game_id,
+                    'team_id': team_id, 'position': player['position'],
+                    'rating_change': None })
+
+                for score in player['scores']:
+                    score_rows.append({ 'id': next(score_ids),
+                        'player_id': player_id, 'game_id': game_id,
+                        'team_id': team_id, 'time': score['time'],
+                        'own_goal': score['own_goal'] })
+
+    copy_rows(connection, Game.__table__, game_rows)
+    copy_rows(connection, Team.__table__, team_rows)
+    copy_rows(connection, Player.__table__, player_rows)
+    copy_rows(connection, Score.__table__, score_rows)
+    return game_ids
+
+
+def write_users(connection, users):
+    """Insert users from generate_users. Returns their ids."""
+    user_ids = allocate_ids(connection, User.__table__, len(users))
+    copy_rows(connection, User.__table__, [dict(user, id=user_id,
+        rating=1500.0, version=1, updated=START)
+        for user, user_id in zip(users, user_ids)])
+    return user_ids
+
+
+def populate(engine, n_users, n_games, seed=1, prefix='user', start=START,
+        chunk_size=CHUNK_SIZE, progress=None):
+    """Add n_users generated users and n_games games between them, then
+    rebuild every user's stats and rating from all of the games.
+
+    Each chunk of chunk_size games is a transaction of its own. progress,
+    if given, is called with the number of games written after each.
+    Returns the new users' ids."""
+    users = generate_users(n_users, seed, prefix)
+    user_ids = []
+    for offset in range(0, len(users), chunk_size):
+        with engine.begin() as connection:
+            user_ids.extend(write_users(connection,
+                users[offset:offset + chunk_size]))
+
+    written = 0
+    chunk = []
+    for game in generate_games(n_games, user_ids, seed, start):
+        chunk.append(game)
+        if len(chunk) == chunk_size or written + len(chunk) == n_games:
+            with engine.begin() as connection:
+                write_games(connection, chunk)
+            written += len(chunk)
+            chunk = []
+            if progress is not None:
+                progress(written)
+
+    rebuild_stats(engine)
+    recompute_ratings(engine)
+    return user_ids
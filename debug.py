@@ -3,14 +3,12 @@ from datetime import datetime
 from flask import Flask, request, session, g, redirect, url_for, abort, \
         render_template, flash, jsonify, make_response
 from models import db, User, Game, Team, Player, Score
+from config import from_environ
 
 # create our application
 app = Flask(__name__)
 
-app.config.update(dict(
-    SQLALCHEMY_DATABASE_URI='postgresql+psycopg2://danny@localhost/testdb',
-    DEBUG=True
-))
+app.config.update(from_environ())
 
 db.app = app 
 db.init_app(app)
\ No newline at end of file
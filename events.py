@@ -0,0 +1,189 @@
+"""Live game events, pushed to clients as Server-Sent Events.
+
+Scoreboards follow a game with GET /games/<id>/events instead of polling.
+The views that change a game publish an event once their transaction has
+committed:
+
+- goal: a new score, with every team's points after it
+- update: the whole game, after a PUT (players, names or scores changed)
+- end: the game is over, with the final points
+- delete: the game is gone, and its streams end
+
+Each event is encoded once, as the text of an SSE message, and the same
+text is handed to every listener through a bounded queue, so a write
+reaches any number of listeners without further database reads. A
+listener that falls behind by a full queue is dropped rather than holding
+up the writer; browsers reconnect on their own.
+
+EventHub fans out within one process. With several workers, give it a
+broker, anything with publish(message) and listen(callback) like
+RedisBroker below, and every message goes through the broker so that
+listeners on any worker see writes made on any other.
+"""
+import json
+import threading
+
+try:
+    from Queue import Queue, Full, Empty
+except ImportError:
+    from queue import Queue, Full, Empty
+
+# Seconds between the comments that keep idle streams open through proxies
+KEEPALIVE = 15
+
+
+def encode_event(event, data):
+    """The text of one SSE message"""
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+
+class Listener(object):
+    """One open stream: the queue its messages wait in"""
+
+    def __init__(self, game_id, size):
+        self.game_id = game_id
+        self.queue = Queue(size)
+        self.dropped = False
+
+    def messages(self, keepalive=KEEPALIVE):
+        """Messages as they arrive, with a keepalive comment after each
+        quiet spell. Ends after the game's delete event, or if the listener
+        was dropped for falling behind."""
+        while not self.dropped:
+            try:
+                text = self.queue.get(timeout=keepalive)
+            except Empty:
+                yield ': keepalive\n\n'
+                continue
+            if text is None:
+                return
+            yield text
+            if text.startswith('event: delete\n'):
+                return
+
+
+class EventHub(object):
+    """Publish game events to the listeners of each game.
+
+    queue_size bounds the messages waiting for any one listener. published,
+    delivered and dropped count messages published, messages queued for
+    listeners and listeners dropped for falling behind."""
+
+    def __init__(self, queue_size=100, broker=None):
+        self.queue_size = queue_size
+        self.broker = broker
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self._listening = False
+
+    def subscribe(self, game_id):
+        """Start listening to a game. Pass the listener to unsubscribe once
+        its stream is closed."""
+        if self.broker is not None:
+            self._listen()
+
+        listener = Listener(game_id, self.queue_size)
+        with self._lock:
+            self._listeners.setdefault(game_id, set()).add(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            listeners = self._listeners.get(listener.game_id, set())
+            listeners.discard(listener)
+            if len(listeners) == 0:
+                self._listeners.pop(listener.game_id, None)
+
+    def publish(self, game_id, event, data):
+        """Send an event to everybody listening to a game"""
+        text = encode_event(event, data)
+        with self._lock:
+            self.published += 1
+
+        if self.broker is None:
+            self.deliver(game_id, text)
+        else:
+            self.broker.publish(json.dumps([game_id, text]))
+
+    def deliver(self, game_id, text):
+        """Queue a message for this process's listeners to a game"""
+        with self._lock:
+            listeners = list(self._listeners.get(game_id, ()))
+
+        for listener in listeners:
+            try:
+                listener.queue.put_nowait(text)
+            except Full:
+                listener.dropped = True
+                self.unsubscribe(listener)
+                with self._lock:
+                    self.dropped += 1
+            else:
+                with self._lock:
+                    self.delivered += 1
+
+    def _listen(self):
+        """Start relaying the broker's messages, once"""
+        with self._lock:
+            if self._listening:
+                return
+            self._listening = True
+
+        def relay(message):
+            game_id, text = json.loads(message)
+            self.deliver(game_id, text)
+
+        thread = threading.Thread(target=self.broker.listen, args=(relay,))
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """End every open stream"""
+        with self._lock:
+            listeners = [listener for game in self._listeners.values()
+                for listener in game]
+            self._listeners.clear()
+
+        for listener in listeners:
+            try:
+                listener.queue.put_nowait(None)
+            except Full:
+                listener.dropped = True
+
+    def stats(self):
+        """Counters and current listeners"""
+        with self._lock:
+            return {
+                'published': self.published,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'listeners': sum(len(game)
+                    for game in self._listeners.values()),
+                'games': len(self._listeners)
+            }
+
+
+class RedisBroker(object):
+    """Broker for EventHub over a Redis pub/sub channel.
+
+    client is a redis.StrictRedis (or compatible) client. Every worker
+    publishing to and listening on the same channel sees every event."""
+
+    def __init__(self, client, channel='foosball:events'):
+        self.client = client
+        self.channel = channel
+
+    def publish(self, message):
+        self.client.publish(self.channel, message)
+
+    def listen(self, callback):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for item in pubsub.listen():
+            data = item['data']
+            if not isinstance(data, str):
+                data = data.decode('utf-8')
+            callback(data)
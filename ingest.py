@@ -0,0 +1,221 @@
+"""Loading many games at once from NDJSON, one game per line.
+
+For backfilling history, POST /games costs a request, a validation query,
+an ORM flush per row and a commit for every game. ingest instead reads the
+games a chunk at a time:
+
+- every line is parsed and checked with the same rules as POST /games,
+  looking up all of the chunk's users together
+- ids for the chunk's games, teams, players and scores are reserved up
+  front (bulk.allocate_ids), so each table is written with one executemany
+- the games' contributions to user stats and ratings are worked out in
+  memory and written with one executemany each
+- the chunk is committed once
+
+Lines that fail are reported by line number and skipped; the rest of their
+chunk is still written. Ids in the payloads are ignored, so games exported
+from GET /games can be loaded as new games.
+"""
+import json
+from datetime import datetime
+from sqlalchemy import bindparam, select
+from sqlalchemy.exc import IntegrityError
+from models import User, Game, Team, Player, Score
+from validation import resolve_game, validate_game, find_users, \
+    tally_points, unique_errors
+from stats import game_stats, finished_teams, add_stat, apply_stats_batch
+from ratings import rate_in_order
+from bulk import allocate_ids, insert_rows, lock_for_write
+
+CHUNK_SIZE = 500
+
+
+def without_ids(game_json):
+    """Drop the ids of a game payload's teams, players and scores"""
+    for team in game_json.get('teams') or []:
+        if isinstance(team, dict):
+            team.pop('id', None)
+            for player in team.get('players') or []:
+                if isinstance(player, dict):
+                    player.pop('id', None)
+                    for score in player.get('scores') or []:
+                        if isinstance(score, dict):
+                            score.pop('id', None)
+    return game_json
+
+
+def read_chunk(numbered):
+    """Parse and validate a chunk of (line number, text) pairs.
+
+    Returns (games, errors): the valid games as (line number, game) in the
+    shape of validation.resolve_game, and a list of messages for each line
+    number that failed."""
+    resolved = []
+    errors = {}
+
+    for number, text in numbered:
+        try:
+            game_json = json.loads(text)
+        except ValueError:
+            errors[number] = ['not valid JSON']
+            continue
+
+        if not isinstance(game_json, dict):
+            errors[number] = ['each line must be a game object']
+            continue
+
+        try:
+            game, problems = resolve_game(without_ids(game_json))
+        except (AttributeError, TypeError):
+            errors[number] = ['game is not in the expected shape']
+            continue
+        resolved.append((number, game, problems))
+
+    known_users = find_users(player['user_id']
+        for number, game, problems in resolved
+        for team in game['teams'] for player in team['players'])
+
+    games = []
+    for number, game, problems in resolved:
+        problems = unique_errors(problems + validate_game(game, known_users))
+        if len(problems) > 0:
+            errors[number] = problems
+        else:
+            games.append((number, game))
+
+    return games, errors
+
+
+def load_ratings(connection, user_ids, batch_size=500):
+    """{ user_id: rating } for the given users"""
+    users = User.__table__
+    user_ids = sorted(user_ids)
+    ratings = {}
+
+    for start in range(0, len(user_ids), batch_size):
+        rows = connection.execute(select([users.c.id, users.c.rating])\
+            .where(users.c.id.in_(user_ids[start:start + batch_size])))
+        ratings.update((row[0], row[1]) for row in rows)
+
+    return ratings
+
+
+def write_chunk(connection, games):
+    """Insert valid games from read_chunk, along with their effects on user
+    stats and ratings. Returns the new games' ids."""
+    lock_for_write(connection, Game.__table__)
+    game_ids = allocate_ids(connection, Game.__table__, len(games))
+    team_ids = iter(allocate_ids(connection, Team.__table__,
+        sum(len(game['teams']) for number, game in games)))
+    player_ids = iter(allocate_ids(connection, Player.__table__,
+        sum(len(team['players']) for number, game in games
+            for team in game['teams'])))
+    score_ids = iter(allocate_ids(connection, Score.__table__,
+        sum(len(player['scores']) for number, game in games
+            for team in game['teams'] for player in team['players'])))
+
+    # Rate the finished games in order, as if each had just ended
+    finished = [finished_teams(game) for number, game in games]
+    ratings = load_ratings(connection, set(user_id
+        for teams in finished if teams is not None
+        for points, user_ids in teams for user_id in user_ids))
+    before = dict(ratings)
+    changes = iter(rate_in_order([teams for teams in finished
+        if teams is not None], ratings))
+
+    game_rows, team_rows, player_rows, score_rows = [], [], [], []
+    stat_changes = {}
+
+    for (number, game), game_id, teams in zip(games, game_ids, finished):
+        game_rows.append({ 'id': game_id, 'start': game['start'],
+            'end': game['end'] })
+
+        change = next(changes) if teams is not None else None
+        for index, (team, points) in enumerate(zip(game['teams'],
+                tally_points(game))):
+            team_id = next(team_ids)
+            team_rows.append({ 'id': team_id, 'game_id': game_id,
+                'name': team['name'], 'points': points })
+
+            for player in team['players']:
+                player_id = next(player_ids)
+                player_rows.append({ 'id': player_id,
+                    'user_id': player['user_id'], 'game_id': game_id,
+                    'team_id': team_id, 'position': player['position'],
+                    'rating_change': None if change is None
+                        else (change if index == 0 else -change) })
+
+                for score in player['scores']:
+                    score_rows.append({ 'id': next(score_ids),
+                        'player_id': player_id, 'game_id': game_id,
+                        'team_id': team_id, 'time': score['time'],
+                        'own_goal': score['own_goal'] })
+
+        for user_id, change_by_field in game_stats(game).items():
+            for field, amount in change_by_field.items():
+                add_stat(stat_changes, user_id, field, amount)
+
+    insert_rows(connection, Game.__table__, game_rows)
+    insert_rows(connection, Team.__table__, team_rows)
+    insert_rows(connection, Player.__table__, player_rows)
+    insert_rows(connection, Score.__table__, score_rows)
+    apply_stats_batch(connection, stat_changes)
+
+    users = User.__table__
+    rated = [{ 'target': user_id, 'new_rating': rating }
+        for user_id, rating in sorted(ratings.items())
+        if rating != before[user_id]]
+    if len(rated) > 0:
+        connection.execute(users.update()\
+            .where(users.c.id == bindparam('target'))\
+            .values(rating=bindparam('new_rating'),
+                version=users.c.version + 1, updated=datetime.utcnow()),
+            rated)
+
+    return game_ids
+
+
+def numbered_chunks(lines, chunk_size):
+    """Split lines into chunks of (line number, text), skipping blank
+    lines but counting them"""
+    chunk = []
+    for number, line in enumerate(lines, 1):
+        if line.strip() == '':
+            continue
+        chunk.append((number, line))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def ingest(session, lines, chunk_size=CHUNK_SIZE, progress=None):
+    """Create a game from each line of NDJSON in lines.
+
+    Each chunk of chunk_size lines is validated, written and committed
+    together. progress, if given, is called with the running summary after
+    every chunk. Returns the summary: { 'created': number of games created,
+    'ids': their ids, 'errors': [(line number, messages)] }."""
+    summary = { 'created': 0, 'ids': [], 'errors': [] }
+
+    for chunk in numbered_chunks(lines, chunk_size):
+        games, errors = read_chunk(chunk)
+
+        if len(games) > 0:
+            try:
+                game_ids = write_chunk(session.connection(), games)
+                session.commit()
+            except IntegrityError:
+                # Somebody else took the ids we reserved, try again once
+                session.rollback()
+                game_ids = write_chunk(session.connection(), games)
+                session.commit()
+            summary['ids'].extend(game_ids)
+            summary['created'] += len(game_ids)
+
+        summary['errors'].extend(sorted(errors.items()))
+        if progress is not None:
+            progress(summary)
+
+    return summary
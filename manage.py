@@ -0,0 +1,205 @@
+"""Maintenance commands for the foosball database.
+
+Usage: python manage.py <command> [options]
+
+Commands act on the database in SQLALCHEMY_DATABASE_URI, or on the one
+given with --database.
+"""
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+
+import api
+from models import db
+from ingest import CHUNK_SIZE
+from datagen import CHUNK_SIZE as GENERATE_CHUNK_SIZE
+from purge import BATCH_SIZE
+from archive import BATCH_SIZE as ARCHIVE_BATCH_SIZE
+from ratings import K_FACTOR
+
+
+def command_migrate(args):
+    """Add missing tables, columns and indexes to an existing database"""
+    api.init_db()
+    from migrate import migrate
+    migrate(db.engine, log=print_line)
+
+
+def command_rebuild_stats(args):
+    """Recompute every user's stats from their games"""
+    api.init_db()
+    from stats import rebuild_stats
+    print_line('rebuilt stats for %s users' % (rebuild_stats(db.engine),))
+
+
+def command_recompute_ratings(args):
+    """Replay every finished game to rebuild all ratings"""
+    api.init_db()
+    from ratings import recompute_ratings
+    started = time.time()
+    ratings = recompute_ratings(db.engine, k_factor=args.k_factor,
+        write=not args.dry_run)
+    print_line('rated %s users in %.2fs' % (len(ratings),
+        time.time() - started))
+
+    if args.dry_run:
+        best = sorted(ratings.items(), key=lambda item: -item[1])[:10]
+        for user_id, rating in best:
+            print_line('%8s %8.1f' % (user_id, rating))
+
+
+def command_ingest(args):
+    """Create games from an NDJSON file, one game per line"""
+    api.init_db()
+    from ingest import ingest
+    started = time.time()
+
+    def progress(summary):
+        print_line('%s games created, %s lines failed, %.0f games/s' % (
+            summary['created'], len(summary['errors']),
+            summary['created'] / max(time.time() - started, 1e-6)))
+
+    lines = sys.stdin if args.path == '-' else open(args.path)
+    try:
+        summary = ingest(db.session, lines, args.chunk_size, progress)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+    for number, errors in summary['errors']:
+        print_line('line %s: %s' % (number, '; '.join(errors)))
+
+
+def command_generate(args):
+    """Add synthetic users and games, the same ones for the same seed"""
+    api.init_db()
+    from datagen import populate
+    started = time.time()
+
+    def progress(written):
+        print_line('%s games written, %.0f games/s' % (written,
+            written / max(time.time() - started, 1e-6)))
+
+    populate(db.engine, args.users, args.games, args.seed, args.prefix,
+        chunk_size=args.chunk_size, progress=progress)
+    print_line('generated %s users and %s games in %.1fs' % (args.users,
+        args.games, time.time() - started))
+
+
+def command_purge(args):
+    """Delete every game started in a time range, in batches"""
+    if args.started_after is None and args.started_before is None:
+        sys.exit('--started-after or --started-before is required')
+    api.init_db()
+    from dateutil.parser import parse
+    from purge import purge
+    started = time.time()
+    deleted = [0]
+
+    def progress(game_ids):
+        deleted[0] += len(game_ids)
+        print_line('%s games deleted, %.0f games/s' % (deleted[0],
+            deleted[0] / max(time.time() - started, 1e-6)))
+
+    count = purge(db.session,
+        parse(args.started_after) if args.started_after else None,
+        parse(args.started_before) if args.started_before else None,
+        args.batch_size, progress)
+    print_line('deleted %s games in %.1fs' % (count, time.time() - started))
+
+
+def command_archive(args):
+    """Move finished games older than a number of days to the archive
+    tables, in batches"""
+    api.init_db()
+    from archive import archive_games
+    days = args.older_than
+    if days is None:
+        days = api.app.config['ARCHIVE_AFTER_DAYS']
+    started = time.time()
+    archived = [0]
+
+    def progress(game_ids):
+        archived[0] += len(game_ids)
+        print_line('%s games archived, %.0f games/s' % (archived[0],
+            archived[0] / max(time.time() - started, 1e-6)))
+
+    count = archive_games(db.session,
+        datetime.utcnow() - timedelta(days=days), args.batch_size, progress)
+    print_line('archived %s games in %.1fs' % (count, time.time() - started))
+
+
+def print_line(message):
+    sys.stdout.write(message + '\n')
+
+
+COMMANDS = {
+    'archive': command_archive,
+    'generate': command_generate,
+    'ingest': command_ingest,
+    'migrate': command_migrate,
+    'purge': command_purge,
+    'rebuild-stats': command_rebuild_stats,
+    'recompute-ratings': command_recompute_ratings
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', help='database URI to work on')
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparsers.add_parser('migrate', help=command_migrate.__doc__)
+
+    ingest = subparsers.add_parser('ingest', help=command_ingest.__doc__)
+    ingest.add_argument('path', help="NDJSON file to read, or - for stdin")
+    ingest.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+        help='games written per transaction (default %s)' % (CHUNK_SIZE,))
+    subparsers.add_parser('rebuild-stats', help=command_rebuild_stats.__doc__)
+
+    generate = subparsers.add_parser('generate',
+        help=command_generate.__doc__)
+    generate.add_argument('--users', type=int, default=1000,
+        help='users to add (default 1000)')
+    generate.add_argument('--games', type=int, default=100000,
+        help='games to add between them (default 100000)')
+    generate.add_argument('--seed', type=int, default=1)
+    generate.add_argument('--prefix', default='user',
+        help="start of the new users' names (default user)")
+    generate.add_argument('--chunk-size', type=int,
+        default=GENERATE_CHUNK_SIZE, help='games written per transaction '
+        '(default %s)' % (GENERATE_CHUNK_SIZE,))
+
+    ratings = subparsers.add_parser('recompute-ratings',
+        help=command_recompute_ratings.__doc__)
+    ratings.add_argument('--k-factor', type=float, default=K_FACTOR,
+        help='rating points at stake in each game (default %g)' % (K_FACTOR,))
+    ratings.add_argument('--dry-run', action='store_true',
+        help="print the best ratings instead of saving them")
+
+    purge = subparsers.add_parser('purge', help=command_purge.__doc__)
+    purge.add_argument('--started-after',
+        help='delete games started at or after this time')
+    purge.add_argument('--started-before',
+        help='delete games started before this time')
+    purge.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+        help='games deleted per transaction (default %s)' % (BATCH_SIZE,))
+
+    archive = subparsers.add_parser('archive', help=command_archive.__doc__)
+    archive.add_argument('--older-than', type=int, metavar='DAYS',
+        help='archive games started more than DAYS days ago (default '
+        'ARCHIVE_AFTER_DAYS, %s)' % (api.app.config['ARCHIVE_AFTER_DAYS'],))
+    archive.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+        help='games archived per transaction (default %s)'
+        % (ARCHIVE_BATCH_SIZE,))
+
+    args = parser.parse_args(argv)
+    if args.database is not None:
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+
+    COMMANDS[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Per-endpoint request metrics, served in Prometheus text format.
+
+For every request the api records, under the name of the Flask endpoint
+that handled it:
+
+- how long the view took, up to the response being returned
+- the size of the response body, when it isn't streamed
+- how many SQL statements it ran and how long they took
+
+so that an endpoint making a query per row shows up as a high statement
+count rather than only as slowness. Recording is a few dict and list
+updates under a lock per request, plus two clock reads per statement, so
+it can stay on under load.
+
+Statements are counted with engine events on every engine, and charged to
+the request running on the same thread (or greenlet).
+"""
+import threading
+import time
+from bisect import bisect_left
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram(object):
+    """Counts of observations per bucket, with their sum"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last count is for observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        """Prometheus lines for the histogram, buckets cumulative"""
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels,
+                format_number(bound), total))
+        lines.append('%s_bucket{%s,le="+Inf"} %s' % (name, labels,
+            self.count))
+        lines.append('%s_sum{%s} %s' % (name, labels,
+            format_number(self.sum)))
+        lines.append('%s_count{%s} %s' % (name, labels, self.count))
+        return lines
+
+
+class EndpointMetrics(object):
+    """Everything recorded for one endpoint"""
+
+    def __init__(self):
+        self.responses = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.size = Histogram(SIZE_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.statement_seconds = 0.0
+
+
+class Metrics(object):
+    """Request metrics by endpoint.
+
+    Call start at the beginning of each request and finish with its
+    response. gauges and counters, if given, return { (name, help): value }
+    of extra values to report, read when the metrics are rendered. Counters
+    only ever go up, and get _total added to their names."""
+
+    def __init__(self, prefix='foosball', gauges=None, counters=None):
+        self.prefix = prefix
+        self.gauges = gauges
+        self.counters = counters
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        g.metrics_started = time.time()
+        g.metrics_statements = 0
+        g.metrics_statement_seconds = 0.0
+
+    def finish(self, endpoint, response):
+        started = getattr(g, 'metrics_started', None)
+        if started is None:
+            return
+        elapsed = time.time() - started
+        size = None if response.is_streamed else \
+            response.calculate_content_length()
+
+        with self._lock:
+            metrics = self._endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self._endpoints[endpoint] = EndpointMetrics()
+            metrics.responses[response.status_code] = \
+                metrics.responses.get(response.status_code, 0) + 1
+            metrics.latency.observe(elapsed)
+            if size is not None:
+                metrics.size.observe(size)
+            metrics.statements.observe(g.metrics_statements)
+            metrics.statement_seconds += g.metrics_statement_seconds
+
+    def endpoint(self, endpoint):
+        """What has been recorded for an endpoint, or None"""
+        with self._lock:
+            return self._endpoints.get(endpoint)
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def render(self):
+        """Everything recorded, in the Prometheus text format"""
+        p = self.prefix
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines = [
+                '# HELP %s_requests_total Requests handled.' % (p,),
+                '# TYPE %s_requests_total counter' % (p,)]
+            for endpoint, metrics in endpoints:
+                for status, count in sorted(metrics.responses.items()):
+                    lines.append('%s_requests_total{endpoint="%s",status="%s"}'
+                        ' %s' % (p, endpoint, status, count))
+
+            histograms = [
+                ('request_duration_seconds', 'latency',
+                    'Time spent in the view.'),
+                ('response_size_bytes', 'size',
+                    'Size of response bodies that were not streamed.'),
+                ('sql_statements', 'statements',
+                    'SQL statements run per request.')]
+            for name, attribute, text in histograms:
+                lines.append('# HELP %s_%s %s' % (p, name, text))
+                lines.append('# TYPE %s_%s histogram' % (p, name))
+                for endpoint, metrics in endpoints:
+                    lines.extend(getattr(metrics, attribute).lines(
+                        '%s_%s' % (p, name), 'endpoint="%s"' % (endpoint,)))
+
+            lines.append('# HELP %s_sql_duration_seconds_total Time spent '
+                'running SQL statements.' % (p,))
+            lines.append('# TYPE %s_sql_duration_seconds_total counter' % (p,))
+            for endpoint, metrics in endpoints:
+                lines.append('%s_sql_duration_seconds_total{endpoint="%s"} %s'
+                    % (p, endpoint, format_number(metrics.statement_seconds)))
+
+        if self.counters is not None:
+            for (name, text), value in sorted(self.counters().items()):
+                lines.append('# HELP %s_%s_total %s' % (p, name, text))
+                lines.append('# TYPE %s_%s_total counter' % (p, name))
+                lines.append('%s_%s_total %s' % (p, name, format_number(value)))
+
+        if self.gauges is not None:
+            for (name, text), value in sorted(self.gauges().items()):
+                lines.append('# HELP %s_%s %s' % (p, name, text))
+                lines.append('# TYPE %s_%s gauge' % (p, name))
+                lines.append('%s_%s %s' % (p, name, format_number(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+        executemany):
+    if has_request_context():
+        conn.info['metrics_started'] = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+        executemany):
+    started = conn.info.pop('metrics_started', None)
+    if started is not None and has_request_context() and \
+            hasattr(g, 'metrics_statements'):
+        g.metrics_statements += 1
+        g.metrics_statement_seconds += time.time() - started
+
+
+def count_statements():
+    """Charge the statements of every engine to the current request"""
+    if not event.contains(Engine, 'before_cursor_execute',
+            before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
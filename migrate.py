@@ -0,0 +1,90 @@
+"""Bring an existing database up to the current models.
+
+db.create_all only creates tables that are missing. migrate also adds
+columns and indexes that were declared on the models after a table was
+created, and fills in any derived data the new columns need. Every step
+checks what is already there first, so it is safe to run repeatedly.
+"""
+from sqlalchemy import and_, func, inspect, or_, select
+from sqlalchemy.schema import CreateColumn
+from models import db, Team, Score
+
+
+def add_missing_columns(engine):
+    """ALTER TABLE ... ADD COLUMN for every model column a table lacks.
+    Returns the names of the columns added, as table.column."""
+    inspector = inspect(engine)
+    added = []
+
+    for table in db.metadata.sorted_tables:
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            spec = CreateColumn(column).compile(dialect=engine.dialect)
+            engine.execute('ALTER TABLE %s ADD COLUMN %s' % (table.name, spec))
+            added.append('%s.%s' % (table.name, column.name))
+
+    return added
+
+
+def add_missing_indexes(engine):
+    """Create every index declared on the models that doesn't exist yet.
+    Returns the names of the indexes created."""
+    inspector = inspect(engine)
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+
+    return created
+
+
+def recount_points(engine):
+    """Recompute every team's running point total from the scores table"""
+    teams = Team.__table__
+    scores = Score.__table__
+
+    scored = select([func.count(scores.c.id)])\
+        .where(scores.c.team_id == teams.c.id)\
+        .where(or_(scores.c.own_goal == None, scores.c.own_goal == False))\
+        .as_scalar()
+    # Own goals by the other team in the game
+    gifted = select([func.count(scores.c.id)])\
+        .where(and_(scores.c.game_id == teams.c.game_id,
+            scores.c.team_id != teams.c.id, scores.c.own_goal == True))\
+        .as_scalar()
+
+    engine.execute(teams.update().values(points=scored + gifted))
+
+
+def migrate(engine, log=None):
+    """Create missing tables, columns and indexes, then backfill the derived
+    columns and tables that were just added"""
+    log = log or (lambda message: None)
+
+    existing = set(inspect(engine).get_table_names())
+    db.metadata.create_all(engine)
+
+    added = add_missing_columns(engine)
+    for name in added:
+        log('added column %s' % (name,))
+
+    for name in add_missing_indexes(engine):
+        log('created index %s' % (name,))
+
+    if 'teams.points' in added:
+        recount_points(engine)
+        log('recounted team points')
+
+    if 'users.rating' in added:
+        from ratings import recompute_ratings
+        log('rated %s users' % (len(recompute_ratings(engine)),))
+
+    if 'user_stats' not in existing:
+        from stats import rebuild_stats
+        log('rebuilt stats for %s users' % (rebuild_stats(engine),))
@@ -1,11 +1,30 @@
+from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Boolean, Column, Integer, String, Date, DateTime
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import relationship, backref 
+from sqlalchemy import Boolean, Column, Integer, Float, String, Date, DateTime, \
+	LargeBinary
+from sqlalchemy import ForeignKey, Index
+from sqlalchemy.orm import relationship, backref, subqueryload, joinedload
 from flask.ext.sqlalchemy import SQLAlchemy
+from serializers import serialize_user, serialize_game, serialize_team, \
+	serialize_player, serialize_score, serialize_user_stats
+
+from config import engine_options, prepare_engine
+
+class Database(SQLAlchemy):
+	"""Flask-SQLAlchemy, building the engine from the app's settings for
+	its pool and SQLite pragmas (see config.py)"""
+
+	def apply_driver_hacks(self, app, info, options):
+		SQLAlchemy.apply_driver_hacks(self, app, info, options)
+		engine_options(app.config, info, options)
+
+	def get_engine(self, app, bind=None):
+		engine = SQLAlchemy.get_engine(self, app, bind)
+		prepare_engine(engine, app.config)
+		return engine
 
 #Base = declarative_base()
-db = SQLAlchemy()
+db = Database()
 
 class User(db.Model):
 	__tablename__ = 'users'
@@ -16,76 +35,55 @@ class User(db.Model):
 	last_name = Column(String)
 	birthday = Column(Date)
 	email = Column(String)
+	# Elo rating, starting at ratings.INITIAL_RATING
+	rating = Column(Float, nullable=False, default=1500.0,
+		server_default='1500')
+	# Bumped by every change to the user, for ETags
+	version = Column(Integer, nullable=False, default=1, server_default='1')
+	updated = Column(DateTime, default=datetime.utcnow)
 
 	players = relationship("Player", backref="user")
 
 	@property 
 	def serialize(self):
 		"""Return User Object"""
-		return {
-			'id': self.id,
-			'name': self.name,
-			'first_name': self.first_name,
-			'last_name': self.last_name,
-			'birthday': self.birthday.strftime('%m/%d/%Y') if self.birthday is not None\
-					else None,
-			'email': self.email
-		}
+		return serialize_user(self)
 
 	def __repr__(self):
 		return ("<User(name='%s', first_name='%s', last_name='%s', "
 			"birthday='%s', email='%s')>") % (self.name, self.first_name, 
 			self.last_name, self.birthday, self.email)
 
+# GET /ratings, best first
+Index('ix_users_rating', User.rating.desc(), User.id)
+
 class Game(db.Model):
 	__tablename__ = 'games'
+	__table_args__ = (
+		# Start time ranges, and paging sorted by start
+		Index('ix_games_start_id', 'start', 'id'),
+	)
 	id = Column(Integer, primary_key=True)
 	start = Column(DateTime)
 	end = Column(DateTime)
+	# Bumped by every change to the game or anything in it, for ETags
+	version = Column(Integer, nullable=False, default=1, server_default='1')
+	updated = Column(DateTime, default=datetime.utcnow)
+	# Moved to archived_games, keeping only this row (see archive.py)
+	archived = Column(Boolean, nullable=False, default=False,
+		server_default='0')
 
 	players = relationship("Player", backref="game",
-				cascade="all, delete, delete-orphan")
+				cascade="all, delete, delete-orphan", order_by="Player.id")
 	teams = relationship("Team", backref="game",
-				cascade="all, delete, delete-orphan")
+				cascade="all, delete, delete-orphan", order_by="Team.id")
 	scores = relationship("Score", backref="game",
-				cascade="all, delete, delete-orphan")
+				cascade="all, delete, delete-orphan", order_by="Score.id")
 
 	@property 
 	def serialize(self):
-		teams = []
-		for team in self.teams:
-			t = { 
-				'id': team.id,
-				'name': team.name,
-				'players': [] 
-			}
-			for player in team.players:
-				p = {
-					'id': player.id,
-					'position': player.position,
-					'user': player.user.serialize,
-					'scores': []
-				}
-				t['players'].append(p)
-				for score in player.scores:
-					p['scores'].append({
-						'id': score.id,
-						'time': score.time.strftime('%m/%d/%Y %H:%M:%S') if score.time is not None\
-							else None,
-						'own_goal': score.own_goal 
-					})
-
-			teams.append(t)
-
 		"""Return full Game object"""
-		return {
-			'id': self.id,
-			'start': self.start.strftime('%m/%d/%Y %H:%M:%S') if self.start is not None\
-					else None,
-			'end': self.end.strftime('%m/%d/%Y %H:%M:%S') if self.end is not None\
-					else None,
-			'teams': teams
-		}
+		return serialize_game(self)
 
 	@property 
 	def serialize_players(self):
@@ -105,43 +103,46 @@ class Game(db.Model):
 class Team(db.Model):
 	__tablename__ = 'teams'
 	id = Column(Integer, primary_key=True)
-	game_id = Column(Integer, ForeignKey('games.id'))
+	game_id = Column(Integer, ForeignKey('games.id'), index=True)
 	name = Column(String, nullable=False)
+	# Running total of goals credited to this team, own goals included.
+	# Kept in step with the scores table by the api.
+	points = Column(Integer, nullable=False, default=0, server_default='0')
 
-	players = relationship("Player", backref="team")
-	scores = relationship("Score", backref="team")
+	players = relationship("Player", backref="team", order_by="Player.id")
+	scores = relationship("Score", backref="team", order_by="Score.id")
 
 	@property 
 	def serialize(self):
 		"""Return Team object"""
-		return {
-			'id': self.id,
-			'game_id': self.game_id
-		}
+		return serialize_team(self)
 
 	def __repr__(self):
 		return "<Team(game_id='%s')>" % self.game_id
 
 class Player(db.Model):
 	__tablename__ = 'players'
+	__table_args__ = (
+		# Games a user played in, as filtered on by GET /games?user_id=
+		Index('ix_players_user_id_game_id', 'user_id', 'game_id'),
+		# A game's players, in the order GET /games/<id>/players lists them
+		Index('ix_players_game_id_team_id_position', 'game_id', 'team_id',
+			'position'),
+	)
 	id = Column(Integer, primary_key=True)
 	user_id = Column(Integer, ForeignKey('users.id'))
 	game_id = Column(Integer, ForeignKey('games.id'))
-	team_id = Column(Integer, ForeignKey('teams.id'))
+	team_id = Column(Integer, ForeignKey('teams.id'), index=True)
 	position = Column(Integer)
+	# What the game did to the user's rating, or None if it isn't rated
+	rating_change = Column(Float)
 
-	scores = relationship("Score", backref="player")
+	scores = relationship("Score", backref="player", order_by="Score.id")
 
 	@property 
 	def serialize(self):
 		"""Return Player object"""
-		return {
-			'id': self.id,
-			'user_id': self.user_id,
-			'game_id': self.game_id,
-			'team_id': self.team_id,
-			'position': self.position
-		}
+		return serialize_player(self)
 
 	def __repr__(self):
 		return ("<Player(user_id='%s', game_id='%s', team_id='%s', "
@@ -150,22 +151,108 @@ class Player(db.Model):
 class Score(db.Model):
 	__tablename__ = 'scores'
 	id = Column(Integer, primary_key=True)
-	player_id = Column(Integer, ForeignKey('players.id'))
-	game_id = Column(Integer, ForeignKey('games.id'))
-	team_id = Column(Integer, ForeignKey('teams.id'))
+	player_id = Column(Integer, ForeignKey('players.id'), index=True)
+	game_id = Column(Integer, ForeignKey('games.id'), index=True)
+	team_id = Column(Integer, ForeignKey('teams.id'), index=True)
 	time = Column(DateTime)
 	own_goal = Column(Boolean)
 
 	@property 
 	def serialize(self):
 		"""Return Score Object"""
-		return {
-			'id': self.id,
-			'time': self.time.strftime('%m/%d/%Y %H:%M:%S') if self.time is not None\
-				else None,
-			'own_goal': self.own_goal
-		}
+		return serialize_score(self)
 
 	def __repr__(self):
 		return ("<Score(player_id='%s', game_id='%s', team_id='%s', "
-			"own_goal='%s')>") % (self.player_id, self.game_id, self.team_id, self.own_goal)
\ No newline at end of file
+			"own_goal='%s')>") % (self.player_id, self.game_id, self.team_id, self.own_goal)
+
+class UserStats(db.Model):
+	"""Running totals of a user's games, kept up to date by the api as
+	games are scored, changed and deleted (see stats.py)"""
+	__tablename__ = 'user_stats'
+	user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+	# Results only count once a game is over
+	games_played = Column(Integer, nullable=False, default=0, server_default='0')
+	wins = Column(Integer, nullable=False, default=0, server_default='0')
+	losses = Column(Integer, nullable=False, default=0, server_default='0')
+	# Goals the user scored, in any game
+	goals = Column(Integer, nullable=False, default=0, server_default='0')
+	own_goals = Column(Integer, nullable=False, default=0, server_default='0')
+	# Points for and against the user's team in finished games
+	goals_for = Column(Integer, nullable=False, default=0, server_default='0')
+	goals_against = Column(Integer, nullable=False, default=0, server_default='0')
+
+	@property
+	def goal_differential(self):
+		return self.goals_for - self.goals_against
+
+	@property 
+	def serialize(self):
+		"""Return UserStats object"""
+		return serialize_user_stats(self)
+
+	def __repr__(self):
+		return ("<UserStats(user_id='%s', wins='%s', losses='%s')>") % (
+			self.user_id, self.wins, self.losses)
+
+# The leaderboard reads the top of this index, however many games there are
+Index('ix_user_stats_ranking', UserStats.wins.desc(), UserStats.losses,
+	UserStats.user_id)
+
+class ArchivedGame(db.Model):
+	"""A finished game moved out of the teams, players and scores tables,
+	as one compressed blob (see archive.py). Its games row stays."""
+	__tablename__ = 'archived_games'
+
+	game_id = Column(Integer, ForeignKey('games.id'), primary_key=True)
+	# zlib compressed JSON of the game's teams, players and scores
+	payload = Column(LargeBinary, nullable=False)
+
+	def __repr__(self):
+		return "<ArchivedGame(game_id='%s')>" % (self.game_id,)
+
+class ArchivedPlayer(db.Model):
+	"""What an archived game's player row counted for, so that stats,
+	ratings and GET /games?user_id= still see archived games"""
+	__tablename__ = 'archived_players'
+	__table_args__ = (
+		# Archived games a user played in, for GET /games?user_id=
+		Index('ix_archived_players_user_id_game_id', 'user_id', 'game_id'),
+	)
+
+	# The id the player had in the players table
+	player_id = Column(Integer, primary_key=True)
+	game_id = Column(Integer, ForeignKey('games.id'), index=True)
+	team_id = Column(Integer)
+	user_id = Column(Integer, ForeignKey('users.id'))
+	# Goals and own goals the player scored
+	goals = Column(Integer, nullable=False, default=0)
+	own_goals = Column(Integer, nullable=False, default=0)
+	# Final points of the player's team and of the other team, or None if
+	# there was no other team
+	points = Column(Integer, nullable=False, default=0)
+	against = Column(Integer)
+	rating_change = Column(Float)
+
+	def __repr__(self):
+		return ("<ArchivedPlayer(player_id='%s', game_id='%s', "
+			"user_id='%s')>") % (self.player_id, self.game_id, self.user_id)
+
+def game_graph():
+	"""Loader options for everything Game.serialize touches.
+
+	Teams, players (with their users) and scores are each fetched with a
+	single extra query for the whole result set, so loading a page of games
+	costs the same number of statements whatever the page size."""
+	return (
+		subqueryload(Game.teams).subqueryload(Team.players)\
+			.joinedload('user'),
+		subqueryload(Game.teams).subqueryload(Team.players)\
+			.subqueryload(Player.scores)
+	)
+
+def touch(obj):
+	"""Record a change to a Game or User by bumping its version. The bump
+	is done in SQL so concurrent writers can't both claim the same version."""
+	obj.version = type(obj).version + 1
+	obj.updated = datetime.utcnow()
@@ -0,0 +1,83 @@
+"""Deleting games with set-based statements.
+
+Deleting a Game through the ORM loads its teams, players and scores and
+lets the delete-orphan cascades remove them a row at a time. delete_games
+works on a batch of game ids instead, with a few statements in all:
+
+- what the games added to their users' stats is summed with two grouped
+  queries (stats.game_totals) and taken back with one executemany
+- their rating changes are summed per user and taken back the same way
+  (ratings.unrate_games)
+- scores, players, teams, the archive tables and then the games are
+  removed with one DELETE ... WHERE game_id IN (...) each
+
+purge deletes every game started in a time range this way, a batch at a
+time, committing after each batch so that no lock is held for long.
+"""
+from sqlalchemy import select
+from bulk import lock_rows
+from models import Game, Team, Player, Score, ArchivedGame, ArchivedPlayer
+from ratings import unrate_games
+from stats import apply_stats_batch, difference, game_totals
+
+BATCH_SIZE = 500
+
+
+def delete_contents(connection, game_ids):
+    """Delete the scores, players and teams of games, leaving the games
+    rows and their users' stats and ratings alone"""
+    for Model in (Score, Player, Team):
+        table = Model.__table__
+        connection.execute(table.delete().where(table.c.game_id.in_(game_ids)))
+
+
+def delete_games(connection, game_ids):
+    """Delete games and everything in them, taking back what they added to
+    their users' stats and ratings. game_ids should be at most a few
+    hundred, as they are sent in IN (...) lists. Returns the number of
+    games deleted."""
+    if len(game_ids) == 0:
+        return 0
+
+    # Nobody else can change these games between reading what they added
+    # and deleting them
+    lock_rows(connection, Game.__table__, game_ids)
+    apply_stats_batch(connection,
+        difference({}, game_totals(connection, game_ids)))
+    unrate_games(connection, game_ids)
+
+    delete_contents(connection, game_ids)
+    for Model in (ArchivedPlayer, ArchivedGame):
+        table = Model.__table__
+        connection.execute(table.delete().where(table.c.game_id.in_(game_ids)))
+    games = Game.__table__
+    return connection.execute(games.delete()\
+        .where(games.c.id.in_(game_ids))).rowcount
+
+
+def purge(session, started_after=None, started_before=None,
+        batch_size=BATCH_SIZE, progress=None):
+    """Delete every game started at or after started_after and before
+    started_before (either may be None for no limit), batch_size games per
+    transaction. progress, if given, is called with the ids of each batch
+    once it is committed. Returns the number of games deleted."""
+    games = Game.__table__
+    query = select([games.c.id])\
+        .order_by(games.c.start, games.c.id)\
+        .limit(batch_size)
+    if started_after is not None:
+        query = query.where(games.c.start >= started_after)
+    if started_before is not None:
+        query = query.where(games.c.start < started_before)
+
+    deleted = 0
+    while True:
+        game_ids = [row[0] for row in session.connection().execute(query)]
+        if len(game_ids) == 0:
+            session.commit()
+            return deleted
+
+        deleted += delete_games(session.connection(), game_ids)
+        session.commit()
+        if progress is not None:
+            progress(game_ids)
@@ -0,0 +1,337 @@
+"""Elo ratings for users, from the results of their games.
+
+A team's strength is the average rating of its players. When a game with
+two teams is over, each player on the team that won gains
+
+    K_FACTOR * (result - expected)
+
+where result is 1 for a win, 0.5 for a draw and 0 for a loss, and expected
+is the team's chance of winning given the two averages. The losing team
+loses the same amount. Every user starts at INITIAL_RATING.
+
+The api rates a game as soon as it is over (rate_game), and remembers the
+change each player got in players.rating_change so that it can be taken back
+if the game is changed or deleted (unrate_game).
+
+recompute_ratings replays the whole history, ordered by start time, to
+rebuild every rating from scratch, for instance after changing the formula.
+The history is read with one query into flat lists, and replayed against a
+list of ratings indexed by user, without building any ORM objects.
+"""
+from datetime import datetime
+from sqlalchemy import and_, bindparam, func, literal, or_, select, \
+    union_all
+from models import User, Game, Team, Player, ArchivedPlayer
+
+INITIAL_RATING = 1500.0
+K_FACTOR = 32.0
+# Rating difference at which the stronger team is 10 times as likely to win
+SCALE = 400.0
+
+
+def expected_result(rating, other):
+    """Chance of a team rated rating beating one rated other"""
+    return 1.0 / (1.0 + 10.0 ** ((other - rating) / SCALE))
+
+
+def elo_change(ratings, points, k_factor=K_FACTOR):
+    """Change for each player on the first of two teams.
+
+    ratings and points are (first, second) pairs of the teams' average
+    ratings and points. The second team's players get the negated change."""
+    if points[0] > points[1]:
+        result = 1.0
+    elif points[0] < points[1]:
+        result = 0.0
+    else:
+        result = 0.5
+    return k_factor * (result - expected_result(ratings[0], ratings[1]))
+
+
+def is_rated(teams):
+    """Whether a game's teams, as (points, user_ids) pairs, can be rated"""
+    return len(teams) == 2 and all(len(user_ids) > 0
+        for points, user_ids in teams)
+
+
+def rate_in_order(games, ratings, k_factor=K_FACTOR):
+    """Rate games one after another, in memory, the same as rate_game.
+
+    games lists each game's teams as (points, user_ids). ratings is
+    { user_id: rating } for every user in them, and is updated as the games
+    are rated. Returns the change for each game's first team, or None for a
+    game that can't be rated."""
+    changes = []
+
+    for teams in games:
+        if not is_rated(teams):
+            changes.append(None)
+            continue
+
+        averages = [sum(ratings[user_id] for user_id in user_ids)
+            / len(user_ids) for points, user_ids in teams]
+        change = elo_change(averages, [points for points, user_ids in teams],
+            k_factor)
+
+        for sign, (points, user_ids) in zip((1, -1), teams):
+            for user_id in user_ids:
+                ratings[user_id] += sign * change
+        changes.append(change)
+
+    return changes
+
+
+def update_ratings(session, changes, now=None):
+    """Add { user_id: change } to the users' ratings, with one executemany
+    UPDATE. Their versions are bumped too, since the rating is part of the
+    user payload."""
+    users = User.__table__
+    now = now or datetime.utcnow()
+
+    if len(changes) > 0:
+        session.execute(users.update()\
+            .where(users.c.id == bindparam('target'))\
+            .values(rating=users.c.rating + bindparam('change'),
+                version=users.c.version + 1, updated=now),
+            [{ 'target': user_id, 'change': changes[user_id] }
+                for user_id in sorted(changes)])
+
+
+def rate_game(session, game_id, k_factor=K_FACTOR):
+    """Rate a finished game from its current teams and players' ratings.
+
+    Returns False, changing nothing, if the game doesn't have two teams
+    with players."""
+    rows = session.query(Team.id, Team.points, Player.id, Player.user_id,
+            User.rating)\
+        .join(Player, Player.team_id == Team.id)\
+        .join(User, User.id == Player.user_id)\
+        .filter(Team.game_id == game_id)\
+        .order_by(Team.id, Player.id).all()
+
+    teams = []
+    last_team = None
+    for team_id, points, player_id, user_id, rating in rows:
+        if team_id != last_team:
+            teams.append((points, []))
+            last_team = team_id
+        teams[-1][1].append((player_id, user_id, rating))
+
+    if not is_rated(teams):
+        return False
+
+    averages = [sum(p[2] for p in players) / len(players)
+        for points, players in teams]
+    change = elo_change(averages, [points for points, players in teams],
+        k_factor)
+
+    players = Player.__table__
+    player_changes = []
+    user_changes = {}
+    for sign, (points, team) in zip((1, -1), teams):
+        for player_id, user_id, rating in team:
+            player_changes.append({ 'target': player_id,
+                'change': sign * change })
+            user_changes[user_id] = user_changes.get(user_id, 0) + \
+                sign * change
+
+    session.execute(players.update()\
+        .where(players.c.id == bindparam('target'))\
+        .values(rating_change=bindparam('change')), player_changes)
+    update_ratings(session, user_changes)
+    return True
+
+
+def unrate_game(session, game_id):
+    """Take back the rating changes a game gave its players, if any"""
+    rows = session.query(Player.user_id, Player.rating_change)\
+        .filter(Player.game_id == game_id)\
+        .filter(Player.rating_change != None)
+
+    user_changes = {}
+    for user_id, change in rows:
+        user_changes[user_id] = user_changes.get(user_id, 0) - change
+
+    if len(user_changes) == 0:
+        return False
+
+    update_ratings(session, user_changes)
+    session.query(Player).filter(Player.game_id == game_id)\
+        .update({ Player.rating_change: None }, synchronize_session=False)
+    return True
+
+
+def unrate_games(connection, game_ids):
+    """Take back the rating changes games gave their players, archived or
+    not, summed per user with a grouped query per table and applied with
+    one executemany"""
+    changes = {}
+    for table in (Player.__table__, ArchivedPlayer.__table__):
+        rows = connection.execute(select([table.c.user_id,
+                func.sum(table.c.rating_change)])\
+            .where(table.c.game_id.in_(game_ids))\
+            .where(table.c.rating_change != None)\
+            .where(table.c.user_id != None)\
+            .group_by(table.c.user_id))
+        for user_id, change in rows:
+            changes[user_id] = changes.get(user_id, 0) - change
+    update_ratings(connection, changes)
+
+
+def batches(result, size=10000):
+    """Iterate over a result's rows, fetching them size at a time"""
+    while True:
+        rows = result.fetchmany(size)
+        if len(rows) == 0:
+            return
+        for row in rows:
+            yield row
+
+
+def load_history(engine):
+    """Every rateable game, in the order recompute_ratings replays them.
+
+    Returns (player_ids, user_ids, games, sides, points): a row per player,
+    naming its game (counted from 0 in replay order) and side (0 or 1), and
+    the points of each game's two sides as a list of pairs. player_ids are
+    (archived, id) pairs, archived players being named by their player_id
+    in archived_players."""
+    games = Game.__table__
+    teams = Team.__table__
+    opponents = Team.__table__.alias('opponents')
+    players = Player.__table__
+    archived = ArchivedPlayer.__table__
+
+    finished = or_(games.c.end != None, teams.c.points >= 10,
+        opponents.c.points >= 10)
+    hot = select([games.c.start.label('start'), games.c.id.label('game_id'),
+            teams.c.id.label('team_id'), teams.c.points.label('points'),
+            opponents.c.points.label('against'),
+            players.c.id.label('player_id'),
+            players.c.user_id.label('user_id'),
+            literal(False).label('archived')])\
+        .select_from(games\
+            .join(teams, teams.c.game_id == games.c.id)\
+            .join(opponents, and_(opponents.c.game_id == games.c.id,
+                opponents.c.id != teams.c.id))\
+            .join(players, players.c.team_id == teams.c.id))\
+        .where(finished)
+    # Archived games are all finished, and have no against without a
+    # second team
+    cold = select([games.c.start, games.c.id, archived.c.team_id,
+            archived.c.points, archived.c.against, archived.c.player_id,
+            archived.c.user_id, literal(True)])\
+        .select_from(games.join(archived, archived.c.game_id == games.c.id))\
+        .where(archived.c.against != None)
+    query = union_all(hot, cold)\
+        .order_by('start', 'game_id', 'team_id', 'player_id')
+
+    player_ids, user_ids, game_index, sides, points = [], [], [], [], []
+    last_game = last_team = None
+
+    for start, game_id, team_id, team_points, other_points, player_id, \
+            user_id, is_archived in batches(engine.execute(query)):
+        if game_id != last_game:
+            # Games with more than two teams aren't valid, skip any extras
+            last_game, last_team, side = game_id, team_id, 0
+            points.append((team_points, other_points))
+        elif team_id != last_team:
+            last_team, side = team_id, side + 1
+        if side > 1 or user_id is None:
+            continue
+
+        player_ids.append((bool(is_archived), player_id))
+        user_ids.append(user_id)
+        game_index.append(len(points) - 1)
+        sides.append(side)
+
+    # A team without players leaves its game with a single side
+    sided = set(zip(game_index, sides))
+    keep = [i for i, game in enumerate(game_index)
+        if (game, 1 - sides[i]) in sided]
+
+    return ([player_ids[i] for i in keep], [user_ids[i] for i in keep],
+        [game_index[i] for i in keep], [sides[i] for i in keep], points)
+
+
+def game_rows(games):
+    """(game, first row, end row) for each run of rows from the same game"""
+    bounds = [row for row in range(1, len(games))
+        if games[row] != games[row - 1]]
+    starts = [0] + bounds
+    ends = bounds + [len(games)]
+    return [(games[start], start, end) for start, end in zip(starts, ends)
+        if start < end]
+
+
+def replay(user_index, games, sides, points, n_users, k_factor=K_FACTOR):
+    """Rate every game in order, one player row at a time.
+
+    user_index numbers users from 0. Returns (ratings, changes): each user's
+    final rating and each player row's change."""
+    ratings = [INITIAL_RATING] * n_users
+    changes = [0.0] * len(games)
+
+    for game, start, end in game_rows(games):
+        totals, sizes = [0.0, 0.0], [0, 0]
+        for row in range(start, end):
+            totals[sides[row]] += ratings[user_index[row]]
+            sizes[sides[row]] += 1
+        averages = [totals[0] / sizes[0], totals[1] / sizes[1]]
+        change = elo_change(averages, points[game], k_factor)
+
+        for row in range(start, end):
+            changes[row] = change if sides[row] == 0 else -change
+            ratings[user_index[row]] += changes[row]
+
+    return ratings, changes
+
+
+def recompute_ratings(engine, k_factor=K_FACTOR, write=True):
+    """Replay every finished game to rebuild all ratings.
+
+    Users that never played go back to INITIAL_RATING. With write False the
+    ratings are only computed, for trying out a formula. Returns
+    { user_id: rating } for every user who played."""
+    player_ids, user_ids, games, sides, points = load_history(engine)
+
+    users = sorted(set(user_ids))
+    numbering = dict((user_id, index) for index, user_id in enumerate(users))
+    user_index = [numbering[user_id] for user_id in user_ids]
+
+    ratings, changes = replay(user_index, games, sides, points, len(users),
+        k_factor)
+
+    if write:
+        users_table = User.__table__
+        now = datetime.utcnow()
+
+        with engine.begin() as connection:
+            connection.execute(users_table.update()\
+                .where(users_table.c.rating != INITIAL_RATING)\
+                .values(rating=INITIAL_RATING,
+                    version=users_table.c.version + 1, updated=now))
+            for table in (Player.__table__, ArchivedPlayer.__table__):
+                connection.execute(table.update()\
+                    .where(table.c.rating_change != None)\
+                    .values(rating_change=None))
+
+            if len(users) > 0:
+                connection.execute(users_table.update()\
+                    .where(users_table.c.id == bindparam('user_id'))\
+                    .values(rating=bindparam('new_rating'),
+                        version=users_table.c.version + 1, updated=now),
+                    [{ 'user_id': user_id, 'new_rating': rating }
+                        for user_id, rating in zip(users, ratings)])
+            for table, key, archived in ((Player.__table__, 'id', False),
+                    (ArchivedPlayer.__table__, 'player_id', True)):
+                rows = [{ 'target': player_id, 'change': change }
+                    for (is_archived, player_id), change
+                        in zip(player_ids, changes)
+                    if is_archived == archived]
+                if len(rows) > 0:
+                    connection.execute(table.update()\
+                        .where(table.c[key] == bindparam('target'))\
+                        .values(rating_change=bindparam('change')), rows)
+
+    return dict(zip(users, ratings))
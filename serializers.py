@@ -0,0 +1,236 @@
+"""Serialization of models for the api.
+
+Each model's fields are listed once, and turned at import into two
+functions: one building the dict the model's serialize property returns,
+and one writing the model straight out as JSON text for listings, which
+skips building the dicts and the generic encoder's key sorting. Timestamps
+are formatted with string interpolation rather than strftime, and a game
+listing writes each user once however many of the games they played in.
+
+The JSON text is byte-for-byte what flask.json.dumps produces for the
+serialized dicts, keys sorted as with the default JSON_SORT_KEYS.
+"""
+from operator import attrgetter
+
+try:
+    # simplejson's C encoder can sort keys, the standard library's can't
+    import simplejson as _json
+except ImportError:
+    import json as _json
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def format_datetime(value):
+    """value as MM/DD/YYYY hh:mm:ss, or None"""
+    if value is None:
+        return None
+    return '%02d/%02d/%04d %02d:%02d:%02d' % (value.month, value.day,
+        value.year, value.hour, value.minute, value.second)
+
+
+def format_date(value):
+    """value as MM/DD/YYYY, or None"""
+    if value is None:
+        return None
+    return '%02d/%02d/%04d' % (value.month, value.day, value.year)
+
+
+FORMATTERS = {
+    'datetime': format_datetime,
+    'date': format_date
+}
+
+_encoder = _json.JSONEncoder(sort_keys=True)
+_encode_string = _json.encoder.encode_basestring_ascii
+
+
+def dumps(obj):
+    """Encode serialized models as JSON, the same as flask.json.dumps does
+    with the default JSON_SORT_KEYS, minus its per-call setup"""
+    return _encoder.encode(obj)
+
+
+def encode_value(value):
+    """JSON text for a single field value"""
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, string_types):
+        return _encode_string(value)
+    if isinstance(value, int):
+        return str(value)
+    return _encoder.encode(value)
+
+
+def make_serializer(fields):
+    """Build the serialize and encode functions for a model.
+
+    fields is a list of at least two (key, attribute, format), where format
+    names one of FORMATTERS, or is None to use the attribute's value as it
+    is. The attributes are read with one attrgetter call. Returns
+    (serialize, encode): serialize(obj) gives the dict of fields, and
+    encode(obj) the JSON text of that dict."""
+    keys = [key for key, attribute, fmt in fields]
+    get = attrgetter(*[attribute for key, attribute, fmt in fields])
+    formatted = [(key, FORMATTERS[fmt]) for key, attribute, fmt in fields
+        if fmt is not None]
+
+    # The JSON text has its keys in sorted order
+    ordered = sorted(fields)
+    get_ordered = attrgetter(*[attribute for key, attribute, fmt in ordered])
+    formatted_ordered = [(index, FORMATTERS[fmt])
+        for index, (key, attribute, fmt) in enumerate(ordered)
+        if fmt is not None]
+    template = '{' + ', '.join('%s: %%s' % (_encode_string(key),)
+        for key, attribute, fmt in ordered) + '}'
+
+    def serialize(obj):
+        result = dict(zip(keys, get(obj)))
+        for key, formatter in formatted:
+            result[key] = formatter(result[key])
+        return result
+
+    def encode(obj):
+        values = list(get_ordered(obj))
+        for index, formatter in formatted_ordered:
+            values[index] = formatter(values[index])
+        return template % tuple([encode_value(value) for value in values])
+
+    return serialize, encode
+
+
+USER_FIELDS = [
+    ('id', 'id', None),
+    ('name', 'name', None),
+    ('first_name', 'first_name', None),
+    ('last_name', 'last_name', None),
+    ('birthday', 'birthday', 'date'),
+    ('email', 'email', None)
+]
+
+serialize_user, encode_user = make_serializer(USER_FIELDS + [('rating', 'rating', None)])
+
+# Users inside games leave out the rating, which changes with every game
+# the user plays, so that a game's JSON only changes with the game
+serialize_game_user, encode_game_user = make_serializer(USER_FIELDS)
+
+serialize_team, encode_team = make_serializer([
+    ('id', 'id', None),
+    ('game_id', 'game_id', None)
+])
+
+serialize_player, encode_player = make_serializer([
+    ('id', 'id', None),
+    ('user_id', 'user_id', None),
+    ('game_id', 'game_id', None),
+    ('team_id', 'team_id', None),
+    ('position', 'position', None)
+])
+
+serialize_score, encode_score = make_serializer([
+    ('id', 'id', None),
+    ('time', 'time', 'datetime'),
+    ('own_goal', 'own_goal', None)
+])
+
+serialize_user_stats, encode_user_stats = make_serializer([
+    ('user_id', 'user_id', None),
+    ('games_played', 'games_played', None),
+    ('wins', 'wins', None),
+    ('losses', 'losses', None),
+    ('goals', 'goals', None),
+    ('own_goals', 'own_goals', None),
+    ('goals_for', 'goals_for', None),
+    ('goals_against', 'goals_against', None),
+    ('goal_differential', 'goal_differential', None)
+])
+
+
+def cached_user(player, users, serialize):
+    """serialize(player.user), cached in users by user id"""
+    user = users.get(player.user_id)
+    if user is None:
+        user = serialize(player.user)
+        if player.user_id is not None:
+            users[player.user_id] = user
+    return user
+
+
+def serialize_game(game, users=None):
+    """Full game with its teams, players, users and scores.
+
+    users caches serialized users by id. Pass the same dict when serializing
+    several games so each user is only serialized once."""
+    if users is None:
+        users = {}
+
+    teams = []
+    for team in game.teams:
+        players = []
+        for player in team.players:
+            players.append({
+                'id': player.id,
+                'position': player.position,
+                'user': cached_user(player, users, serialize_game_user),
+                'scores': [serialize_score(score) for score in player.scores]
+            })
+
+        teams.append({
+            'id': team.id,
+            'name': team.name,
+            'players': players
+        })
+
+    return {
+        'id': game.id,
+        'start': format_datetime(game.start),
+        'end': format_datetime(game.end),
+        'teams': teams
+    }
+
+
+def encode_game(game, users=None):
+    """JSON text of serialize_game(game). users caches encoded users."""
+    if users is None:
+        users = {}
+
+    teams = []
+    for team in game.teams:
+        players = []
+        for player in team.players:
+            players.append('{"id": %s, "position": %s, "scores": [%s], '
+                '"user": %s}' % (encode_value(player.id),
+                    encode_value(player.position),
+                    ', '.join([encode_score(score) for score in player.scores]),
+                    cached_user(player, users, encode_game_user)))
+
+        teams.append('{"id": %s, "name": %s, "players": [%s]}' % (
+            encode_value(team.id), encode_value(team.name), ', '.join(players)))
+
+    return '{"end": %s, "id": %s, "start": %s, "teams": [%s]}' % (
+        encode_value(format_datetime(game.end)), encode_value(game.id),
+        encode_value(format_datetime(game.start)), ', '.join(teams))
+
+
+def serialize_games(games):
+    """List of serialized games, sharing serialized users between them"""
+    users = {}
+    return [serialize_game(game, users) for game in games]
+
+
+def encode_games(games):
+    """List of the JSON text of each game, sharing encoded users"""
+    users = {}
+    return [encode_game(game, users) for game in games]
+
+
+def encode_users(users):
+    """List of the JSON text of each user"""
+    return [encode_user(user) for user in users]
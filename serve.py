@@ -0,0 +1,75 @@
+"""Serve the api on gevent, so idle and slow connections cost next to nothing.
+
+Usage: python serve.py [--host HOST] [--port PORT] [--database URI]
+                       [--max-connections N] [--pool-size N]
+
+app.run gives every connection a thread (or a whole process under a sync
+WSGI server), which an event stream or a slow phone on a bad network keeps
+for as long as it is open. Here each connection is a greenlet on one event
+loop instead: the same app, routes and JSON, with sockets, sleeps, locks
+and queues (so EventHub's listener queues too) patched to yield to other
+greenlets while they wait. Thousands of open connections cost a few
+kilobytes each.
+
+Database calls yield too where the driver allows it: psycopg2 is made
+cooperative with psycogreen, when both are installed. The sqlite3 module
+can't be, so on SQLite each query holds the loop while it runs, which is
+fine for the short queries the api makes but means SQLite is for
+development only. Every greenlet that talks to the database needs a
+pooled connection while it does, so size --pool-size to the number of
+queries you want in flight at once.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    patch_psycopg = None
+else:
+    patch_psycopg()
+
+import argparse
+import sys
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+import api
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--database', help='database URI to serve')
+    parser.add_argument('--max-connections', type=int, default=10000,
+        help='connections served at once, the rest wait (default 10000)')
+    parser.add_argument('--pool-size', type=int,
+        help='database connections kept open (default SQLAlchemy\'s)')
+    args = parser.parse_args(argv)
+
+    if args.database is not None:
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    if args.pool_size is not None:
+        api.app.config['SQLALCHEMY_POOL_SIZE'] = args.pool_size
+    # The debugger and reloader only work under app.run
+    api.app.config['DEBUG'] = False
+    api.init_db()
+
+    if patch_psycopg is None and \
+            api.db.engine.dialect.driver == 'psycopg2':
+        sys.stderr.write('psycogreen is not installed, database calls will '
+            'block every connection while they run\n')
+
+    server = WSGIServer((args.host, args.port), api.app,
+        spawn=Pool(args.max_connections), log=None)
+    sys.stderr.write('serving on http://%s:%s\n' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
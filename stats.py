@@ -0,0 +1,341 @@
+"""Per-user statistics, kept as running totals in the user_stats table.
+
+Recomputing a user's record from their games gets slower with every game
+played, so the api instead adds each game's contribution to the totals as
+it happens: a goal as soon as it is scored, and the result once the game is
+over. Changing or deleting a game takes back what it contributed before and
+adds what it contributes now. Reading a user's stats is then one row by
+primary key, and the leaderboard reads the top of ix_user_stats_ranking.
+
+rebuild_stats recomputes every row from the games, for backfilling an
+existing database or repairing the totals.
+"""
+from sqlalchemy import and_, bindparam, case, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from models import UserStats, Game, Team, Player, Score, ArchivedPlayer
+from validation import tally_points
+
+FIELDS = ('games_played', 'wins', 'losses', 'goals', 'own_goals',
+    'goals_for', 'goals_against')
+
+
+def add_stat(changes, user_id, field, amount):
+    """Add amount to a user's field in a dict of changes"""
+    if user_id is None or amount == 0:
+        return
+    change = changes.setdefault(user_id, {})
+    change[field] = change.get(field, 0) + amount
+
+
+def scoring_stats(game, changes=None):
+    """Goals and own goals in a game from validation.resolve_game, as
+    { user_id: { field: amount } }"""
+    if changes is None:
+        changes = {}
+
+    for team in game['teams']:
+        for player in team['players']:
+            for score in player['scores']:
+                field = 'own_goals' if score['own_goal'] else 'goals'
+                add_stat(changes, player['user_id'], field, 1)
+
+    return changes
+
+
+def result_stats(teams, changes=None):
+    """Results of a finished game, as { user_id: { field: amount } }.
+
+    teams lists each team as (points, user_ids), in game order. A team wins
+    by having more points than the other one; a game with a single team, or
+    a draw, still counts as played."""
+    if changes is None:
+        changes = {}
+
+    for index, (points, user_ids) in enumerate(teams):
+        against = teams[1 - index][0] if len(teams) == 2 else 0
+        for user_id in user_ids:
+            add_stat(changes, user_id, 'games_played', 1)
+            add_stat(changes, user_id, 'goals_for', points)
+            add_stat(changes, user_id, 'goals_against', against)
+            if len(teams) == 2 and points > against:
+                add_stat(changes, user_id, 'wins', 1)
+            elif len(teams) == 2 and points < against:
+                add_stat(changes, user_id, 'losses', 1)
+
+    return changes
+
+
+def is_finished(game, points):
+    """Whether a game from resolve_game with the given team points is over,
+    the same test as api.is_game_over"""
+    return game['end'] is not None or max(points or [0]) >= 10
+
+
+def finished_teams(game):
+    """The teams of a game from validation.resolve_game as result_stats
+    takes them, or None if the game isn't over"""
+    points = tally_points(game)
+    if not is_finished(game, points):
+        return None
+
+    return [(team_points, [p['user_id'] for p in team['players']])
+        for team_points, team in zip(points, game['teams'])]
+
+
+def game_stats(game):
+    """Everything a game from validation.resolve_game contributes to its
+    users' stats"""
+    changes = scoring_stats(game)
+
+    teams = finished_teams(game)
+    if teams is not None:
+        result_stats(teams, changes)
+
+    return changes
+
+
+def difference(after, before):
+    """Changes turning the stats contributed by before into after's"""
+    changes = {}
+    for user_id, change in after.items():
+        for field, amount in change.items():
+            add_stat(changes, user_id, field, amount)
+    for user_id, change in before.items():
+        for field, amount in change.items():
+            add_stat(changes, user_id, field, -amount)
+
+    # Drop users whose totals cancelled out
+    return dict((user_id, change) for user_id, change in changes.items()
+        if any(change.values()))
+
+
+def add_to_stats(connection, user_id, change):
+    """Add change to a user's row with one relative UPDATE, inserting the
+    row if there is none. If another transaction inserts it first, the
+    UPDATE is run again against that row."""
+    table = UserStats.__table__
+    update = table.update()\
+        .where(table.c.user_id == user_id)\
+        .values(dict((field, table.c[field] + amount)
+            for field, amount in change.items()))
+    if connection.execute(update).rowcount > 0:
+        return
+
+    row = dict.fromkeys(FIELDS, 0)
+    row.update(change)
+    row['user_id'] = user_id
+    # A failed statement aborts a PostgreSQL transaction unless it is in a
+    # savepoint. SQLite only undoes the statement, and pysqlite can't take
+    # savepoints inside a transaction.
+    savepoint = None
+    if connection.dialect.name != 'sqlite':
+        savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert().values(row))
+    except IntegrityError:
+        if savepoint is not None:
+            savepoint.rollback()
+        connection.execute(update)
+    else:
+        if savepoint is not None:
+            savepoint.commit()
+
+
+def apply_stats(session, changes):
+    """Add changes to the user_stats rows in the session's transaction.
+
+    Each user's row is changed with one relative UPDATE, so concurrent
+    writers add to the totals rather than overwriting each other. A user
+    without a row yet gets one (see add_to_stats)."""
+    connection = session.connection()
+
+    for user_id in sorted(changes):
+        change = dict((field, amount)
+            for field, amount in changes[user_id].items() if amount != 0)
+        if len(change) > 0:
+            add_to_stats(connection, user_id, change)
+
+
+def apply_stats_batch(connection, changes, batch_size=500):
+    """apply_stats for many users at once.
+
+    Which users already have a row is looked up batch_size users per query.
+    Their rows are then changed with one executemany UPDATE, adding to
+    every field, and the rest are inserted with one executemany INSERT.
+
+    If another transaction adds one of those rows in between, the INSERT
+    fails and is undone with a savepoint, and the new rows are added a user
+    at a time with add_to_stats instead. SQLite can't take the savepoint,
+    but there the callers have written already, so they hold the
+    database's write lock and nobody else can add a row."""
+    table = UserStats.__table__
+    user_ids = sorted(user_id for user_id, change in changes.items()
+        if any(change.values()))
+
+    existing = set()
+    for start in range(0, len(user_ids), batch_size):
+        rows = connection.execute(select([table.c.user_id])\
+            .where(table.c.user_id.in_(user_ids[start:start + batch_size])))
+        existing.update(row[0] for row in rows)
+
+    updates, inserts = [], []
+    for user_id in user_ids:
+        row = dict.fromkeys(FIELDS, 0)
+        row.update(changes[user_id])
+        if user_id in existing:
+            updates.append(dict(('d_' + field, row[field]) for field in FIELDS))
+            updates[-1]['target'] = user_id
+        else:
+            row['user_id'] = user_id
+            inserts.append(row)
+
+    if len(updates) > 0:
+        connection.execute(table.update()\
+            .where(table.c.user_id == bindparam('target'))\
+            .values(dict((field, table.c[field] + bindparam('d_' + field))
+                for field in FIELDS)), updates)
+    if len(inserts) == 0:
+        return
+
+    if connection.dialect.name == 'sqlite':
+        connection.execute(table.insert(), inserts)
+        return
+
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert(), inserts)
+    except IntegrityError:
+        savepoint.rollback()
+        for row in inserts:
+            add_to_stats(connection, row['user_id'], dict((field, row[field])
+                for field in FIELDS if row[field] != 0))
+    else:
+        savepoint.commit()
+
+
+def team_results(session, game_id):
+    """A game's teams as result_stats takes them, read fresh from the
+    database in one query"""
+    rows = session.query(Team.id, Team.points, Player.user_id)\
+        .outerjoin(Player, Player.team_id == Team.id)\
+        .filter(Team.game_id == game_id)\
+        .order_by(Team.id, Player.id)
+
+    teams = []
+    last_team = None
+    for team_id, points, user_id in rows:
+        if team_id != last_team:
+            teams.append((points, []))
+            last_team = team_id
+        if user_id is not None:
+            teams[-1][1].append(user_id)
+
+    return teams
+
+
+def game_totals(connection, game_ids=None):
+    """What games contributed to their users' stats, as
+    { user_id: { field: amount } }: every game, or only those in game_ids.
+
+    Goals are counted from scores, and results from each finished game's
+    team points, with one grouped query each, and archived games add a
+    third over archived_players. Only the per-user totals come back to
+    Python, so this stays quick however many games there are."""
+    games = Game.__table__
+    teams = Team.__table__
+    opponents = Team.__table__.alias('opponents')
+    players = Player.__table__
+    scores = Score.__table__
+
+    totals = {}
+
+    own_goal = scores.c.own_goal == True
+    goals = select([players.c.user_id,
+            func.sum(case([(own_goal, 0)], else_=1)),
+            func.sum(case([(own_goal, 1)], else_=0))])\
+        .select_from(scores.join(players, players.c.id == scores.c.player_id))\
+        .where(players.c.user_id != None)\
+        .group_by(players.c.user_id)
+    if game_ids is not None:
+        goals = goals.where(scores.c.game_id.in_(game_ids))
+
+    for user_id, scored, own_goals in connection.execute(goals):
+        add_stat(totals, user_id, 'goals', int(scored))
+        add_stat(totals, user_id, 'own_goals', int(own_goals))
+
+    # Teams play at most one other team
+    against = func.coalesce(opponents.c.points, 0)
+    finished = or_(games.c.end != None, teams.c.points >= 10,
+        against >= 10)
+    win = and_(opponents.c.id != None, teams.c.points > against)
+    loss = and_(opponents.c.id != None, teams.c.points < against)
+
+    def total(value=1, condition=None):
+        if condition is not None:
+            value = case([(condition, value)], else_=0)
+        return func.sum(case([(finished, value)], else_=0))
+
+    results = select([players.c.user_id,
+            total(), total(condition=win), total(condition=loss),
+            total(teams.c.points), total(against)])\
+        .select_from(players\
+            .join(teams, teams.c.id == players.c.team_id)\
+            .join(games, games.c.id == teams.c.game_id)\
+            .outerjoin(opponents, and_(opponents.c.game_id == teams.c.game_id,
+                opponents.c.id != teams.c.id)))\
+        .where(players.c.user_id != None)\
+        .group_by(players.c.user_id)
+    if game_ids is not None:
+        results = results.where(games.c.id.in_(game_ids))
+
+    for row in connection.execute(results):
+        user_id, amounts = row[0], list(row)[1:]
+        for field, amount in zip(('games_played', 'wins', 'losses',
+                'goals_for', 'goals_against'), amounts):
+            add_stat(totals, user_id, field, int(amount or 0))
+
+    # Archived games are all finished, with their goals counted per player
+    archived = ArchivedPlayer.__table__
+    against = func.coalesce(archived.c.against, 0)
+
+    def count(condition):
+        return func.sum(case([(condition, 1)], else_=0))
+
+    results = select([archived.c.user_id, func.sum(archived.c.goals),
+            func.sum(archived.c.own_goals), func.count(),
+            count(archived.c.points > archived.c.against),
+            count(archived.c.points < archived.c.against),
+            func.sum(archived.c.points), func.sum(against)])\
+        .where(archived.c.user_id != None)\
+        .group_by(archived.c.user_id)
+    if game_ids is not None:
+        results = results.where(archived.c.game_id.in_(game_ids))
+
+    for row in connection.execute(results):
+        user_id, amounts = row[0], list(row)[1:]
+        for field, amount in zip(('goals', 'own_goals', 'games_played',
+                'wins', 'losses', 'goals_for', 'goals_against'), amounts):
+            add_stat(totals, user_id, field, int(amount or 0))
+
+    return totals
+
+
+def rebuild_stats(engine):
+    """Recompute every user's stats from the games tables, with
+    game_totals"""
+    totals = game_totals(engine)
+
+    rows = []
+    for user_id in sorted(totals):
+        row = dict.fromkeys(FIELDS, 0)
+        row.update(totals[user_id])
+        row['user_id'] = user_id
+        rows.append(row)
+
+    table = UserStats.__table__
+    with engine.begin() as connection:
+        connection.execute(table.delete())
+        if len(rows) > 0:
+            connection.execute(table.insert(), rows)
+
+    return len(rows)
@@ -0,0 +1,296 @@
+"""Validation for game payloads.
+
+Games are posted as nested JSON (teams -> players -> scores). check_game
+works on that raw payload, before any ORM objects are built for it, so an
+invalid game never touches the session. It reports every problem it finds
+instead of stopping at the first one, and looks up all of the referenced
+users with a single query.
+"""
+import re
+from datetime import datetime
+from numbers import Integral
+from dateutil.parser import parse
+from models import db, User
+from serializers import string_types
+
+TIME_FORMAT_ERROR = 'times must be in YYYY-MM-DDThh:mm:ss'
+ID_ERROR = 'ids must be whole numbers'
+
+# The format nearly every payload uses, read without dateutil
+ISO_TIME = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)$')
+
+
+def parse_time(value, errors):
+    """Parse a payload timestamp, noting an error if it can't be read"""
+    match = ISO_TIME.match(value) if isinstance(value, string_types) \
+        else None
+    if match is not None:
+        try:
+            return datetime(*[int(part) for part in match.groups()])
+        except ValueError:
+            # Let dateutil have the final say on odd dates
+            pass
+
+    try:
+        return parse(value)
+    except (AttributeError, TypeError, ValueError, OverflowError):
+        errors.append(TIME_FORMAT_ERROR)
+        return None
+
+
+def is_id(value):
+    """Whether value can be a payload id: a whole number, or None for a
+    new entry. true and false are left out, as they would pass for 1 and 0."""
+    return value is None or \
+        (isinstance(value, Integral) and not isinstance(value, bool))
+
+
+def entries(value, errors, message):
+    """The objects of a payload list, None counting as empty. Anything
+    else, or any entry that isn't an object, is noted as message and left
+    out."""
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        errors.append(message)
+        return []
+    if not all(isinstance(entry, dict) for entry in value):
+        errors.append(message)
+    return [entry for entry in value if isinstance(entry, dict)]
+
+
+def resolve_game(game_json, existing=None):
+    """Work out the game a payload describes, as plain dicts.
+
+    For a new game this is just the payload with its times parsed and user
+    ids pulled out. For an update, existing is the loaded Game: entries in
+    the payload with an id are laid over the matching rows, entries without
+    one are new, and anything the payload doesn't mention is kept as it is.
+
+    Returns (game, errors), errors being the problems found reading the
+    payload. Raises LookupError if the payload names a team, player or score
+    that isn't part of the game."""
+    errors = []
+
+    if not isinstance(game_json, dict):
+        errors.append('game must be an object')
+        game_json = {}
+
+    if existing is None:
+        game = { 'id': None, 'start': datetime.now(), 'end': None, 'teams': [] }
+        if 'start' in game_json:
+            game['start'] = parse_time(game_json.get('start'), errors)
+    else:
+        game = describe_game(existing)
+        if game_json.get('start') is not None:
+            game['start'] = parse_time(game_json.get('start'), errors)
+
+    if game_json.get('end') is not None:
+        game['end'] = parse_time(game_json.get('end'), errors)
+
+    teams = dict((t['id'], t) for t in game['teams'])
+
+    for team_json in entries(game_json.get('teams'), errors,
+            'teams must be a list of objects'):
+        if not is_id(team_json.get('id')):
+            errors.append(ID_ERROR)
+            continue
+        if team_json.get('id') is None:
+            team = { 'id': None, 'players': [] }
+            game['teams'].append(team)
+        elif team_json.get('id') in teams:
+            team = teams[team_json.get('id')]
+        else:
+            raise LookupError('team does not exist')
+
+        team['name'] = team_json.get('name')
+        players = dict((p['id'], p) for p in team['players'])
+
+        for player_json in entries(team_json.get('players'), errors,
+                'players must be a list of objects'):
+            if not is_id(player_json.get('id')):
+                errors.append(ID_ERROR)
+                continue
+            if player_json.get('id') is None:
+                player = { 'id': None, 'scores': [] }
+                team['players'].append(player)
+            elif player_json.get('id') in players:
+                player = players[player_json.get('id')]
+            else:
+                raise LookupError('player does not exist')
+
+            player['position'] = player_json.get('position')
+            user = player_json.get('user')
+            if user is not None and not isinstance(user, dict):
+                errors.append('user must be an object')
+                user = None
+            player['user_id'] = user_id(user.get('id')) if user is not None \
+                else None
+            scores = dict((s['id'], s) for s in player['scores'])
+
+            for score_json in entries(player_json.get('scores'), errors,
+                    'scores must be a list of objects'):
+                if not is_id(score_json.get('id')):
+                    errors.append(ID_ERROR)
+                    continue
+                if score_json.get('id') is None:
+                    score = { 'id': None }
+                    player['scores'].append(score)
+                elif score_json.get('id') in scores:
+                    score = scores[score_json.get('id')]
+                else:
+                    raise LookupError('score does not exist')
+
+                if score_json.get('time') is None:
+                    score['time'] = None
+                else:
+                    score['time'] = parse_time(score_json.get('time'), errors)
+                own_goal = score_json.get('own_goal', False)
+                if not isinstance(own_goal, Integral) or own_goal not in (0, 1):
+                    errors.append('own_goal must be true or false')
+                score['own_goal'] = own_goal in (True, 1)
+
+    return game, errors
+
+
+def user_id(value):
+    """A payload user id as an int, or None if it isn't a number. true and
+    false are None too, rather than users 1 and 0."""
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def describe_game(game):
+    """Plain dict copy of a loaded Game, in the shape resolve_game uses"""
+    return {
+        'id': game.id,
+        'start': game.start,
+        'end': game.end,
+        'teams': [{
+            'id': team.id,
+            'name': team.name,
+            'players': [{
+                'id': player.id,
+                'position': player.position,
+                'user_id': player.user_id,
+                'scores': [{
+                    'id': score.id,
+                    'time': score.time,
+                    'own_goal': score.own_goal
+                } for score in player.scores]
+            } for player in team.players]
+        } for team in game.teams]
+    }
+
+
+def tally_points(game):
+    """Each team's points, in team order. Own goals count for the other
+    team."""
+    totals = [0] * len(game['teams'])
+
+    for index, team in enumerate(game['teams']):
+        for player in team['players']:
+            for score in player['scores']:
+                if score['own_goal']:
+                    totals[index - 1] += 1
+                else:
+                    totals[index] += 1
+
+    return totals
+
+
+def find_users(user_ids, batch_size=500):
+    """The subset of user_ids that belong to existing users, looked up
+    batch_size ids per query"""
+    ids = sorted(set(i for i in user_ids if isinstance(i, int)))
+    found = set()
+
+    for start in range(0, len(ids), batch_size):
+        rows = db.session.query(User.id)\
+            .filter(User.id.in_(ids[start:start + batch_size]))
+        found.update(row.id for row in rows)
+
+    return found
+
+
+def validate_game(game, known_users=None):
+    """Check a game from resolve_game against the rules of foosball.
+
+    known_users is the set of user ids that exist. If it isn't given, the
+    game's users are looked up with one query. Returns a list of error
+    messages, empty if the game is valid."""
+    errors = []
+    teams = game['teams']
+
+    if known_users is None:
+        known_users = find_users(player['user_id']
+            for team in teams for player in team['players'])
+
+    if len(teams) > 2:
+        errors.append('too many teams')
+
+    names = [team['name'] for team in teams]
+
+    for team in teams:
+        if len(team['players']) > 4:
+            errors.append('too many players on team')
+
+        if not isinstance(team['name'], string_types) or team['name'] == '':
+            errors.append('each team must have a name')
+        elif names.count(team['name']) > 1:
+            errors.append('each team must have a different name')
+
+        position_counts = { 1: 0, 2: 0, 3: 0, 4: 0 }
+        for player in team['players']:
+            if player['user_id'] not in known_users:
+                errors.append('user does not exist')
+
+            position = player['position']
+            if not isinstance(position, int) or isinstance(position, bool) \
+                    or position not in position_counts:
+                errors.append('player must be in position 1-4')
+            else:
+                position_counts[position] += 1
+
+        if max(position_counts.values()) > 1:
+            errors.append('more than one player in the same position')
+
+    for team in teams:
+        for player in team['players']:
+            for score in player['scores']:
+                if score['time'] is None:
+                    errors.append('every score must have a time')
+
+    if max(tally_points(game) or [0]) > 10:
+        errors.append('each team can have a max of 10 points')
+
+    # Verify that same user isn't on each team
+    if len(teams) == 2:
+        team1_users = set(player['user_id'] for player in teams[0]['players'])
+        for player in teams[1]['players']:
+            if player['user_id'] in team1_users:
+                errors.append('each user can only be on a single team')
+
+    return errors
+
+
+def check_game(game_json, existing=None):
+    """Resolve and validate a game payload in one go.
+
+    Returns (game, errors) where errors lists each distinct problem once.
+    Raises LookupError like resolve_game."""
+    game, errors = resolve_game(game_json, existing)
+    return game, unique_errors(errors + validate_game(game))
+
+
+def unique_errors(errors):
+    """errors with each message kept once, in the order first seen"""
+    unique = []
+    for error in errors:
+        if error not in unique:
+            unique.append(error)
+    return unique